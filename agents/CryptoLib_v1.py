@@ -37,6 +37,9 @@ DEFAULT_BLOCK_SIZE = 32
 DEFAULT_PADDING = '{'
 RANDOM_PARAM = 32
 CHALLENGE_SIZE = 10
+# encodeAESChunks works on chunks of this many blocks. Being a multiple of 3,
+# the chunks' base64 encodings can be concatenated.
+AES_CHUNK_BLOCKS = 3 * 1024
 
 class CryptoLib:
 
@@ -97,20 +100,34 @@ class CryptoLib:
         #data = key.decrypt(encodedData)
         return data
 
-    def encodeAES(self, data, secret):
-        # base64 decode secret
-        secret = base64.b64decode(secret)
-        # generate cipher from secret
-        cipher = AES.new(secret)
+    def newAESCipher(self, secret):
+        # base64 decode secret and generate cipher from it
+        return AES.new(base64.b64decode(secret))
+
+    def encodeAES(self, data, secret, cipher=None):
+        # cipher can be passed in to reuse one built by newAESCipher
+        if cipher is None:
+            cipher = self.newAESCipher(secret)
         # encode data
         encodedData = base64.b64encode(cipher.encrypt(self.pad(data)))
         return encodedData
 
-    def decodeAES(self, encodedData, secret):
-        # base64 decode secret
-        secret = base64.b64decode(secret)
-        # generate cipher from secret
-        cipher = AES.new(secret)
+    def encodeAESChunks(self, data, secret, cipher=None):
+        """Same as encodeAES, but yields the encoded data in chunks, so large
+        messages don't need to be padded, encrypted and encoded as a whole.
+        """
+        if cipher is None:
+            cipher = self.newAESCipher(secret)
+        chunkSize = self.blockSize * AES_CHUNK_BLOCKS
+        # the last chunk is always yielded, since it carries the padding
+        last = len(data) - len(data) % chunkSize
+        for start in xrange(0, last, chunkSize):
+            yield base64.b64encode(cipher.encrypt(data[start:start + chunkSize]))
+        yield base64.b64encode(cipher.encrypt(self.pad(data[last:])))
+
+    def decodeAES(self, encodedData, secret, cipher=None):
+        if cipher is None:
+            cipher = self.newAESCipher(secret)
         # decode data
         data = cipher.decrypt(base64.b64decode(encodedData)).rstrip(self.padding)
         return data
@@ -143,19 +160,30 @@ class RSAKey:
         self.u = u
 
     def getPublicKey(self):
-        rsaKey = RSA.construct((long(self.mod), long(self.exp)))
-        return rsaKey.publickey()
+        # The constructed keys are kept in the instance, since building them
+        # is expensive. getattr is needed for instances pickled before that.
+        publicKey = getattr(self, '_publicKey', None)
+        if publicKey is None:
+            rsaKey = RSA.construct((long(self.mod), long(self.exp)))
+            publicKey = self._publicKey = rsaKey.publickey()
+        return publicKey
 
     def getPrivateKey(self):
-        rsaKey = RSA.construct((long(self.mod), long(self.exp), long(self.d), long(self.p), long(self.q), long(self.u)))
-        return rsaKey
+        privateKey = getattr(self, '_privateKey', None)
+        if privateKey is None:
+            privateKey = self._privateKey = RSA.construct((long(self.mod), long(self.exp), long(self.d), long(self.p), long(self.q), long(self.u)))
+        return privateKey
+
+    def __getstate__(self):
+        # RSAKey instances are stored in memcache, leave the RSA objects out
+        state = self.__dict__.copy()
+        state.pop('_publicKey', None)
+        state.pop('_privateKey', None)
+        return state
 
 
 ##############################################################################
 
-#
-# TODO: We might be able to cache the aggregatorKey. Check how we can optimize this
-#
 crypto = CryptoLib()
 aggregatorKey = RSAKey(settings.RSAKEY_MOD,
                        settings.RSAKEY_EXP,
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##
+## Author: Adriano Monteiro Marques <adriano@umitproject.org>
+##
+## Copyright (C) 2011 S2S Network Consultoria e Tecnologia da Informacao LTDA
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU Affero General Public License as
+## published by the Free Software Foundation, either version 3 of the
+## License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Affero General Public License for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""Per-process cache of the crypto objects used by the API.
+
+Building the aggregator RSA key, the agents' public keys and the AES ciphers
+is done on every request otherwise. Each process keeps one context per
+CryptoLib version, holding the aggregator private key and bounded LRUs of the
+agents' AES ciphers and public keys, keyed by agent id.
+"""
+
+import threading
+
+from collections import OrderedDict
+
+from django.conf import settings
+
+import agents.CryptoLib
+import agents.CryptoLib_v1
+
+
+CRYPTO_CONTEXT_CACHE_SIZE = getattr(settings, 'CRYPTO_CONTEXT_CACHE_SIZE',
+                                    10000)
+
+
+class LRUCache(object):
+    """Thread safe, bounded mapping that drops the least recently used
+    entries first. Keeps hit and miss counters.
+    """
+
+    def __init__(self, size=CRYPTO_CONTEXT_CACHE_SIZE):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return dict(size=len(self._data), hits=self.hits, misses=self.misses)
+
+
+class CryptoContext(object):
+    """Wraps one of the CryptoLib modules, reusing the expensive objects
+    between requests.
+
+    AES ciphers are only reused while the agent's AES key stays the same, so
+    an agent that registers again with a new key gets a new cipher.
+    """
+
+    def __init__(self, cryptolib, size=CRYPTO_CONTEXT_CACHE_SIZE):
+        self.cryptolib = cryptolib
+        self.crypto = cryptolib.crypto
+        self.aggregator_key = cryptolib.aggregatorKey
+        # RSAKey keeps the RSA object it constructs, so this is the only
+        # time the aggregator private key gets built.
+        self.aggregator_key.getPrivateKey()
+        self.ciphers = LRUCache(size)
+        self.public_keys = LRUCache(size)
+
+    def decode_session_key(self, key):
+        """Decrypts a session AES key sent by an agent with the aggregator
+        public key.
+        """
+        return self.crypto.decodeRSAPrivateKey(key, self.aggregator_key)
+
+    def cipher(self, aes_key, agent_id=None):
+        if agent_id is None:
+            return self.crypto.newAESCipher(aes_key)
+
+        entry = self.ciphers.get(agent_id)
+        if entry is None or entry[0] != aes_key:
+            entry = (aes_key, self.crypto.newAESCipher(aes_key))
+            self.ciphers.set(agent_id, entry)
+        return entry[1]
+
+    def decrypt(self, message, message_type, aes_key, agent_id=None):
+        """Decrypts and parses a message into a new message_type object.
+        """
+        msg = self.crypto.decodeAES(message, aes_key,
+                                    cipher=self.cipher(aes_key, agent_id))
+
+        msg_obj = message_type()
+        msg_obj.ParseFromString(msg)
+
+        return msg_obj
+
+    def encrypt(self, data, aes_key, agent_id=None):
+        return self.crypto.encodeAES(data, aes_key,
+                                     cipher=self.cipher(aes_key, agent_id))
+
+    def encrypt_chunks(self, data, aes_key, agent_id=None):
+        return self.crypto.encodeAESChunks(data, aes_key,
+                                           cipher=self.cipher(aes_key, agent_id))
+
+    def public_key(self, agent):
+        """Returns the agent's RSAKey. The RSA object it builds is kept
+        along with it, so it's only constructed once per process.
+        """
+        entry = self.public_keys.get(agent.id)
+        if entry is None or entry[0] != (agent.publicKeyMod,
+                                         agent.publicKeyExp):
+            entry = ((agent.publicKeyMod, agent.publicKeyExp),
+                     self.cryptolib.RSAKey(agent.publicKeyMod,
+                                           agent.publicKeyExp))
+            self.public_keys.set(agent.id, entry)
+        return entry[1]
+
+    def forget(self, agent_id):
+        self.ciphers.delete(agent_id)
+        self.public_keys.delete(agent_id)
+
+    def stats(self):
+        return dict(ciphers=self.ciphers.stats(),
+                    public_keys=self.public_keys.stats())
+
+
+crypto_context = CryptoContext(agents.CryptoLib)
+crypto_context_v1 = CryptoContext(agents.CryptoLib_v1)
+
+def get_crypto_context(crypto_v1=False):
+    """Returns the context of the CryptoLib version used by the request.
+    """
+    if crypto_v1:
+        return crypto_context_v1
+    return crypto_context
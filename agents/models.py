@@ -34,6 +34,8 @@ from dbextra.fields import ListField
 from dbextra.fields import CassandraKeyField
 
 from agents.CryptoLib import *
+from agents.peers import peer_directory
+from geoip.counters import ip_range_counter, location_counter
 from geoip.models import *
 
 
@@ -91,58 +93,8 @@ class LoggedAgent(models.Model):
         return agent
 
     def _getPeers(agent_id, country_code, superPeer, totalPeers):
-        selectedPeers = []
-        
-        peersIDs = []
-
-        # select near peers
-        nearPeers = list(LoggedAgent.objects.filter(Q(country_code=country_code),
-                                                    Q(superPeer=superPeer),
-                                                    ~Q(agent_id=agent_id)))
-
-        # if more peers are needed, get far peers
-        neededPeers = totalPeers-len(nearPeers)
-        if neededPeers>0:
-
-            # list of peer ids to exclude
-            for peer in nearPeers:
-                peersIDs.append(peer.agent_id)
-
-            # select far peers
-            farPeers = list(LoggedAgent.objects.filter(~Q(agent_id=agent_id),
-                                                       Q(superPeer=superPeer)))
-            # shuffle peers
-            random.shuffle(farPeers)
-
-            if len(nearPeers)>0:
-                selectedPeers.extend(nearPeers)
-            if len(farPeers)>0:
-                selectedPeers.extend(farPeers[:neededPeers])
-
-            # if more peers are needed, get offline peers with best uptime
-            neededPeers = totalPeers-len(nearPeers)-len(farPeers)
-            if neededPeers>0:
-
-                # list of peers ids to exclude
-                for peer in farPeers:
-                    peersIDs.append(peer.agent_id)
-
-                # select offline peers sorted by uptime
-                offlinePeers = list(Agent.objects.filter(\
-                                    Q(superPeer=superPeer),
-                                    ~Q(id=agent_id),
-                                    Q(uptime__gt=0)).order_by('-uptime'))
-
-                if len(offlinePeers)>0:
-                    selectedPeers.extend(offlinePeers[:neededPeers])
-
-        else:
-            # shuffle peers
-            random.shuffle(nearPeers)
-            # just select totalPeers
-            selectedPeers.extend(nearPeers[:totalPeers])
-
-        return selectedPeers
+        return peer_directory.get_peers(agent_id, country_code, superPeer,
+                                        totalPeers)
 
     @staticmethod
     def getLoggedAgent(agent_id):
@@ -360,14 +312,11 @@ class Agent(models.Model):
             loggedAgent.state_region = iprange.location.state_region
             loggedAgent.city = iprange.location.city
             loggedAgent.save()
+            peer_directory.add(loggedAgent)
             
             
-            iprange.nodes_count += 1
-            iprange.save()
-            
-            location = iprange.location
-            location.nodes_count += 1
-            location.save()
+            ip_range_counter.add(iprange.id)
+            location_counter.add(iprange.location_id)
             
             
             # update agent information
@@ -391,15 +340,12 @@ class Agent(models.Model):
     def logout(self):
         # TODO: update uptime
         LoggedAgent.objects.filter(agent_id=self.id).delete()
+        peer_directory.remove(self.id)
         
         # Remove from networks list
         iprange = IPRange.ip_location(self.lastKnownIP)
-        iprange.nodes_count -= 1
-        iprange.save()
-        
-        location = iprange.location
-        location.nodes_count -= 1
-        location.save()
+        ip_range_counter.add(iprange.id, -1)
+        location_counter.add(iprange.location_id, -1)
 
     def getPeers(self, totalPeers=100):
         #return Agent._getPeers(country, False, totalPeers)
@@ -444,16 +390,8 @@ class Agent(models.Model):
         return LoggedAgent.getLoggedAgent(self.id)
 
     def public_key(self, crypto_v1=False):
-        if crypto_v1:
-            from agents.CryptoLib_v1 import RSAKey
-        else:
-            from agents.CryptoLib import RSAKey
-        key = PUBLIC_KEY_AGENT_CACHE_KEY % self.id
-        pkey = cache.get(key, False)
-        if not pkey:
-            pkey = RSAKey(self.publicKeyMod, self.publicKeyExp)
-            cache.set(key, pkey, CACHE_EXPIRATION)
-        return pkey
+        from agents.cryptocontext import get_crypto_context
+        return get_crypto_context(crypto_v1).public_key(self)
     
     @property
     def iprange(self):
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##
+## Author: Adriano Monteiro Marques <adriano@umitproject.org>
+##
+## Copyright (C) 2011 S2S Network Consultoria e Tecnologia da Informacao LTDA
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU Affero General Public License as
+## published by the Free Software Foundation, either version 3 of the
+## License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Affero General Public License for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""In-process directory of the logged agents, used to pick peer lists.
+
+Logged agents are kept in buckets by country and by superPeer flag, so a
+random sample of peers costs the size of the sample rather than the size of
+the network. Logins and logouts handled by this process update the directory
+right away; the ones handled elsewhere are picked up when the directory is
+reloaded, every refresh_interval seconds. Only the first load is done while
+serving a request, the next ones are done by a background thread, which
+swaps the new directory in. The best offline peers, by uptime, are
+precomputed on each reload.
+"""
+
+import time
+import random
+import logging
+import threading
+
+from django.conf import settings
+from django.db import close_connection
+
+
+class RandomSet(object):
+    """Set with O(1) add, remove and random access.
+    """
+
+    def __init__(self):
+        self._items = []
+        self._positions = {}
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def add(self, key, value):
+        if key in self._positions:
+            self._items[self._positions[key]] = (key, value)
+        else:
+            self._positions[key] = len(self._items)
+            self._items.append((key, value))
+
+    def remove(self, key):
+        position = self._positions.pop(key, None)
+        if position is None:
+            return
+        # move the last item to the removed item's position
+        last = self._items.pop()
+        if position < len(self._items):
+            self._items[position] = last
+            self._positions[last[0]] = position
+
+    def sample(self, count, exclude=()):
+        """Returns up to count random values whose keys aren't in exclude.
+        """
+        count = min(count, len(self._items))
+        if count <= 0:
+            return []
+        # exclude is small, so asking for a few more items is enough
+        extra = min(len(exclude), len(self._items) - count)
+        items = random.sample(self._items, count + extra)
+        return [value for key, value in items if key not in exclude][:count]
+
+
+class PeerDirectory(object):
+
+    def __init__(self, refresh_interval=60, offline_peers=100):
+        self.refresh_interval = refresh_interval
+        self.offline_peers = offline_peers
+        self._loaded_at = None
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        self._by_country = {}
+        self._by_type = {True: RandomSet(), False: RandomSet()}
+        self._countries = {}
+        self._offline = {True: [], False: []}
+
+    def _bucket(self, country_code, superPeer):
+        key = (country_code, bool(superPeer))
+        bucket = self._by_country.get(key)
+        if bucket is None:
+            bucket = self._by_country[key] = RandomSet()
+        return bucket
+
+    def _add(self, logged_agent):
+        self._remove(logged_agent.agent_id)
+        superPeer = bool(logged_agent.superPeer)
+        self._bucket(logged_agent.country_code, superPeer).add(
+                logged_agent.agent_id, logged_agent)
+        self._by_type[superPeer].add(logged_agent.agent_id, logged_agent)
+        self._countries[logged_agent.agent_id] = (logged_agent.country_code,
+                                                  superPeer)
+
+    def _remove(self, agent_id):
+        key = self._countries.pop(agent_id, None)
+        if key is None:
+            return
+        self._by_country[key].remove(agent_id)
+        self._by_type[key[1]].remove(agent_id)
+
+    def load(self):
+        """Rebuilds the directory from the LoggedAgent table and recomputes
+        the best offline peers.
+        """
+        from agents.models import LoggedAgent, Agent
+
+        logged_agents = list(LoggedAgent.objects.all())
+        offline = {}
+        for superPeer in (True, False):
+            offline[superPeer] = list(Agent.objects.filter(
+                    superPeer=superPeer,
+                    uptime__gt=0).order_by('-uptime')[:self.offline_peers])
+
+        with self._lock:
+            self._clear()
+            for logged_agent in logged_agents:
+                self._add(logged_agent)
+            self._offline = offline
+            self._loaded_at = time.time()
+
+    def _schedule(self):
+        timer = threading.Timer(self.refresh_interval, self._timed_load)
+        timer.daemon = True
+        timer.start()
+
+    def _timed_load(self):
+        try:
+            self.load()
+        except Exception, e:
+            # The current directory is kept until the next reload
+            logging.error("Failed to reload the peer directory: %s" % e)
+        finally:
+            # Give the timer thread's database connections back
+            close_connection()
+            self._schedule()
+
+    def _refresh(self):
+        if self._loaded_at is not None:
+            return
+
+        with self._load_lock:
+            if self._loaded_at is None:
+                self.load()
+                self._schedule()
+
+    def add(self, logged_agent):
+        """Called when an agent logs in.
+        """
+        with self._lock:
+            if self._loaded_at is not None:
+                self._add(logged_agent)
+
+    def remove(self, agent_id):
+        """Called when an agent logs out.
+        """
+        with self._lock:
+            self._remove(agent_id)
+
+    def get_peers(self, agent_id, country_code, superPeer, totalPeers):
+        """Returns up to totalPeers peers for the agent. Logged agents from
+        the same country come first, then logged agents from anywhere and
+        then the offline agents with the best uptime.
+        """
+        self._refresh()
+        superPeer = bool(superPeer)
+
+        with self._lock:
+            selected = []
+            exclude = set([agent_id])
+
+            bucket = self._by_country.get((country_code, superPeer))
+            if bucket is not None:
+                selected.extend(bucket.sample(totalPeers, exclude))
+
+            neededPeers = totalPeers - len(selected)
+            if neededPeers > 0:
+                exclude.update([peer.agent_id for peer in selected])
+                selected.extend(self._by_type[superPeer].sample(neededPeers,
+                                                                exclude))
+
+            offline = self._offline[superPeer]
+
+        neededPeers = totalPeers - len(selected)
+        if neededPeers > 0:
+            exclude.update([peer.agent_id for peer in selected])
+            selected.extend([peer for peer in offline
+                             if peer.id not in exclude][:neededPeers])
+
+        return selected
+
+
+peer_directory = PeerDirectory(
+        refresh_interval=getattr(settings, 'PEER_DIRECTORY_REFRESH_INTERVAL', 60),
+        offline_peers=getattr(settings, 'PEER_DIRECTORY_OFFLINE_PEERS', 100))
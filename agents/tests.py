@@ -5,8 +5,16 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import pickle
+
+from django.conf import settings
 from django.test import TestCase
 
+from agents import CryptoLib, CryptoLib_v1
+from agents.cryptocontext import LRUCache, CryptoContext
+from agents.peers import RandomSet, PeerDirectory
+from icm_utils.testing import PatchingTestCase
+
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -14,3 +22,116 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class RandomSetTest(TestCase):
+    def setUp(self):
+        self.set = RandomSet()
+        for key in range(10):
+            self.set.add(key, str(key))
+
+    def test_remove(self):
+        self.set.remove(3)
+        self.set.remove(9)
+        self.set.remove(42)
+        self.assertEqual(len(self.set), 8)
+        self.assertFalse(3 in self.set)
+        self.assertEqual(sorted(self.set.sample(10)),
+                         ['0', '1', '2', '4', '5', '6', '7', '8'])
+
+    def test_sample_exclude(self):
+        for i in range(20):
+            sample = self.set.sample(9, exclude=set([0]))
+            self.assertEqual(len(sample), 9)
+            self.assertFalse('0' in sample)
+
+
+class PeerDirectoryTest(PatchingTestCase):
+    def setUp(self):
+        super(PeerDirectoryTest, self).setUp()
+        self.directory = PeerDirectory(refresh_interval=0)
+        self.loads = []
+        self.scheduled = []
+        def load():
+            self.loads.append(None)
+            self.directory._loaded_at = len(self.loads)
+        self.patch(self.directory, 'load', load)
+        self.patch(self.directory, '_schedule',
+                   lambda: self.scheduled.append(None))
+
+    def test_requests_only_load_once(self):
+        for i in range(3):
+            self.directory.get_peers('agent', 'BR', False, 10)
+        self.assertEqual(len(self.loads), 1)
+        self.assertEqual(len(self.scheduled), 1)
+
+    def test_failed_reload_keeps_directory(self):
+        self.directory.get_peers('agent', 'BR', False, 10)
+        def load():
+            raise IOError("unavailable")
+        self.patch(self.directory, 'load', load)
+        self.directory._timed_load()
+        self.assertEqual(self.directory._loaded_at, 1)
+        self.assertEqual(len(self.scheduled), 2)
+
+
+class AESChunksTest(TestCase):
+    def check_chunks(self, module):
+        crypto = module.CryptoLib()
+        key = crypto.generateAESKey()
+        chunkSize = crypto.blockSize * module.AES_CHUNK_BLOCKS
+        for size in (0, 1, crypto.blockSize, chunkSize - 1, chunkSize,
+                     chunkSize + 1, 2 * chunkSize, 2 * chunkSize + 5):
+            data = ''.join([chr(i % 256) for i in range(size)])
+            self.assertEqual(''.join(crypto.encodeAESChunks(data, key)),
+                             crypto.encodeAES(data, key),
+                             "Chunks differ for %s bytes" % size)
+
+    def test_chunks(self):
+        self.check_chunks(CryptoLib)
+
+    def test_chunks_v1(self):
+        self.check_chunks(CryptoLib_v1)
+
+
+class LRUCacheTest(TestCase):
+    def test_eviction_order(self):
+        lru = LRUCache(size=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        # Reading 'a' makes 'b' the least recently used
+        self.assertEqual(lru.get('a'), 1)
+        lru.set('c', 3)
+        self.assertEqual(lru.get('b'), None)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertEqual(lru.get('c'), 3)
+        self.assertEqual(lru.stats(), dict(size=2, hits=3, misses=1))
+
+
+class FakeAgent(object):
+    def __init__(self, id, mod=settings.RSAKEY_MOD, exp=settings.RSAKEY_EXP):
+        self.id = id
+        self.publicKeyMod = mod
+        self.publicKeyExp = exp
+
+
+class CryptoContextTest(TestCase):
+    def test_reuses_public_key(self):
+        context = CryptoContext(CryptoLib, size=10)
+        agent = FakeAgent(1)
+        key = context.public_key(agent)
+        rsa = key.getPublicKey()
+        self.assertTrue(context.public_key(agent) is key)
+        self.assertTrue(key.getPublicKey() is rsa)
+
+        # A new key replaces the cached one
+        agent.publicKeyExp = 3
+        self.assertFalse(context.public_key(agent) is key)
+
+    def test_pickle_leaves_rsa_out(self):
+        for module in (CryptoLib, CryptoLib_v1):
+            key = module.RSAKey(settings.RSAKEY_MOD, settings.RSAKEY_EXP)
+            key.getPublicKey()
+            state = pickle.loads(pickle.dumps(key)).__dict__
+            self.assertFalse('_publicKey' in state)
+            self.assertEqual(state['mod'], key.mod)
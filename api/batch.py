@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##
+## Author: Adriano Monteiro Marques <adriano@umitproject.org>
+##
+## Copyright (C) 2011 S2S Network Consultoria e Tecnologia da Informacao LTDA
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU Affero General Public License as
+## published by the Free Software Foundation, either version 3 of the
+## License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Affero General Public License for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""Envelope used by agents to send several reports in a single request.
+
+Both the request and the response are a sequence of records, each one being
+a type byte, the payload length as a 4 bytes big-endian integer and the
+payload. The envelope is encrypted as a whole, like any other api message.
+
+Request records carry a serialized SendWebsiteReport ('W') or
+SendServiceReport ('S'). The response starts with a SendReportResponse ('H'),
+holding the usual header, followed by one status record ('R') per report, in
+the order they were sent. Requests with more than REPORT_BATCH_MAX_REPORTS
+records are rejected.
+"""
+
+import struct
+import logging
+
+from django.conf import settings
+
+from umit.proto import messages_pb2
+
+from agents.models import LoggedAgent
+from geoip.models import IPRange
+from reports.models import WebsiteReport, ServiceReport, traceroute_ips
+from reports.tasks import enqueue_report
+from decision.decisionSystem import DecisionSystem
+
+
+RECORD_HEADER = struct.Struct('>cI')
+
+WEBSITE_REPORT_RECORD = 'W'
+SERVICE_REPORT_RECORD = 'S'
+RESPONSE_HEADER_RECORD = 'H'
+REPORT_STATUS_RECORD = 'R'
+
+REPORT_RECORDS = {
+    WEBSITE_REPORT_RECORD: ('WEBSITE', messages_pb2.SendWebsiteReport),
+    SERVICE_REPORT_RECORD: ('SERVICE', messages_pb2.SendServiceReport),
+}
+
+# Report statuses
+STATUS_OK = 'OK'
+STATUS_QUEUED = 'QUEUED'
+STATUS_INVALID = 'INVALID'
+STATUS_FAILED = 'FAILED'
+
+
+def read_records(data, max_records=None):
+    """Yields the (type, payload) records of an envelope, which can't have
+    more than max_records of them.
+    """
+    offset = 0
+    count = 0
+    while offset < len(data):
+        count += 1
+        if max_records is not None and count > max_records:
+            raise ValueError("More than %s records" % max_records)
+        if offset + RECORD_HEADER.size > len(data):
+            raise ValueError("Truncated record header at %s" % offset)
+        record_type, length = RECORD_HEADER.unpack_from(data, offset)
+        offset += RECORD_HEADER.size
+        if offset + length > len(data):
+            raise ValueError("Truncated record at %s" % offset)
+        yield record_type, data[offset:offset + length]
+        offset += length
+
+def write_record(record_type, payload):
+    return RECORD_HEADER.pack(record_type, len(payload)) + payload
+
+
+class ReportBatch(object):
+    """Request message for SendReportBatchHandler. Has the same parsing
+    interface as the protobuf messages, so message_handler can decrypt it.
+
+    reports is a list of (report type, message) pairs. The message is None
+    for records that couldn't be parsed.
+    """
+
+    def __init__(self):
+        self.reports = []
+
+    def ParseFromString(self, data):
+        records = read_records(data, settings.REPORT_BATCH_MAX_REPORTS)
+        for record_type, payload in records:
+            report_type, message_type = REPORT_RECORDS.get(record_type,
+                                                           (None, None))
+            report = None
+            if message_type is not None:
+                try:
+                    report = message_type()
+                    report.ParseFromString(payload)
+                except Exception, e:
+                    logging.error("Invalid report in batch: %s" % e)
+                    report = None
+            self.reports.append((report_type, report))
+
+
+class ReportBatchResponse(object):
+    """Response message for SendReportBatchHandler.
+    """
+
+    def __init__(self):
+        self.response = messages_pb2.SendReportResponse()
+        self.header = self.response.header
+        self.statuses = []
+
+    def SerializeToString(self):
+        records = [write_record(RESPONSE_HEADER_RECORD,
+                                self.response.SerializeToString())]
+        records.extend([write_record(REPORT_STATUS_RECORD, status)
+                        for status in self.statuses])
+        return ''.join(records)
+
+
+def create_reports(batch, agent):
+    """Adds every report in the batch and returns their statuses. The agent's
+    login info is read once and all the traceroutes are geolocated together.
+    """
+    if agent is None:
+        raise Exception("Reports can only be sent by registered agents")
+
+    statuses = []
+
+    if settings.ASYNC_REPORT_INGESTION:
+        for report_type, report_msg in batch.reports:
+            if report_msg is None:
+                statuses.append(STATUS_INVALID)
+                continue
+            try:
+                enqueue_report(report_type, report_msg, agent)
+                statuses.append(STATUS_QUEUED)
+            except Exception, e:
+                logging.error("Failed to queue report from batch: %s" % e)
+                statuses.append(STATUS_FAILED)
+        return statuses
+
+    try:
+        loggedAgent = agent.getLoginInfo()
+    except LoggedAgent.DoesNotExist:
+        loggedAgent = None
+
+    ips = []
+    for report_type, report_msg in batch.reports:
+        if report_msg is not None and \
+           report_msg.report.header.HasField('traceroute'):
+            ips.extend(traceroute_ips(report_msg.report.header.traceroute))
+    locations = IPRange.locate_many(ips)
+
+    for report_type, report_msg in batch.reports:
+        if report_msg is None or not report_msg.IsInitialized():
+            statuses.append(STATUS_INVALID)
+            continue
+        try:
+            if report_type == 'WEBSITE':
+                WebsiteReport.create(report_msg, agent, locations, loggedAgent)
+            else:
+                report = ServiceReport.create(report_msg, agent, locations,
+                                              loggedAgent)
+                DecisionSystem.newReport(report)
+            statuses.append(STATUS_OK)
+        except Exception, e:
+            logging.error("Failed to add report from batch: %s" % e)
+            statuses.append(STATUS_FAILED)
+
+    return statuses
@@ -19,12 +19,55 @@
 ## along with this program.  If not, see <http://www.gnu.org/licenses/>.
 ##
 
+import hashlib
 import logging
 
+from django.core.cache import cache
+
 from agents.models import Agent
 from versions.models import *
 from icm_tests.models import Test
-from agents.CryptoLib import crypto, aggregatorKey, aes_decrypt
+from agents.cryptocontext import get_crypto_context
+from api.streaming import EncryptedResponse
+
+
+VERSION_HEADER_CACHE_KEY = "version_header_%s"
+
+
+def get_version_header(agent, agent_type=None):
+    """Returns the latest software version for the agent type and the test
+    version for the agent's location, which go in every response header.
+
+    Agent types other than DESKTOP get the MOBILE version, and requests
+    without an agent get no version. The headers are cached per agent type
+    and city, until a software version is released or the test
+    aggregation changes.
+    """
+    if agent_type is None and agent is not None:
+        agent_type = agent.agent_type
+
+    location = agent.location if agent is not None else None
+    if location:
+        place = (location.country_name, location.state_region, location.city)
+    else:
+        place = (None, None, None)
+
+    # Cities have spaces and non-ascii characters, which memcache won't take
+    vector = repr((get_version_header_generation(), agent is not None,
+                   agent_type) + place)
+    key = VERSION_HEADER_CACHE_KEY % hashlib.md5(vector).hexdigest()
+
+    header = cache.get(key)
+    if header is None:
+        if agent_type is None:
+            software_version = None
+        elif agent_type == 'DESKTOP':
+            software_version = DesktopAgentVersion.getLastVersionNo()
+        else:
+            software_version = MobileAgentVersion.getLastVersionNo()
+        header = (software_version, Test.get_test_version(agent))
+        cache.set(key, header, VERSION_HEADER_EXPIRATION)
+    return header
 
 
 class message_handler(object):
@@ -40,10 +83,7 @@ class message_handler(object):
     
     def __call__(self, method):
         def new_method(handler, request, *args, **kwargs):
-            if request.POST.get('crypto_v1', None):
-                from agents.CryptoLib_v1 import crypto, CryptoLib, aggregatorKey, aes_decrypt
-            else:
-                from agents.CryptoLib import crypto, CryptoLib, aggregatorKey, aes_decrypt
+            context = get_crypto_context(request.POST.get('crypto_v1', None))
             aes_key = None
             agent = None
             
@@ -56,32 +96,22 @@ class message_handler(object):
                 assert agent_id
                 
                 agent = Agent.get_agent(agent_id)
+                agent_id = agent.id
                 aes_key = agent.AESKey
             else:
-                aes_key = crypto.decodeRSAPrivateKey(key, aggregatorKey)
+                aes_key = context.decode_session_key(key)
+                # The agent's cipher is only cached once it's known to be
+                # using the agent's stored key
+                agent_id = None
             
+            msg_obj = context.decrypt(message, self.message_type, aes_key,
+                                      agent_id)
             
-            aes_key, msg_obj = aes_decrypt(message,
-                                           self.message_type,
-                                           aes_key=aes_key)
-            
-            # get software version information
-            # TODO: CACHE the desktop and mobile latest versions so we don't need
-            # to reach out to the datastore to get that upon every api request.
-            software_version = None
-            if agent is not None:
-                if agent.agent_type == 'DESKTOP':
-                    software_version = DesktopAgentVersion.getLastVersionNo()
-                elif agent.agent_type == 'MOBILE':
-                    software_version = MobileAgentVersion.getLastVersionNo()
-                else:
-                    logging.error("Unknown agent type '%s' - Agent %s" % \
-                                    ( agent.agent_type, agent))
-            
-            # get lastest test id
-            # TODO: Cache the latest test version to avoid going to datastore on
-            # every api request
-            test_version = Test.get_test_version(agent)
+            software_version, test_version = get_version_header(agent)
+            if agent is not None and \
+               agent.agent_type not in AGENT_VERSION_MODELS:
+                logging.error("Unknown agent type '%s' - Agent %s" % \
+                                ( agent.agent_type, agent))
             
             response = None
             if self.response_type is not None:
@@ -101,8 +131,8 @@ class message_handler(object):
                                   response,
                                   *args, **kwargs)
             
-            # Need to encrypt and return the response now
-            return crypto.encodeAES(response, aes_key)
+            # The response is encrypted while it's written out
+            return EncryptedResponse(context, response, aes_key, agent_id)
         
         return new_method
 
@@ -35,15 +35,16 @@ from piston.handler import BaseHandler
 
 from suggestions.models import WebsiteSuggestion, ServiceSuggestion
 from reports.models import WebsiteReport, ServiceReport
+from reports.tasks import enqueue_report
 from events.models import Event
-from versions.models import DesktopAgentVersion, MobileAgentVersion
 from icm_tests.models import Test, WebsiteTest, ServiceTest
 from decision.decisionSystem import DecisionSystem
 from agents.models import *
 from agents.CryptoLib import *
 from geoip.models import *
 
-from api.decorators import message_handler
+from api.decorators import message_handler, get_version_header
+from api.batch import ReportBatch, ReportBatchResponse, create_reports
 
 
 class RegisterAgentHandler(BaseHandler):
@@ -168,14 +169,8 @@ class Login2Handler(BaseHandler):
                                   crypto_v1=request.POST.get('crypto_v1',False))
 
         if agent is not None:
-            # get software version information
-            if agent.agent_type=='DESKTOP':
-                softwareVersion = DesktopAgentVersion.getLastVersionNo()
-            else:
-                softwareVersion = MobileAgentVersion.getLastVersionNo()
-
-            # get last test id
-            testVersion = Test.get_test_version(agent)
+            # get software version information and last test id
+            softwareVersion, testVersion = get_version_header(agent)
 
             # create the response
             response = messages_pb2.LoginResponse()
@@ -302,7 +297,7 @@ class GetNetlistHandler(BaseHandler):
         count = received_msg.count if received_msg.count < settings.MAX_NETLIST_RESPONSE else settings.MAX_NETLIST_RESPONSE
         
         # TODO: Retrieve randomized list 
-        netlist = IPRange.objects.all().order_by("-nodes_count")[:count]
+        netlist = IPRange.top_networks(count)
         
         for net in netlist:
             network = response.networks.add()
@@ -425,8 +420,12 @@ class SendWebsiteReportHandler(BaseHandler):
     @message_handler(request_message, response_message)
     def create(self, request, received_website_report, aes_key, agent,
                software_version, test_version, response):
-        # add website report
-        WebsiteReport.create(received_website_report, agent)
+        if settings.ASYNC_REPORT_INGESTION:
+            # queue website report, to be added by a worker
+            enqueue_report('WEBSITE', received_website_report, agent)
+        else:
+            # add website report
+            WebsiteReport.create(received_website_report, agent)
 
         # send back response
         response_str = response.SerializeToString()
@@ -445,11 +444,15 @@ class SendServiceReportHandler(BaseHandler):
     @message_handler(request_message, response_message)
     def create(self, request, received_service_report, aes_key, agent,
                software_version, test_version, response):
-        # add service report
-        serviceReport = ServiceReport.create(received_service_report, agent)
+        if settings.ASYNC_REPORT_INGESTION:
+            # queue service report, to be added by a worker
+            enqueue_report('SERVICE', received_service_report, agent)
+        else:
+            # add service report
+            serviceReport = ServiceReport.create(received_service_report, agent)
 
-        # send report to decision system
-        DecisionSystem.newReport(serviceReport)
+            # send report to decision system
+            DecisionSystem.newReport(serviceReport)
         
         # send back response
         response_str = response.SerializeToString()
@@ -457,6 +460,28 @@ class SendServiceReportHandler(BaseHandler):
         return response_str
 
 
+class SendReportBatchHandler(BaseHandler):
+    """Adds several website and service reports, sent together in a single
+    envelope (see api.batch), and returns the status of each one of them.
+    """
+
+    allowed_methods = ('POST',)
+    url = 'sendreportbatch/'
+
+    request_message = ReportBatch
+    response_message = ReportBatchResponse
+
+    @message_handler(request_message, response_message)
+    def create(self, request, received_batch, aes_key, agent,
+               software_version, test_version, response):
+        response.statuses = create_reports(received_batch, agent)
+
+        # send back response
+        response_str = response.SerializeToString()
+        
+        return response_str
+
+
 class CheckNewVersionHandler(BaseHandler):
 
     allowed_methods = ('POST',)
@@ -568,14 +593,13 @@ class CheckAggregator(BaseHandler):
     def create(self, request, received_check_aggregator, aes_key, agent,
                software_version, test_version, response):
 
-        # get software version information
+        # get software version information and last test id
         if received_check_aggregator.agentType=='DESKTOP':
-            softwareVersion = DesktopAgentVersion.getLastVersionNo()
+            agent_type = 'DESKTOP'
         else:
-            softwareVersion = MobileAgentVersion.getLastVersionNo()
-
-        # get last test id
-        test_version = Test.get_test_version(agent)
+            agent_type = 'MOBILE'
+        softwareVersion, test_version = get_version_header(agent,
+                                                           agent_type)
 
         # create the response
         response.status = "ON"
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##
+## Author: Adriano Monteiro Marques <adriano@umitproject.org>
+##
+## Copyright (C) 2011 S2S Network Consultoria e Tecnologia da Informacao LTDA
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU Affero General Public License as
+## published by the Free Software Foundation, either version 3 of the
+## License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Affero General Public License for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""Streaming of the encrypted api responses.
+
+message_handler returns an EncryptedResponse, which is only encrypted and
+base64 encoded while piston writes it out, one chunk at a time. The wire
+format is the same as the JSON emitter produces for a string.
+
+Since the headers are sent before the response is encrypted, an encryption
+error can't turn into an error response anymore. It's logged and the stream
+is cut short, so the agent gets an unterminated string instead of a
+response.
+"""
+
+import logging
+
+from piston.resource import Resource
+from piston.emitters import Emitter, JSONEmitter
+from piston.validate_jsonp import is_valid_jsonp_callback_value
+
+
+class EncryptedResponse(object):
+    """A serialized response, to be encrypted with the given aes_key.
+    """
+
+    def __init__(self, context, data, aes_key, agent_id=None):
+        self.context = context
+        self.data = data
+        self.aes_key = aes_key
+        self.agent_id = agent_id
+
+    def __iter__(self):
+        return self.context.encrypt_chunks(self.data, self.aes_key,
+                                           self.agent_id)
+
+    def __str__(self):
+        return self.context.encrypt(self.data, self.aes_key, self.agent_id)
+
+
+class EncryptedJSONEmitter(JSONEmitter):
+    """JSON emitter that writes EncryptedResponses as a JSON string, without
+    building the whole string first when streaming.
+    """
+
+    def _callback(self, request):
+        cb = request.GET.get('callback', None)
+        if cb and is_valid_jsonp_callback_value(cb):
+            return cb
+
+    def render(self, request):
+        if not isinstance(self.data, EncryptedResponse):
+            return super(EncryptedJSONEmitter, self).render(request)
+
+        # base64 doesn't have any character that needs escaping
+        seria = '"%s"' % self.data
+        cb = self._callback(request)
+        if cb:
+            return '%s(%s)' % (cb, seria)
+        return seria
+
+    def stream_render(self, request, stream=True):
+        if not isinstance(self.data, EncryptedResponse):
+            yield self.render(request)
+            return
+
+        cb = self._callback(request)
+        if cb:
+            yield '%s(' % cb
+        yield '"'
+        chunks = iter(self.data)
+        try:
+            for chunk in chunks:
+                yield chunk
+        except Exception:
+            logging.exception("Failed to encrypt the api response")
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+            return
+        yield '"'
+        if cb:
+            yield ')'
+
+Emitter.register('json', EncryptedJSONEmitter,
+                 'application/json; charset=utf-8')
+
+
+class StreamingResource(Resource):
+    """Resource that always streams its output, regardless of
+    PISTON_STREAM_OUTPUT.
+    """
+
+    def __init__(self, handler, authentication=None):
+        super(StreamingResource, self).__init__(handler, authentication)
+        self.stream = True
@@ -27,12 +27,17 @@ import logging
 
 import settings
 
+from django.conf import settings as django_settings
 from django.test import TestCase
 from django.test.client import Client
 
 from umit.proto import messages_pb2
 
 from agents.CryptoLib import *
+from api import batch, decorators
+from api.batch import read_records, write_record, ReportBatch, create_reports
+from api.streaming import EncryptedResponse, EncryptedJSONEmitter
+from icm_utils.testing import PatchingTestCase
 
 
 mod = 109916896023924130410814755146616820050848287195403807165245502023708307057182505344954954927069297885076677369989575235572225938578405052695849113605912075520043830304524405776689005895802218122674008335365710906635693457269579474788929265226007718176605597921238270933430352422527094012100555192243443310437
@@ -734,3 +739,148 @@ class APITestCase(TestCase):
         checkAggregator.ParseFromString(msg)
 
         logging.info("Aggregator is " + checkAggregator.status)
+
+
+class FakeVersion(object):
+    def __init__(self, version):
+        self.version = version
+
+
+class FakeAgent(object):
+    location = None
+
+    def __init__(self, agent_type):
+        self.agent_type = agent_type
+
+
+class VersionHeaderTest(PatchingTestCase):
+    def setUp(self):
+        super(VersionHeaderTest, self).setUp()
+        self.patch_cache(decorators)
+        self.patch(decorators.DesktopAgentVersion, 'getLastVersionNo',
+                   staticmethod(lambda: FakeVersion(1)))
+        self.patch(decorators.MobileAgentVersion, 'getLastVersionNo',
+                   staticmethod(lambda: FakeVersion(2)))
+        self.patch(decorators.Test, 'get_test_version',
+                   staticmethod(lambda agent: 3))
+
+    def get_version(self, agent, agent_type=None):
+        software_version, test_version = decorators.get_version_header(
+                                            agent, agent_type)
+        self.assertEqual(test_version, 3)
+        return software_version and software_version.version
+
+    def test_agent_types(self):
+        self.assertEqual(self.get_version(FakeAgent('DESKTOP')), 1)
+        self.assertEqual(self.get_version(FakeAgent('MOBILE')), 2)
+        # Unknown types fall back to the mobile version
+        self.assertEqual(self.get_version(FakeAgent('TABLET')), 2)
+        self.assertEqual(self.get_version(None, 'DESKTOP'), 1)
+        self.assertEqual(self.get_version(None), None)
+
+
+class FakeReportMessage(object):
+    def ParseFromString(self, data):
+        # Like the protobuf messages, which raise DecodeError
+        if data == 'garbled':
+            raise ValueError("Truncated message")
+        self.data = data
+
+    def IsInitialized(self):
+        return True
+
+
+class ReportBatchTest(PatchingTestCase):
+    def setUp(self):
+        super(ReportBatchTest, self).setUp()
+        self.patch(batch, 'REPORT_RECORDS',
+                   {'W': ('WEBSITE', FakeReportMessage)})
+
+    def test_records(self):
+        data = write_record('W', 'report') + write_record('R', '') + \
+               write_record('S', 'x' * 300)
+        self.assertEqual(list(read_records(data)),
+                         [('W', 'report'), ('R', ''), ('S', 'x' * 300)])
+        self.assertEqual(list(read_records('')), [])
+
+    def test_truncated_records(self):
+        data = write_record('W', 'report')
+        self.assertRaises(ValueError, list, read_records(data[:3]))
+        self.assertRaises(ValueError, list, read_records(data[:-1]))
+        self.assertRaises(ValueError, list, read_records(data + 'W'))
+
+    def test_max_records(self):
+        data = write_record('W', 'report') * 3
+        self.assertEqual(len(list(read_records(data, 3))), 3)
+        self.assertRaises(ValueError, list, read_records(data, 2))
+
+        data = write_record('W', 'report') * \
+               (django_settings.REPORT_BATCH_MAX_REPORTS + 1)
+        self.assertRaises(ValueError, ReportBatch().ParseFromString, data)
+
+    def test_truncated_batch(self):
+        data = write_record('W', 'report') + write_record('W', 'report')
+        self.assertRaises(ValueError, ReportBatch().ParseFromString,
+                          data[:-2])
+
+    def test_garbled_reports(self):
+        received = ReportBatch()
+        received.ParseFromString(write_record('W', 'report') +
+                                 write_record('W', 'garbled') +
+                                 write_record('X', 'report'))
+        self.assertEqual([report_type for report_type, report in
+                          received.reports], ['WEBSITE', 'WEBSITE', None])
+        self.assertEqual(received.reports[0][1].data, 'report')
+        self.assertEqual(received.reports[1][1], None)
+        self.assertEqual(received.reports[2][1], None)
+
+        queued = []
+        def enqueue_report(report_type, report_msg, agent):
+            queued.append(report_msg)
+        self.patch(batch, 'enqueue_report', enqueue_report)
+        self.patch(django_settings, 'ASYNC_REPORT_INGESTION', True)
+
+        statuses = create_reports(received, object())
+        self.assertEqual(statuses, [batch.STATUS_QUEUED, batch.STATUS_INVALID,
+                                    batch.STATUS_INVALID])
+        self.assertEqual(queued, [received.reports[0][1]])
+
+
+class FakeCryptoContext(object):
+    def __init__(self, fail_at=None):
+        self.fail_at = fail_at
+        self.closed = False
+
+    def encrypt_chunks(self, data, aes_key, agent_id=None):
+        try:
+            for i, chunk in enumerate(data):
+                if i == self.fail_at:
+                    raise ValueError("Invalid key")
+                yield chunk.upper()
+        finally:
+            self.closed = True
+
+
+class FakeRequest(object):
+    def __init__(self, callback=None):
+        self.GET = {}
+        if callback:
+            self.GET['callback'] = callback
+
+
+class EncryptedStreamTest(TestCase):
+    def render(self, context, callback=None):
+        emitter = EncryptedJSONEmitter(
+                EncryptedResponse(context, ['a', 'b', 'c'], 'key'),
+                None, None)
+        return ''.join(emitter.stream_render(FakeRequest(callback)))
+
+    def test_stream(self):
+        self.assertEqual(self.render(FakeCryptoContext()), '"ABC"')
+        self.assertEqual(self.render(FakeCryptoContext(), 'cb'), 'cb("ABC")')
+
+    def test_encryption_error(self):
+        context = FakeCryptoContext(fail_at=1)
+        # The string is left unterminated, so the agent can't parse it
+        self.assertEqual(self.render(context), '"A')
+        self.assertTrue(context.closed)
@@ -21,7 +21,7 @@
 ##
 
 from django.conf.urls.defaults import *
-from piston.resource import Resource
+from api.streaming import StreamingResource
 from api.handlers import *
 from gui.decorators import staff_member_required
 
@@ -39,6 +39,7 @@ ACTIVE_HANDLERS = (
     GetEventsHandler,
     SendWebsiteReportHandler,
     SendServiceReportHandler,
+    SendReportBatchHandler,
     CheckNewVersionHandler,
     CheckNewTestHandler,
     WebsiteSuggestionHandler,
@@ -48,6 +49,6 @@ ACTIVE_HANDLERS = (
 
 
 urlpatterns = patterns('',
-    *[url(r'^%s/?$' % Handler.url, Resource(Handler)) \
+    *[url(r'^%s/?$' % Handler.url, StreamingResource(Handler)) \
       for Handler in ACTIVE_HANDLERS]
 )
@@ -19,12 +19,12 @@
 ## along with this program.  If not, see <http://www.gnu.org/licenses/>.
 ##
 
-import csv
-import decimal
-import cStringIO, StringIO
 from collections import deque
 
-from django.db import models
+from django.db import models, router, DEFAULT_DB_ALIAS
+from django.db.models import signals
+
+from dbextra.listcodec import encode_list, decode_list
 
 
 class FIFOList(deque):
@@ -51,12 +51,50 @@ class FIFOList(deque):
         return list(self)
 
 
+class EncodedList(object):
+    """A ListField value as read from the database, before it's decoded.
+    """
+    __slots__ = ('raw',)
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    def __getstate__(self):
+        return self.raw
+
+    def __setstate__(self, raw):
+        self.raw = raw
+
+
+class ListFieldDescriptor(object):
+    """Keeps the values read from the database encoded until the field is
+    first accessed, so the fields that are never read are never decoded.
+    """
+
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, obj, type=None):
+        if obj is None:
+            raise AttributeError('Can only be accessed via an instance.')
+        value = obj.__dict__[self.field.attname]
+        if isinstance(value, EncodedList):
+            value = obj.__dict__[self.field.attname] = \
+                self.field.to_python(value.raw)
+        return value
+
+    def __set__(self, obj, value):
+        if isinstance(value, basestring) and value:
+            value = EncodedList(value)
+        elif not isinstance(value, EncodedList):
+            value = self.field.to_python(value)
+        obj.__dict__[self.field.attname] = value
+
+
 class ListField(models.TextField):
-    description = "A ListField is actually a TextField with comma-separated " \
+    description = "A ListField is actually a TextField with the encoded " \
                   "values. The value types can be string, integer and decimal."
     
-    __metaclass__ = models.SubfieldBase
-    
     def __init__(self, *args, **kwargs):
         kwargs['null'] = True
         kwargs['blank'] = True
@@ -76,33 +114,113 @@ class ListField(models.TextField):
 
 
         super(ListField, self).__init__(*args, **kwargs)
+
+    def contribute_to_class(self, cls, name):
+        super(ListField, self).contribute_to_class(cls, name)
+        setattr(cls, self.name, ListFieldDescriptor(self))
     
     def to_python(self, value):
         if isinstance(value, list) or isinstance(value, FIFOList):
             return value
 
+        if isinstance(value, EncodedList):
+            value = value.raw
+
         if value in ['', None]:
             return []
 
-        # Field returns a FIFOList (which is a deque) when size is limited
-        # FIFOList tweaks performance at push-fronts and pop-backs
-        if self.max_size:
-            lst = FIFOList(self.max_size)
-        else: # Otherwise, returns a default Python list
-            lst = []
-
-        valueio = StringIO.StringIO(value)
+        values = decode_list(value, self.py_converter)
 
-        for v in csv.reader(valueio, delimiter=','):
-            lst.append(self.py_converter(v[0]))
+        # Field returns a default Python list, unless size is limited
+        if not self.max_size:
+            return values
 
+        # Then it returns a FIFOList (which is a deque)
+        # FIFOList tweaks performance at push-fronts and pop-backs
+        lst = FIFOList(self.max_size)
+        for v in values:
+            lst.append(v)
         return lst
 
+    def pre_save(self, model_instance, add):
+        # Fields that weren't read are saved as they were loaded
+        value = model_instance.__dict__.get(self.attname)
+        if isinstance(value, EncodedList):
+            return value
+        return super(ListField, self).pre_save(model_instance, add)
+
     def get_prep_value(self, value):
-        valueio = cStringIO.StringIO()
-        writer = csv.writer(valueio, delimiter=',')
-        [writer.writerow([self.db_converter(v)]) for v in value]
-        return valueio.getvalue()
+        if isinstance(value, EncodedList):
+            return value.raw
+        return encode_list(value, self.py_converter, self.db_converter)
+
+
+class WideListField(object):
+    """An append-only list kept in a Cassandra wide row, with one column per
+    element, instead of a column of the model. Appending is a single column
+    insert and the elements are read a page at a time. See dbextra.widerow.
+
+    The object must be saved before its list is used, and the list is
+    deleted along with it. Set indexed to test membership without going
+    through the whole list.
+    """
+
+    def __init__(self, py_type=str, db_type=str, page_size=100, indexed=False):
+        self.py_converter = py_type
+        self.db_converter = db_type
+        self.page_size = page_size
+        self.indexed = indexed
+        self._row = None
+
+    def contribute_to_class(self, cls, name):
+        self.name = name
+        self.model = cls
+        setattr(cls, name, self)
+        signals.post_delete.connect(self._delete_list, sender=cls)
+        _wide_list_fields.append(self)
+
+    @property
+    def row(self):
+        if self._row is None:
+            from dbextra.widerow import WideRow
+            self._row = WideRow("%s_%s" % (self.model._meta.db_table, self.name),
+                                router.db_for_write(self.model))
+        return self._row
+
+    def get_list(self, pk):
+        """Returns the list of the object with the given pk, without
+        loading the object.
+        """
+        from dbextra.widerow import WideList
+        return WideList(self.row, pk, self.py_converter, self.db_converter,
+                        self.page_size, self.indexed)
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return self.get_list(instance.pk)
+
+    def __set__(self, instance, value):
+        raise AttributeError("%s can only be appended to" % self.name)
+
+    def _delete_list(self, sender, instance, **kwargs):
+        self.row.delete(instance.pk)
+        if self.indexed:
+            from dbextra.widerow import index_key
+            self.row.delete(index_key(instance.pk))
+
+
+_wide_list_fields = []
+
+def create_wide_lists(sender, created_models, db=DEFAULT_DB_ALIAS, **kwargs):
+    """Creates the column families of the wide lists of the models created
+    by syncdb, so that they aren't created while serving requests.
+    """
+    for field in _wide_list_fields:
+        if field.model in created_models and field.row.using == db:
+            field.row.create_column_family()
+
+signals.post_syncdb.connect(create_wide_lists)
 
 
 class CassandraKeyField(models.CharField):
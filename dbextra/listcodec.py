@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##
+## Author: Adriano Monteiro Marques <adriano@umitproject.org>
+##
+## Copyright (C) 2011 S2S Network Consultoria e Tecnologia da Informacao LTDA
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU Affero General Public License as
+## published by the Free Software Foundation, either version 3 of the
+## License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Affero General Public License for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""Encoding of the ListField values.
+
+Encoded lists start with VERSION_MARKER followed by a format character:
+
+  FORMAT_INT      64 bits big-endian integers, base64 encoded
+  FORMAT_DECIMAL  a scale byte, then the decimals times 10**scale packed
+                  as FORMAT_INT
+  FORMAT_STRING   the values joined by newlines, with backslashes and
+                  newlines escaped by a backslash
+
+Numeric payloads are base64 encoded, so the lists can still be kept in text
+columns. Lists that don't fit their numeric format fall back to
+FORMAT_STRING. Values without the marker are read as the comma-separated
+rows written by the older versions of the field.
+"""
+
+import re
+import csv
+import struct
+import base64
+import decimal
+import cStringIO, StringIO
+
+
+VERSION_MARKER = '\x01'
+
+FORMAT_INT = 'I'
+FORMAT_DECIMAL = 'D'
+FORMAT_STRING = 'S'
+
+INT_MIN = -2**63
+INT_MAX = 2**63 - 1
+
+_escape_re = re.compile(r'\\(.)')
+
+
+def _unescape_char(match):
+    char = match.group(1)
+    if char == 'n':
+        return '\n'
+    return char
+
+
+def _pack_ints(values):
+    return base64.b64encode(struct.pack('>%dq' % len(values), *values))
+
+
+def _unpack_ints(data):
+    data = base64.b64decode(data)
+    return struct.unpack('>%dq' % (len(data) // 8), data)
+
+
+def encode_csv(values, db_converter=str):
+    """Encodes values the way the older versions of ListField did.
+    """
+    valueio = cStringIO.StringIO()
+    writer = csv.writer(valueio, delimiter=',')
+    [writer.writerow([db_converter(v)]) for v in values]
+    return valueio.getvalue()
+
+
+def decode_csv(value, py_converter=str):
+    # Values without quotes are plain CRLF terminated rows
+    if '"' not in value:
+        return [py_converter(v) for v in value.split('\r\n')[:-1]]
+
+    valueio = StringIO.StringIO(value)
+    return [py_converter(v[0]) for v in csv.reader(valueio, delimiter=',')]
+
+
+def encode_ints(values):
+    values = [int(v) for v in values]
+    if values and (min(values) < INT_MIN or max(values) > INT_MAX):
+        return None
+    return VERSION_MARKER + FORMAT_INT + _pack_ints(values)
+
+
+def encode_decimals(values):
+    """Encodes the decimals as integers at the smallest scale that keeps
+    all of them exact. The decoded values have that same scale.
+    """
+    # Exponents, NaN and Infinity fail the int() below
+    parts = [str(v).partition('.') for v in values]
+    scale = max([len(fraction.rstrip('0')) for _, _, fraction in parts])
+    if scale > 255:
+        return None
+
+    zeros = '0' * scale
+    ints = [int(integer + (fraction + zeros)[:scale])
+            for integer, _, fraction in parts]
+    if ints and (min(ints) < INT_MIN or max(ints) > INT_MAX):
+        return None
+    return VERSION_MARKER + FORMAT_DECIMAL + chr(scale) + _pack_ints(ints)
+
+
+def encode_strings(values, db_converter=str):
+    # Converters may return other types, which are stored as their str()
+    values = [str(db_converter(v)) for v in values]
+    joined = '\n'.join(values)
+    if '\\' in joined or joined.count('\n') != len(values) - 1:
+        joined = '\n'.join([v.replace('\\', '\\\\').replace('\n', '\\n')
+                            for v in values])
+    return VERSION_MARKER + FORMAT_STRING + joined
+
+
+def encode_list(values, py_converter=str, db_converter=str):
+    """Encodes values in the most compact format for py_converter.
+    """
+    if not values:
+        return ''
+
+    if db_converter is str:
+        try:
+            if py_converter in (int, long):
+                encoded = encode_ints(values)
+            elif py_converter is decimal.Decimal:
+                encoded = encode_decimals(values)
+            else:
+                encoded = None
+        except (ValueError, TypeError):
+            encoded = None
+        if encoded is not None:
+            return encoded
+
+    return encode_strings(values, db_converter)
+
+
+def decode_list(value, py_converter=str):
+    """Decodes a list encoded by encode_list, or by the older versions of
+    ListField.
+    """
+    if not value:
+        return []
+
+    if value[0] != VERSION_MARKER:
+        return decode_csv(value, py_converter)
+
+    format = value[1]
+    if format == FORMAT_STRING:
+        data = value[2:]
+        values = data.split('\n')
+        if '\\' in data:
+            values = [_escape_re.sub(_unescape_char, v) for v in values]
+        return [py_converter(v) for v in values]
+
+    if format == FORMAT_INT:
+        values = _unpack_ints(value[2:])
+        if py_converter in (int, long):
+            return list(values)
+        return [py_converter(v) for v in values]
+
+    if format == FORMAT_DECIMAL:
+        scale = ord(value[2])
+        values = ['%de-%d' % (v, scale) for v in _unpack_ints(value[3:])]
+        return [py_converter(v) for v in values]
+
+    raise ValueError("Unknown list format %r" % format)
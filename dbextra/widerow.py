@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##
+## Author: Adriano Monteiro Marques <adriano@umitproject.org>
+##
+## Copyright (C) 2011 S2S Network Consultoria e Tecnologia da Informacao LTDA
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU Affero General Public License as
+## published by the Free Software Foundation, either version 3 of the
+## License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Affero General Public License for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""Append-only lists stored in Cassandra wide rows.
+
+Each list is a row of its own column family, keyed by the id of the object
+that owns it, with one column per element. Column names start with the time
+the element was added, so the columns are kept in insertion order and
+appending an element is a single column insert, whatever the list size.
+
+Indexed lists also keep a row named by index_key(key), with a column named
+by each element, so membership is a single column read instead of a scan.
+"""
+
+import struct
+import threading
+from uuid import uuid4
+
+from django.db import connections
+
+from pycassa.cassandra import Cassandra
+from pycassa.cassandra.ttypes import *
+
+from django_cassandra.db.utils import call_cassandra_with_reconnect, \
+    get_next_timestamp
+
+
+def index_key(key):
+    return "%s:index" % key
+
+
+def column_name():
+    """Returns a new column name, ordered by the time it was created. The
+    random suffix keeps names from different processes apart.
+    """
+    return struct.pack('>Q', get_next_timestamp()) + uuid4().bytes[:8]
+
+
+class WideRow(object):
+    """Column family holding one list per row.
+    """
+
+    def __init__(self, column_family, using):
+        self.column_family = column_family
+        self.using = using
+        self._created = False
+        self._create_lock = threading.Lock()
+
+    @property
+    def connection(self):
+        return connections[self.using]
+
+    def _call(self, fn, *args):
+        self.create_column_family()
+        return call_cassandra_with_reconnect(self.connection.db_connection,
+                                             fn, *args)
+
+    def create_column_family(self):
+        """Creates the column family, unless it already exists. syncdb
+        creates them, this covers the lists added since.
+        """
+        if self._created:
+            return
+
+        with self._create_lock:
+            if self._created:
+                return
+            connection = self.connection
+            if self.column_family not in \
+               connection.introspection.get_table_list(None):
+                cf_def = CfDef(keyspace=connection.settings_dict['NAME'],
+                               name=self.column_family,
+                               comparator_type='BytesType')
+                client = connection.db_connection.get_client()
+                try:
+                    client.system_add_column_family(cf_def)
+                except InvalidRequestException:
+                    # Created by another process in the meantime
+                    if self.column_family not in \
+                       connection.introspection.get_table_list(None):
+                        raise
+            self._created = True
+
+    def append(self, key, value, indexed=False):
+        self.extend(key, [value], indexed)
+
+    def extend(self, key, values, indexed=False):
+        """Appends the values to the row of key and, if indexed is set, adds
+        them to its index row, with a single batch_mutate call.
+        """
+        if not values:
+            return
+
+        timestamp = get_next_timestamp()
+        def mutation(name, value):
+            return Mutation(column_or_supercolumn=ColumnOrSuperColumn(
+                        column=Column(name=name, value=value,
+                                      timestamp=timestamp)))
+
+        mutation_map = {key: {self.column_family:
+            [mutation(column_name(), value) for value in values]}}
+        if indexed:
+            mutation_map[index_key(key)] = {self.column_family:
+                [mutation(value, '') for value in values]}
+        self._call(Cassandra.Client.batch_mutate, mutation_map,
+                   self.connection.write_consistency_level)
+
+    def has_column(self, key, name):
+        predicate = SlicePredicate(column_names=[name])
+        columns = self._call(Cassandra.Client.get_slice, key,
+                             ColumnParent(column_family=self.column_family),
+                             predicate, self.connection.read_consistency_level)
+        return bool(columns)
+
+    def get_slice(self, key, start='', count=100, reverse=False):
+        """Returns up to count (column name, value) pairs, from the column
+        named start on, or from the first (or the last, when reverse is set)
+        column if start is empty.
+        """
+        predicate = SlicePredicate(slice_range=SliceRange(start=start,
+                        finish='', reversed=reverse, count=count))
+        columns = self._call(Cassandra.Client.get_slice, key,
+                             ColumnParent(column_family=self.column_family),
+                             predicate, self.connection.read_consistency_level)
+        return [(c.column.name, c.column.value) for c in columns]
+
+    def count(self, key):
+        predicate = SlicePredicate(slice_range=SliceRange(start='', finish='',
+                        count=self.connection.max_column_count))
+        return self._call(Cassandra.Client.get_count, key,
+                          ColumnParent(column_family=self.column_family),
+                          predicate, self.connection.read_consistency_level)
+
+    def delete(self, key):
+        self._call(Cassandra.Client.remove, key,
+                   ColumnPath(column_family=self.column_family),
+                   get_next_timestamp(), self.connection.write_consistency_level)
+
+
+class WideList(object):
+    """The list of a single object. Elements can only be appended, and are
+    read a page at a time.
+    """
+
+    def __init__(self, row, key, py_converter, db_converter, page_size,
+                 indexed=False):
+        if key is None:
+            raise ValueError("The object must be saved before using its lists")
+        self.row = row
+        self.key = key
+        self.py_converter = py_converter
+        self.db_converter = db_converter
+        self.page_size = page_size
+        self.indexed = indexed
+
+    def append(self, value):
+        self.row.append(self.key, self.db_converter(value), self.indexed)
+
+    def extend(self, values):
+        self.row.extend(self.key, [self.db_converter(v) for v in values],
+                        self.indexed)
+
+    def slice(self, count, start=None, reverse=False):
+        """Returns up to count elements, after start, and the value of start
+        for the next page, which is None after the last page.
+        """
+        # The start column is included in the slice, so fetch one more
+        columns = self.row.get_slice(self.key, start or '',
+                                     count + (1 if start else 0), reverse)
+        if start and columns and columns[0][0] == start:
+            columns = columns[1:]
+        columns = columns[:count]
+
+        next_start = columns[-1][0] if len(columns) == count else None
+        return [self.py_converter(value) for name, value in columns], next_start
+
+    def latest(self, count):
+        """Returns the count elements added last, newest first.
+        """
+        return self.slice(count, reverse=True)[0]
+
+    def __iter__(self):
+        start = None
+        while True:
+            values, start = self.slice(self.page_size, start)
+            for value in values:
+                yield value
+            if start is None:
+                break
+
+    def __len__(self):
+        return self.row.count(self.key)
+
+    def __contains__(self, value):
+        if self.indexed:
+            return self.row.has_column(index_key(self.key),
+                                       self.db_converter(value))
+        for v in self:
+            if v == value:
+                return True
+        return False
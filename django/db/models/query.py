@@ -498,6 +498,17 @@ class QuerySet(object):
             return self.query.has_results(using=self.db)
         return bool(self._result_cache)
 
+    def explain(self):
+        """
+        Returns a description of how the database backend would run this
+        query, for the backends that support it.
+        """
+        compiler = self.query.get_compiler(self.db)
+        if not hasattr(compiler, 'explain'):
+            raise NotImplementedError("The %s backend doesn't support explain()"
+                                      % self.db)
+        return compiler.explain()
+
     ##################################################
     # PUBLIC METHODS THAT RETURN A QUERYSET SUBCLASS #
     ##################################################
@@ -23,7 +23,7 @@ import re
 import time
 from .creation import DatabaseCreation
 from .introspection import DatabaseIntrospection
-from .utils import CassandraConnection, CassandraConnectionError, CassandraAccessError
+from .utils import get_connection_pool, CassandraConnectionError, CassandraAccessError, parse_hosts
 from thrift.transport import TTransport
 from pycassa.cassandra.ttypes import *
 
@@ -78,6 +78,11 @@ class DatabaseWrapper(NonrelDatabaseWrapper):
         self.write_consistency_level = self.settings_dict.get('CASSANDRA_WRITE_CONSISTENCY_LEVEL', ConsistencyLevel.ONE)
         self.max_key_count = self.settings_dict.get('CASSANDRA_MAX_KEY_COUNT', 1000000)
         self.max_column_count = self.settings_dict.get('CASSANDRA_MAX_COLUMN_COUNT', 10000)
+        self.page_size = self.settings_dict.get('CASSANDRA_PAGE_SIZE', 1000)
+        self.mutation_batch_size = self.settings_dict.get('CASSANDRA_MUTATION_BATCH_SIZE', 100)
+        self.indexed_range_queries = self.settings_dict.get('CASSANDRA_INDEXED_RANGE_QUERIES', True)
+        self.full_scan_policy = self.settings_dict.get('CASSANDRA_FULL_SCANS', 'allow')
+        self.supports_indexed_range_expressions = False
         self.column_family_def_defaults = self.settings_dict.get('CASSANDRA_COLUMN_FAMILY_DEF_DEFAULT_SETTINGS', {})
 
         self._db_connection = None
@@ -105,6 +110,10 @@ class DatabaseWrapper(NonrelDatabaseWrapper):
             
             # Determine supported features based on the API version
             self.supports_replication_factor_as_strategy_option = major_version >= 19 and minor_version >= 10
+            
+            # Range expressions in index clauses are accepted since 0.7.0
+            self.supports_indexed_range_expressions = self.indexed_range_queries and \
+                (major_version, minor_version) >= (19, 4)
         
         if login:
             self._db_connection.login()
@@ -158,15 +167,12 @@ class DatabaseWrapper(NonrelDatabaseWrapper):
     
     def get_db_connection(self, set_keyspace=False, login=False):
         if not self._db_connection:
-            # Get the host and port specified in the database backend settings.
+            # Get the hosts and port specified in the database backend settings.
             # Default to the standard Cassandra settings.
-            host = self.settings_dict.get('HOST')
-            if not host or host == '':
-                host = 'localhost'
-                
             port = self.settings_dict.get('PORT')
             if not port or port == '':
                 port = 9160
+            hosts = parse_hosts(self.settings_dict.get('HOST'), port)
                 
             keyspace = self.settings_dict.get('NAME')
             if keyspace == None:
@@ -175,8 +181,16 @@ class DatabaseWrapper(NonrelDatabaseWrapper):
             user = self.settings_dict.get('USER')
             password = self.settings_dict.get('PASSWORD')
             
-            # Create our connection wrapper
-            self._db_connection = CassandraConnection(host, port, keyspace, user, password)
+            # Get the connection pool shared by the threads. Every thread uses
+            # its own connection, which goes back to the pool when the
+            # connection is closed, at the end of every request.
+            self._db_connection = get_connection_pool(self.alias,
+                hosts, keyspace, user, password,
+                pool_size=self.settings_dict.get('CASSANDRA_POOL_SIZE', 5),
+                pool_timeout=self.settings_dict.get('CASSANDRA_POOL_TIMEOUT', 30),
+                max_idle_time=self.settings_dict.get('CASSANDRA_POOL_MAX_IDLE_TIME', 300),
+                health_check_interval=self.settings_dict.get('CASSANDRA_POOL_HEALTH_CHECK_INTERVAL', 30),
+                retry_interval=self.settings_dict.get('CASSANDRA_POOL_RETRY_INTERVAL', 10))
             
         try:
             self.configure_connection(set_keyspace, login)
@@ -187,6 +201,10 @@ class DatabaseWrapper(NonrelDatabaseWrapper):
         
         return self._db_connection
     
+    def close(self):
+        if self._db_connection:
+            self._db_connection.release()
+    
     @property
     def db_connection(self):
         return self.get_db_connection(True, True)
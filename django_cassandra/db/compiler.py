@@ -17,6 +17,8 @@ import sys
 import traceback
 import datetime
 import decimal
+import heapq
+import itertools
 
 from django.db.models import ForeignKey
 from django.db.models.sql.where import AND, OR, WhereNode
@@ -32,6 +34,7 @@ from .utils import *
 from .predicate import *
 
 from uuid import uuid4
+import logging
 from pycassa.cassandra import Cassandra
 from pycassa.cassandra.ttypes import *
 from thrift.transport.TTransport import TTransportException
@@ -45,6 +48,14 @@ def safe_call(func):
             raise DatabaseError, DatabaseError(*tuple(e)), sys.exc_info()[2]
     return _func
 
+# What to do when a filtered query needs to scan the whole column family
+FULL_SCAN_ALLOW = 'allow'
+FULL_SCAN_WARN = 'warn'
+FULL_SCAN_RAISE = 'raise'
+
+# Column families and filtered columns already warned about
+_warned_full_scans = set()
+
 class CassandraQuery(NonrelQuery):
     
     # FIXME: How do we set this value? What's the maximum value it can be?
@@ -59,10 +70,14 @@ class CassandraQuery(NonrelQuery):
         self.root_predicate = None
         self.ordering_spec = None
         self.cached_results = None
+        self.fetch_limit = None
+        self.column_names = None
         
+        # Use all the model fields, not only the fetched ones, so that queries
+        # that only fetch the keys can still use the secondary indexes
         self.indexed_columns = []
         self.field_name_to_column_name = {}
-        for field in fields:
+        for field in self.query.get_meta().fields:
             column_name = field.db_column if field.db_column else field.column
             if field.db_index:
                 self.indexed_columns.append(column_name)
@@ -74,12 +89,49 @@ class CassandraQuery(NonrelQuery):
         return '<CassandraQuery: ...>'
 
     def _convert_key_slice_to_rows(self, key_slice):
-        rows = []
         for element in key_slice:
             if element.columns:
-                row = self._convert_column_list_to_row(element.columns, self.pk_column, element.key)
-                rows.append(row)
-        return rows
+                yield self._convert_column_list_to_row(element.columns, self.pk_column, element.key)
+    
+    def _get_slice_predicate(self, column_names=None):
+        # When column_names is set only those columns are fetched, e.g. to
+        # count the rows without transferring all of their data.
+        if column_names is not None:
+            return SlicePredicate(column_names=column_names)
+        return SlicePredicate(slice_range=SliceRange(start='', finish='',
+            count=self.connection.max_column_count))
+    
+    def _iter_key_slices(self, fetch_page, start_key='', limit=None):
+        """
+        Yields the KeySlices returned by fetch_page(start_key, count), one page
+        at a time. The first page has at most limit rows, the ones the caller
+        expects to need, and the next ones page_size rows. Each page starts
+        at the last key of the previous one, so that row is skipped. Stops
+        after max_key_count rows, like the unpaged calls did.
+        """
+        page_size = max(self.connection.page_size, 1)
+        if limit is not None:
+            first_page_size = max(min(page_size, limit), 1)
+        else:
+            first_page_size = page_size
+        
+        remaining = self.connection.max_key_count
+        last_key = None
+        while remaining > 0:
+            if last_key is None:
+                count = min(first_page_size, remaining)
+            else:
+                count = min(page_size, remaining) + 1
+            key_slice = fetch_page(start_key, count)
+            page = key_slice
+            if last_key is not None and page and page[0].key == last_key:
+                page = page[1:]
+            for element in page[:remaining]:
+                yield element
+            remaining -= len(page)
+            if len(key_slice) < count or not page:
+                break
+            last_key = start_key = key_slice[-1].key
     
     def _convert_column_list_to_row(self, column_list, pk_column_name, pk_value):
         row = {}
@@ -95,18 +147,15 @@ class CassandraQuery(NonrelQuery):
 
         db_connection = self.connection.db_connection
         column_parent = ColumnParent(column_family=self.column_family)
-        slice_predicate = SlicePredicate(slice_range=SliceRange(start='',
-            finish='', count=self.connection.max_column_count))
+        slice_predicate = self._get_slice_predicate(self.column_names)
         
         if range_predicate._is_exact():
             column_list = call_cassandra_with_reconnect(db_connection,
                Cassandra.Client.get_slice, range_predicate.start,
                 column_parent, slice_predicate, self.connection.read_consistency_level)
             if column_list:
-                row = self._convert_column_list_to_row(column_list, self.pk_column, range_predicate.start)
-                rows = [row]
-            else:
-                rows = []
+                return iter([self._convert_column_list_to_row(column_list, self.pk_column, range_predicate.start)])
+            return iter([])
         else:
             if range_predicate.start != None:
                 key_start = range_predicate.start
@@ -122,90 +171,191 @@ class CassandraQuery(NonrelQuery):
             else:
                 key_end = ''
             
-            key_range = KeyRange(start_key=key_start, end_key=key_end,
-                count=self.connection.max_key_count)
-            key_slice = call_cassandra_with_reconnect(db_connection,
-                Cassandra.Client.get_range_slices, column_parent,
-                slice_predicate, key_range, self.connection.read_consistency_level)
+            def fetch_page(start_key, count):
+                key_range = KeyRange(start_key=start_key, end_key=key_end, count=count)
+                return call_cassandra_with_reconnect(db_connection,
+                    Cassandra.Client.get_range_slices, column_parent,
+                    slice_predicate, key_range, self.connection.read_consistency_level)
             
-            rows = self._convert_key_slice_to_rows(key_slice)
-                
-        return rows
+            return self._convert_key_slice_to_rows(
+                self._iter_key_slices(fetch_page, key_start, self.fetch_limit))
     
-    def _get_rows_by_indexed_column(self, range_predicate):
-        # Construct the index expression for the range predicate
+    def get_rows_by_keys(self, keys):
+        """
+        Yields the rows with the given keys, in that order, fetching up to
+        page_size of them with each multiget call.
+        """
+        column_parent = ColumnParent(column_family=self.column_family)
+        slice_predicate = self._get_slice_predicate(self.column_names)
+        
+        seen = set()
+        keys = [key for key in keys if not (key in seen or seen.add(key))]
+        return self._iter_rows_by_keys(keys, column_parent, slice_predicate)
+    
+    def _iter_rows_by_keys(self, keys, column_parent, slice_predicate):
+        db_connection = self.connection.db_connection
+        page_size = max(self.connection.page_size, 1)
+        for i in range(0, len(keys), page_size):
+            page = keys[i:i + page_size]
+            column_lists = call_cassandra_with_reconnect(db_connection,
+                Cassandra.Client.multiget_slice, page, column_parent,
+                slice_predicate, self.connection.read_consistency_level)
+            for key in page:
+                column_list = column_lists.get(key)
+                if column_list:
+                    yield self._convert_column_list_to_row(column_list, self.pk_column, key)
+    
+    def _get_index_expressions(self, range_predicate):
         index_expressions = []
-        if ((range_predicate.start != None) and
-            (range_predicate.end == range_predicate.start) and
-            range_predicate.start_inclusive and
-            range_predicate.end_inclusive):
+        if range_predicate._is_exact():
             index_expression = IndexExpression(range_predicate.column, IndexOperator.EQ, unicode(range_predicate.start))
             index_expressions.append(index_expression)
         else:
-            # NOTE: These range queries don't work with the current version of cassandra
-            # that I'm using (0.7 beta3)
-            # It looks like there are cassandra tickets to add support for this, but it's
-            # unclear how soon it will be supported. We shouldn't hit this code for now,
-            # though, because can_evaluate_efficiently was changed to disable range queries
-            # on indexed columns (they still can be performed, just inefficiently).
-            if range_predicate.start:
+            # NOTE: Cassandra only accepts these along with an EQ expression
+            # on an indexed column, and versions before 0.7.0 didn't accept
+            # them at all. The planner checks that before adding them.
+            if range_predicate.start != None:
                 index_op = IndexOperator.GTE if range_predicate.start_inclusive else IndexOperator.GT
                 index_expression = IndexExpression(unicode(range_predicate.column), index_op, unicode(range_predicate.start))
                 index_expressions.append(index_expression)
-            if range_predicate.end:
+            if range_predicate.end != None:
                 index_op = IndexOperator.LTE if range_predicate.end_inclusive else IndexOperator.LT
                 index_expression = IndexExpression(unicode(range_predicate.column), index_op, unicode(range_predicate.end))
                 index_expressions.append(index_expression)
+        return index_expressions
+    
+    def _get_rows_by_indexed_column(self, range_predicate, index_predicates=()):
+        # Construct the index expressions for the range predicate and the
+        # other predicates the planner pushed into the index scan
+        index_expressions = self._get_index_expressions(range_predicate)
+        for predicate in index_predicates:
+            index_expressions.extend(self._get_index_expressions(predicate))
                 
         assert(len(index_expressions) > 0)
                
         # Now make the call to cassandra to get the key slice
         db_connection = self.connection.db_connection
         column_parent = ColumnParent(column_family=self.column_family)
-        index_clause = IndexClause(index_expressions, '', self.connection.max_key_count)
-        slice_predicate = SlicePredicate(slice_range=SliceRange(start='', finish='', count=self.connection.max_column_count))
+        slice_predicate = self._get_slice_predicate(self.column_names)
         
-        key_slice = call_cassandra_with_reconnect(db_connection,
-            Cassandra.Client.get_indexed_slices,
-            column_parent, index_clause, slice_predicate,
-            self.connection.read_consistency_level)
-        rows = self._convert_key_slice_to_rows(key_slice)
+        def fetch_page(start_key, count):
+            index_clause = IndexClause(index_expressions, start_key, count)
+            return call_cassandra_with_reconnect(db_connection,
+                Cassandra.Client.get_indexed_slices,
+                column_parent, index_clause, slice_predicate,
+                self.connection.read_consistency_level)
         
-        return rows
+        return self._convert_key_slice_to_rows(
+            self._iter_key_slices(fetch_page, '', self.fetch_limit))
     
-    def get_row_range(self, range_predicate):
+    def get_row_range(self, range_predicate, index_predicates=()):
         pk_column = self.query.get_meta().pk.column
         if range_predicate.column == pk_column:
             rows = self._get_rows_by_pk(range_predicate)
         else:
             assert(range_predicate.column in self.indexed_columns)
-            rows = self._get_rows_by_indexed_column(range_predicate)
+            rows = self._get_rows_by_indexed_column(range_predicate, index_predicates)
         return rows
     
+    def supports_indexed_ranges(self):
+        # The server version is determined when the connection is configured
+        self.connection.db_connection
+        return self.connection.supports_indexed_range_expressions
+    
+    def _check_full_scan(self):
+        policy = self.connection.full_scan_policy
+        if policy == FULL_SCAN_ALLOW:
+            return
+        message = 'Full scan of %s for %s' % (self.column_family, self.root_predicate)
+        if policy == FULL_SCAN_RAISE:
+            raise DatabaseError(message)
+        # The same query usually runs over and over, once is enough
+        shape = (self.column_family,
+                 tuple(sorted(set(self.root_predicate.get_columns()))))
+        if shape not in _warned_full_scans:
+            _warned_full_scans.add(shape)
+            logging.warning(message)
+    
     def get_all_rows(self):
+        # Queries with no filters are meant to go through all the rows, but
+        # filters that need a full scan are usually missing an index
+        if self.root_predicate != None and self.root_predicate.children:
+            self._check_full_scan()
+        
         # TODO: Could factor this code better
         db_connection = self.connection.db_connection
         column_parent = ColumnParent(column_family=self.column_family)
-        slice_predicate = SlicePredicate(slice_range=SliceRange(start='', finish='', count=self.connection.max_column_count))
-        key_range = KeyRange(start_token = '0', end_token = '0', count=self.connection.max_key_count)
+        slice_predicate = self._get_slice_predicate(self.column_names)
         #end_key = u'\U0010ffff'.encode('utf-8')
         #key_range = KeyRange(start_key='\x01', end_key=end_key, count=self.connection.max_key_count)
         
-        key_slice = call_cassandra_with_reconnect(db_connection,
-            Cassandra.Client.get_range_slices, column_parent,
-            slice_predicate, key_range, self.connection.read_consistency_level)
-        rows = self._convert_key_slice_to_rows(key_slice)
+        # Empty start and end keys cover the whole ring, and unlike tokens
+        # they let us continue from the last key of each page.
+        def fetch_page(start_key, count):
+            key_range = KeyRange(start_key=start_key, end_key='', count=count)
+            return call_cassandra_with_reconnect(db_connection,
+                Cassandra.Client.get_range_slices, column_parent,
+                slice_predicate, key_range, self.connection.read_consistency_level)
         
-        return rows
+        return self._convert_key_slice_to_rows(
+            self._iter_key_slices(fetch_page, '', self.fetch_limit))
     
     def _get_query_results(self):
         if self.cached_results == None:
             assert(self.root_predicate != None)
-            self.cached_results = self.root_predicate.get_matching_rows(self)
+            self.fetch_limit = None
+            self.cached_results = list(self.root_predicate.get_matching_rows(self))
             if self.ordering_spec:
                 sort_rows(self.cached_results, self.ordering_spec)
         return self.cached_results
     
+    def explain(self, low_mark=0, high_mark=None):
+        """
+        Returns a description of how the query is run, without running it.
+        """
+        if self.root_predicate == None:
+            raise DatabaseError('No root query node')
+        
+        lines = ['COLUMN FAMILY %s' % self.column_family]
+        if self.root_predicate.children:
+            lines.extend(self.root_predicate.explain(self))
+        else:
+            lines.append('FULL SCAN')
+        if self.ordering_spec:
+            ordering = ', '.join(['%s%s' % (column, ' DESC' if reverse else '')
+                                  for column, reverse in self.ordering_spec])
+            if high_mark is None:
+                lines.append('SORT BY %s' % ordering)
+            else:
+                lines.append('TOP %s BY %s' % (high_mark, ordering))
+        if low_mark or high_mark is not None:
+            lines.append('SLICE [%s:%s]' % (low_mark or '', '' if high_mark is None else high_mark))
+        return '\n'.join(lines)
+    
+    def _iter_query_results(self, low_mark, high_mark):
+        """
+        Yields the rows between low_mark and high_mark, fetching the rows from
+        Cassandra one page at a time. Without ordering, paging stops as soon as
+        high_mark rows matched. With ordering, only the top high_mark rows are
+        kept while going through the matching rows.
+        """
+        low_mark = low_mark or 0
+        
+        # The paging calls take the limit when get_matching_rows is called,
+        # before any row is fetched
+        self.fetch_limit = None
+        if self.ordering_spec:
+            if high_mark is None:
+                results = self._get_query_results()
+            else:
+                rows = self.root_predicate.get_matching_rows(self)
+                results = heapq.nsmallest(high_mark, rows, key=row_sort_key(self.ordering_spec))
+            return iter(results[low_mark:high_mark])
+        
+        self.fetch_limit = high_mark
+        rows = self.root_predicate.get_matching_rows(self)
+        return itertools.islice(rows, low_mark, high_mark)
+    
     @safe_call
     def fetch(self, low_mark, high_mark):
         
@@ -216,9 +366,10 @@ class CassandraQuery(NonrelQuery):
             if high_mark is not None and high_mark <= low_mark:
                 return
             
-            results = self._get_query_results()
-            if low_mark is not None or high_mark is not None:
-                results = results[low_mark:high_mark]
+            if self.cached_results != None:
+                results = self.cached_results[low_mark:high_mark]
+            else:
+                results = self._iter_query_results(low_mark, high_mark)
         except Exception, e:
             # FIXME: Can get rid of this exception handling code eventually,
             # but it's useful for debugging for now.
@@ -230,24 +381,86 @@ class CassandraQuery(NonrelQuery):
 
     @safe_call
     def count(self, limit=None):
-        # TODO: This could be implemented more efficiently for simple predicates
-        # where we could call the count method in the Cassandra Thrift API.
-        # We can optimize for that later
-        results = self._get_query_results()
-        return len(results)
+        if self.root_predicate == None:
+            raise DatabaseError('No root query node')
+        
+        if self.cached_results != None:
+            return len(self.cached_results[:limit])
+        
+        # Only fetch the primary key, which every row has, and the columns
+        # the predicates need to check. The rows are counted as they're
+        # paged in and paging stops once limit rows matched.
+        column_names = set(self.root_predicate.get_columns())
+        column_names.add(self.pk_column)
+        self.column_names = list(column_names)
+        self.fetch_limit = limit
+        try:
+            rows = self.root_predicate.get_matching_rows(self)
+            if limit is not None:
+                rows = itertools.islice(rows, limit)
+            count = 0
+            for row in rows:
+                count += 1
+        finally:
+            self.column_names = None
+            self.fetch_limit = None
+        return count
+    
+    def iter_keys(self):
+        """
+        Yields the keys of the matching rows, fetching only the primary key
+        and the columns the predicates need to check.
+        """
+        if self.root_predicate == None:
+            raise DatabaseError('No root query node')
+        
+        column_names = set(self.root_predicate.get_columns())
+        column_names.add(self.pk_column)
+        self.column_names = list(column_names)
+        self.fetch_limit = None
+        try:
+            for row in self.root_predicate.get_matching_rows(self):
+                yield row[self.pk_column]
+        finally:
+            self.column_names = None
+    
+    def get_matching_keys(self):
+        """
+        Returns the keys of the matching rows, each of them once. All of them
+        are fetched before any row is changed, so the changes can't affect
+        the paging through the matching rows.
+        """
+        seen = set()
+        return [key for key in self.iter_keys()
+                if not (key in seen or seen.add(key))]
+    
+    def batch_mutate(self, keys, get_mutations):
+        """
+        Applies the mutations returned by get_mutations(key) to each key,
+        with batch_mutate calls of at most mutation_batch_size rows.
+        """
+        db_connection = self.connection.db_connection
+        mutation_map = {}
+        row_count = 0
+        for key in keys:
+            mutation_map[key] = {self.column_family: get_mutations(key)}
+            row_count += 1
+            if len(mutation_map) >= self.connection.mutation_batch_size:
+                call_cassandra_with_reconnect(db_connection,
+                    Cassandra.Client.batch_mutate, mutation_map,
+                    self.connection.write_consistency_level)
+                mutation_map = {}
+        if mutation_map:
+            call_cassandra_with_reconnect(db_connection,
+                Cassandra.Client.batch_mutate, mutation_map,
+                self.connection.write_consistency_level)
+        return row_count
     
     @safe_call
     def delete(self):
-        results = self._get_query_results()
         timestamp = get_next_timestamp()
-        column_family = self.query.get_meta().db_table
-        mutation_map = {}
-        for item in results:
-            mutation_map[item[self.pk_column]] = {column_family: [Mutation(deletion=Deletion(timestamp=timestamp))]}
-        db_connection = self.connection.db_connection
-        call_cassandra_with_reconnect(db_connection,
-            Cassandra.Client.batch_mutate, mutation_map,
-            self.connection.write_consistency_level)
+        mutations = [Mutation(deletion=Deletion(timestamp=timestamp))]
+        self.batch_mutate(self.get_matching_keys(), lambda key: mutations)
         
 
     @safe_call
@@ -315,6 +528,9 @@ class SQLCompiler(NonrelCompiler):
     query_class = CassandraQuery
 
     SPECIAL_NONE_VALUE = "\b"
+    
+    def explain(self):
+        return self.build_query().explain(self.query.low_mark, self.query.high_mark)
 
     # Override this method from NonrelCompiler to get around problem with
     # mixing the field default values with the field format as its stored
@@ -506,45 +722,48 @@ class SQLUpdateCompiler(NonrelUpdateCompiler, SQLCompiler):
         # TODO: Add compound key check here -- ensure that we're not updating
         # any of the fields that are components in the compound key.
         
-        # TODO: This isn't super efficient because executing the query will
-        # fetch all of the columns for each row even though all we really need
-        # is the key for the row. Should be pretty straightforward to change
-        # the CassandraQuery class to support custom slice predicates.
-        
-        #model = self.query.model
-        pk_column = self.query.get_meta().pk.column
-        
-        pk_index = -1
-        fields = self.get_fields()
-        for index in range(len(fields)):
-            if fields[index].column == pk_column:
-                pk_index = index;
-                break
-        if pk_index == -1:
-            raise DatabaseError('Invalid primary key column')
-        
-        row_count = 0
-        column_family = self.query.get_meta().db_table
         timestamp = get_next_timestamp()
-        batch_mutate_data = {}
-        for result in self.results_iter():
-            row_count += 1
-            mutation_list = []
-            key = result[pk_index]
-            for name, value in data.items():
-                # FIXME: Do we need this check here? Or is the name always already a str instead of unicode.
-                if type(name) is unicode:
-                    name = name.decode('utf-8')
-                mutation = Mutation(column_or_supercolumn=ColumnOrSuperColumn(column=Column(name=name, value=value, timestamp=timestamp)))
-                mutation_list.append(mutation)
-            batch_mutate_data[key] = {column_family: mutation_list}
-        
-        db_connection = self.connection.db_connection
-        call_cassandra_with_reconnect(db_connection,
-            Cassandra.Client.batch_mutate, batch_mutate_data,
-            self.connection.write_consistency_level)
+        mutation_list = []
+        for name, value in data.items():
+            # FIXME: Do we need this check here? Or is the name always already a str instead of unicode.
+            if type(name) is unicode:
+                name = name.decode('utf-8')
+            mutation = Mutation(column_or_supercolumn=ColumnOrSuperColumn(column=Column(name=name, value=value, timestamp=timestamp)))
+            mutation_list.append(mutation)
         
-        return row_count
+        # Only the keys of the matching rows are fetched
+        query = self.build_query([self.query.get_meta().pk])
+        return query.batch_mutate(query.get_matching_keys(), lambda key: mutation_list)
     
 class SQLDeleteCompiler(NonrelDeleteCompiler, SQLCompiler):
     pass
+
+def update_rows(model, rows, using=None):
+    """
+    Writes the changes in rows, a {key: {field name: value}} dictionary, to
+    the rows of model with those keys, with batch_mutate calls of at most
+    mutation_batch_size rows. Unlike QuerySet.update, the rows aren't looked
+    up first, so the caller must know they exist.
+    """
+    from django.db import router, connections
+    from django.db.models.sql import Query
+    
+    connection = connections[using or router.db_for_write(model)]
+    compiler = Query(model).get_compiler(connection=connection)
+    query = compiler.build_query([model._meta.pk])
+    timestamp = get_next_timestamp()
+    
+    def get_mutations(key):
+        mutation_list = []
+        for name, value in rows[key].items():
+            field = model._meta.get_field(name)
+            if not field.null and value is None:
+                raise DatabaseError("You can't set %s (a non-nullable "
+                                    "field) to None!" % field.name)
+            value = field.get_db_prep_save(value, connection=connection)
+            value = compiler.convert_value_for_db(field.db_type(connection=connection), value)
+            mutation = Mutation(column_or_supercolumn=ColumnOrSuperColumn(column=Column(name=field.column, value=value, timestamp=timestamp)))
+            mutation_list.append(mutation)
+        return mutation_list
+    
+    return query.batch_mutate(rows.keys(), get_mutations)
@@ -13,6 +13,7 @@
 #   limitations under the License.
 
 import re
+import itertools
 from .utils import combine_rows
 
 SECONDARY_INDEX_SUPPORT_ENABLED = True
@@ -33,6 +34,30 @@ class InvalidPredicateOpException(Exception):
 COMPOUND_OP_AND = 1
 COMPOUND_OP_OR = 2
 
+# Relative cost of evaluating the predicates that can be evaluated
+# efficiently, used to fetch the rows for the cheapest one first
+COST_PK_EXACT = 1
+COST_INDEXED_EXACT = 10
+COST_PK_RANGE = 100
+
+
+class QueryPlan(object):
+    """
+    How a compound predicate gets its rows: the rows of fetch_predicates
+    are fetched from Cassandra (all the rows if there are none) and checked
+    against filter_predicates. index_predicates are sent along with the
+    index expression of the single fetched predicate, if it's an index scan.
+    """
+    
+    def __init__(self, fetch_predicates, filter_predicates, index_predicates=None):
+        self.fetch_predicates = fetch_predicates
+        self.filter_predicates = filter_predicates
+        self.index_predicates = index_predicates or []
+    
+    @property
+    def full_scan(self):
+        return not self.fetch_predicates
+
 class RangePredicate(object):
     
     def __init__(self, column, start=None, start_inclusive=True, end=None, end_inclusive=True):
@@ -49,7 +74,7 @@ class RangePredicate(object):
             s += (unicode(self.start) + op)
         s += self.column
         if self.end:
-            op = '>=' if self.end_inclusive else '>'
+            op = '<=' if self.end_inclusive else '<'
             s += (op + unicode(self.end))
         s += ')'
         return s
@@ -58,12 +83,16 @@ class RangePredicate(object):
         return (self.start != None) and (self.start == self.end) and self.start_inclusive and self.end_inclusive
     
     def can_evaluate_efficiently(self, pk_column, indexed_columns):
-        # FIXME: There's some problem with secondary index support currently.
-        # I'm suspicious that this is a bug in Cassandra but I haven't really verified that yet.
-        # Anyway disabling the secondary index support for now.
+        # Cassandra needs an EQ expression to scan an index, so ranges on an
+        # indexed column are only sent along with one (see get_plan)
         return ((self.column == pk_column) or
                 (SECONDARY_INDEX_SUPPORT_ENABLED and ((self.column in indexed_columns) and self._is_exact())))
     
+    def get_cost(self, pk_column, indexed_columns):
+        if self.column == pk_column:
+            return COST_PK_EXACT if self._is_exact() else COST_PK_RANGE
+        return COST_INDEXED_EXACT
+    
     def incorporate_range_op(self, column, op, value, parent_compound_op):
         if column != self.column:
             return False
@@ -170,10 +199,43 @@ class RangePredicate(object):
         value = row.get(self.column, None)
         return self._matches_value(value)
     
-    def get_matching_rows(self, query):
-        rows = query.get_row_range(self)
+    def compile(self):
+        """
+        Returns a function that tells if a row matches the predicate, with
+        the bounds of the range bound to it.
+        """
+        column = self.column
+        start, start_inclusive = self.start, self.start_inclusive
+        end, end_inclusive = self.end, self.end_inclusive
+        
+        def matches(row):
+            value = row.get(column)
+            if value == None:
+                return False
+            if start != None:
+                if value < start or (value == start and not start_inclusive):
+                    return False
+            if end != None:
+                if value > end or (value == end and not end_inclusive):
+                    return False
+            return True
+        return matches
+    
+    def get_columns(self):
+        return [self.column]
+    
+    def get_matching_rows(self, query, index_predicates=()):
+        rows = query.get_row_range(self, index_predicates)
         return rows
     
+    def explain(self, query, index_predicates=()):
+        if self.column != query.pk_column:
+            return ['INDEX SCAN ' + ' AND '.join([repr(predicate)
+                    for predicate in [self] + list(index_predicates)])]
+        if self._is_exact():
+            return ['KEY LOOKUP ' + repr(self)]
+        return ['KEY RANGE ' + repr(self)]
+    
 class OperationPredicate(object):
     def __init__(self, column, op, value=None):
         self.column = column
@@ -182,46 +244,85 @@ class OperationPredicate(object):
         if op == 'regex' or op == 'iregex':
             flags = re.I if op == 'iregex' else 0
             self.pattern = re.compile(value, flags)
+        self.matches = self._compile_matches()
     
     def __repr__(self):
-        return '(OP: ' + self.op + ':' + unicode(self.value) + ')'
+        return '(OP: ' + self.column + ':' + self.op + ':' + unicode(self.value) + ')'
     
     def can_evaluate_efficiently(self, pk_column, indexed_columns):
-        return False
+        # A list of keys is fetched with multiget calls
+        return (self.column == pk_column) and (self.op == 'in') and (self.value != None)
+    
+    def get_cost(self, pk_column, indexed_columns):
+        return COST_PK_EXACT
 
-    def row_matches(self, row):
-        row_value = row.get(self.column, None)
-        if self.op == 'isnull':
-            return row_value == None
+    def _compile_matches(self):
+        # The operation is looked up and the value lowered once here, instead
+        # of for every row that gets checked.
+        column = self.column
+        op = self.op
+        value = self.value
+        
+        if op == 'isnull':
+            return lambda row: row.get(column) == None
         # FIXME: Not sure if the following test is correct in all cases
-        if (row_value == None) or (self.value == None):
-            return False
-        if self.op == 'in':
-            return row_value in self.value
-        if self.op == 'istartswith':
-            return row_value.lower().startswith(self.value.lower())
-        elif self.op == 'endswith':
-            return row_value.endswith(self.value)
-        elif self.op == 'iendswith':
-            return row_value.lower().endswith(self.value.lower())
-        elif self.op == 'iexact':
-            return row_value.lower() == self.value.lower()
-        elif self.op == 'contains':
-            return row_value.find(self.value) >= 0
-        elif self.op == 'icontains':
-            return row_value.lower().find(self.value.lower()) >= 0
-        elif self.op == 'regex' or self.op == 'iregex':
-            return self.pattern.match(row_value) != None
+        if value == None:
+            return lambda row: False
+        
+        if op == 'in':
+            test = lambda row_value: row_value in value
+        elif op == 'istartswith':
+            lower_value = value.lower()
+            test = lambda row_value: row_value.lower().startswith(lower_value)
+        elif op == 'endswith':
+            test = lambda row_value: row_value.endswith(value)
+        elif op == 'iendswith':
+            lower_value = value.lower()
+            test = lambda row_value: row_value.lower().endswith(lower_value)
+        elif op == 'iexact':
+            lower_value = value.lower()
+            test = lambda row_value: row_value.lower() == lower_value
+        elif op == 'contains':
+            test = lambda row_value: value in row_value
+        elif op == 'icontains':
+            lower_value = value.lower()
+            test = lambda row_value: lower_value in row_value.lower()
+        elif op == 'regex' or op == 'iregex':
+            match = self.pattern.match
+            test = lambda row_value: match(row_value) != None
         else:
-            raise InvalidPredicateOpException()
+            def test(row_value):
+                raise InvalidPredicateOpException()
+        
+        def matches(row):
+            row_value = row.get(column)
+            if row_value == None:
+                return False
+            return test(row_value)
+        return matches
+    
+    def row_matches(self, row):
+        return self.matches(row)
+    
+    def compile(self):
+        return self.matches
     
     def incorporate_range_op(self, column, op, value, parent_compound_op):
         return False
     
-    def get_matching_rows(self, query):
+    def get_columns(self):
+        return [self.column]
+    
+    def get_matching_rows(self, query, index_predicates=()):
         # get_matching_rows should only be called for predicates that can
-        # be evaluated efficiently, which is not the case for OperationPredicate's
-        raise NotImplementedError('get_matching_rows() called for inefficient predicate')
+        # be evaluated efficiently, which for OperationPredicate's is only
+        # the case of a list of keys
+        if not self.can_evaluate_efficiently(query.pk_column, query.indexed_columns):
+            raise NotImplementedError('get_matching_rows() called for inefficient predicate')
+        return query.get_rows_by_keys(self.value)
+    
+    def explain(self, query, index_predicates=()):
+        return ['KEY LOOKUP ' + repr(self)]
     
 class CompoundPredicate(object):
     def __init__(self, op, negated=False, children=None):
@@ -265,36 +366,59 @@ class CompoundPredicate(object):
                 return True
         else:
             raise InvalidPredicateOpException()
-
-    def row_matches_subset(self, row, subset):
+    
+    def get_cost(self, pk_column, indexed_columns):
+        costs = [child.get_cost(pk_column, indexed_columns) for child in self.children
+                 if child.can_evaluate_efficiently(pk_column, indexed_columns)]
         if self.op == COMPOUND_OP_AND:
-            for predicate in subset:
-                if not predicate.row_matches(row):
-                    matches = False
-                    break
-            else:
-                matches = True
+            return min(costs)
+        return sum(costs)
+
+    def row_matches(self, row):
+        return self.compile()(row)
+    
+    def compile_subset(self, subset):
+        """
+        Returns a function that tells if a row matches the given children,
+        combined with the op of this predicate. The children are compiled
+        once, so the function can be applied to every fetched row.
+        """
+        matchers = [predicate.compile() for predicate in subset]
+        negated = self.negated
+        
+        if len(matchers) == 1:
+            matches = matchers[0]
+        elif self.op == COMPOUND_OP_AND:
+            def matches(row):
+                for matcher in matchers:
+                    if not matcher(row):
+                        return False
+                return True
         elif self.op == COMPOUND_OP_OR:
-            for predicate in subset:
-                if predicate.row_matches(row):
-                    matches =  True
-                    break
-            else:
-                matches = False
+            def matches(row):
+                for matcher in matchers:
+                    if matcher(row):
+                        return True
+                return False
         else:
             raise InvalidPredicateOpException()
         
-        if self.negated:
-            matches = not matches
-            
+        if negated:
+            return lambda row: not matches(row)
         return matches
-        
-    def row_matches(self, row):
-        return self.row_matches_subset(row, self.children)
+    
+    def compile(self):
+        return self.compile_subset(self.children)
     
     def incorporate_range_op(self, column, op, value, parent_predicate):
         return False
     
+    def get_columns(self):
+        columns = []
+        for child in self.children:
+            columns.extend(child.get_columns())
+        return columns
+    
     def add_filter(self, column, op, value):
         if op in ('lt', 'lte', 'gt', 'gte', 'exact', 'startswith'):
             for child in self.children:
@@ -312,38 +436,85 @@ class CompoundPredicate(object):
     def add_child(self, child_query_node):
         self.children.append(child_query_node)
     
-    def get_matching_rows(self, query):
-        pk_column = query.query.get_meta().pk.column
-        #indexed_columns = query.indexed_columns
+    def get_plan(self, query):
+        pk_column = query.pk_column
+        indexed_columns = query.indexed_columns
+        
+        # Predicates that can't be evaluated efficiently are checked against
+        # the rows fetched for the ones that can. Hopefully, in most cases,
+        # this will result in a subset of the rows that is much smaller than
+        # the overall number of rows.
+        if not self.can_evaluate_efficiently(pk_column, indexed_columns):
+            return QueryPlan([], self.children)
         
-        # In the first pass we handle the query nodes that can be processed
-        # efficiently. Hopefully, in most cases, this will result in a
-        # subset of the rows that is much smaller than the overall number
-        # of rows so we only have to run the inefficient query predicates
-        # over this smaller number of rows.
-        if self.can_evaluate_efficiently(pk_column, query.indexed_columns):
-            inefficient_predicates = []
+        if self.op == COMPOUND_OP_OR:
+            return QueryPlan(list(self.children), [])
+        
+        # Only fetch the rows for the cheapest predicate, the other ones are
+        # checked against those rows, like the inefficient ones.
+        efficient_predicates = [predicate for predicate in self.children
+            if predicate.can_evaluate_efficiently(pk_column, indexed_columns)]
+        cheapest = min(efficient_predicates,
+            key=lambda predicate: predicate.get_cost(pk_column, indexed_columns))
+        filter_predicates = [predicate for predicate in self.children
+                             if predicate is not cheapest]
+        
+        # An index scan can also take the other conditions on indexed
+        # columns. Cassandra then uses the most selective index and checks
+        # the other expressions itself, so fewer rows are sent back. They're
+        # still kept as filters, since they're cheap to check again.
+        index_predicates = []
+        if isinstance(cheapest, RangePredicate) and cheapest.column != pk_column:
+            supports_ranges = query.supports_indexed_ranges()
+            for predicate in filter_predicates:
+                if (isinstance(predicate, RangePredicate) and
+                    predicate.column in indexed_columns and
+                    (predicate._is_exact() or supports_ranges)):
+                    index_predicates.append(predicate)
+        
+        return QueryPlan([cheapest], filter_predicates, index_predicates)
+    
+    def get_matching_rows(self, query, index_predicates=()):
+        pk_column = query.pk_column
+        plan = self.get_plan(query)
+        
+        if plan.full_scan:
+            result = query.get_all_rows()
+        elif len(plan.fetch_predicates) == 1:
+            result = plan.fetch_predicates[0].get_matching_rows(query, plan.index_predicates)
+        else:
             result = None
-            for predicate in self.children:
-                if predicate.can_evaluate_efficiently(pk_column, query.indexed_columns):
-                    rows = predicate.get_matching_rows(query)
-                            
-                    if result == None:
-                        result = rows
-                    else:
-                        result = combine_rows(result, rows, self.op, pk_column)
+            for predicate in plan.fetch_predicates:
+                rows = predicate.get_matching_rows(query)
+                if result == None:
+                    result = rows
                 else:
-                    inefficient_predicates.append(predicate)
-        else:
-            inefficient_predicates = self.children
-            result = query.get_all_rows()
-        
-        if result == None:
-            result = []
+                    result = combine_rows(list(result), list(rows), self.op, pk_column)
             
-        # Now 
-        if len(inefficient_predicates) > 0:
-            result = [row for row in result if self.row_matches_subset(row, inefficient_predicates)]
+        # The rows are fetched from Cassandra a page at a time, while they're
+        # consumed, so the remaining predicates are applied lazily too.
+        if len(plan.filter_predicates) > 0:
+            result = itertools.ifilter(self.compile_subset(plan.filter_predicates), result)
             
         return result
-
+    
+    def explain(self, query, index_predicates=()):
+        """
+        Returns the lines describing how the rows are fetched and filtered.
+        """
+        plan = self.get_plan(query)
+        
+        if plan.full_scan:
+            lines = ['FULL SCAN']
+        elif len(plan.fetch_predicates) == 1:
+            lines = plan.fetch_predicates[0].explain(query, plan.index_predicates)
+        else:
+            lines = ['UNION']
+            for predicate in plan.fetch_predicates:
+                lines.extend(['    ' + line for line in predicate.explain(query)])
+        
+        if plan.filter_predicates:
+            filters = ', '.join([unicode(predicate) for predicate in plan.filter_predicates])
+            lines.append('FILTER %s%s: %s' % ('NOT ' if self.negated else '',
+                'AND' if self.op == COMPOUND_OP_AND else 'OR', filters))
+        return lines
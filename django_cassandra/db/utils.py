@@ -13,6 +13,8 @@
 #   limitations under the License.
 
 import time
+import logging
+import threading
 from thrift import Thrift
 from thrift.transport import TTransport
 from thrift.transport import TSocket
@@ -59,10 +61,7 @@ def _compare_rows(row1, row2, sort_spec_list):
         result = 0
     return result
 
-def sort_rows(rows, sort_spec):
-    if sort_spec == None:
-        return rows
-
+def row_sort_key(sort_spec):
     if (type(sort_spec) != list) and (type(sort_spec) != tuple):
         raise InvalidSortSpecException()
     
@@ -75,7 +74,13 @@ def sort_rows(rows, sort_spec):
     else:
         sort_spec_list = (sort_spec,)
     
-    rows.sort(key=_cmp_to_key(lambda row1, row2: _compare_rows(row1, row2, sort_spec_list)))
+    return _cmp_to_key(lambda row1, row2: _compare_rows(row1, row2, sort_spec_list))
+
+def sort_rows(rows, sort_spec):
+    if sort_spec == None:
+        return rows
+    
+    rows.sort(key=row_sort_key(sort_spec))
 
 COMBINE_INTERSECTION = 1
 COMBINE_UNION = 2
@@ -87,58 +92,24 @@ def combine_rows(rows1, rows2, op, primary_key_column):
     if not rows2:
         return list(rows1) if (op == COMBINE_UNION) else []
     
-    # We're going to iterate over the lists in parallel and
-    # compare the elements so we need both lists to be sorted
-    # Note that this means that the input arguments will be modified.
-    # We could optionally clone the rows first, but then we'd incur
-    # the overhead of the copy. For now, we'll just always sort
-    # in place, and if it turns out to be a problem we can add the
-    # option to copy
-    sort_rows(rows1,(primary_key_column,))
-    sort_rows(rows2,(primary_key_column,))
-    
-    combined_rows = []
-    iter1 = iter(rows1)
-    iter2 = iter(rows2)
-    update1 = update2 = True
-    
-    while True:
-        # Get the next element from one or both of the lists
-        if update1:
-            try:
-                row1 = iter1.next()
-            except:
-                row1 = None
-            value1 = row1.get(primary_key_column, None) if row1 != None else None
-        if update2:
-            try:
-                row2 = iter2.next()
-            except:
-                row2 = None
-            value2 = row2.get(primary_key_column, None) if row2 != None else None
-        
-        if (op == COMBINE_INTERSECTION):
-            # If we've reached the end of either list and we're doing an intersection,
-            # then we're done
-            if (row1 == None) or (row2 == None):
-                break
-        
-            if value1 == value2:
-                combined_rows.append(row1)
-        elif (op == COMBINE_UNION):
-            if row1 == None:
-                if row2 == None:
-                    break;
-                combined_rows.append(row2)
-            elif (row2 == None) or (value1 <= value2):
-                combined_rows.append(row1)
-            else:
-                combined_rows.append(row2)
-        else:
-            raise InvalidCombineRowsOpException()
-        
-        update1 = (row2 == None) or (value1 <= value2)
-        update2 = (row1 == None) or (value2 <= value1)
+    # Rows are matched by their primary key with a set, so neither list
+    # needs to be sorted. The order of rows1 is kept, followed by the rows
+    # only in rows2 for a union.
+    keys2 = set([row.get(primary_key_column, None) for row in rows2])
+    
+    if op == COMBINE_INTERSECTION:
+        combined_rows = [row for row in rows1
+                         if row.get(primary_key_column, None) in keys2]
+    elif op == COMBINE_UNION:
+        keys1 = set([row.get(primary_key_column, None) for row in rows1])
+        combined_rows = list(rows1)
+        for row in rows2:
+            key = row.get(primary_key_column, None)
+            if key not in keys1:
+                keys1.add(key)
+                combined_rows.append(row)
+    else:
+        raise InvalidCombineRowsOpException()
     
     return combined_rows
 
@@ -187,6 +158,7 @@ class CassandraConnection(object):
         self.client = None
         self.keyspace_set = False
         self.logged_in = False
+        self.last_used = time.time()
         
     def commit(self):
         pass
@@ -262,8 +234,267 @@ class CassandraConnection(object):
     def reopen(self):
         self.close()
         self.open(True, True)
+
+
+def parse_hosts(host, default_port):
+    """
+    Parse the HOST database setting into a list of (host, port) tuples. HOST
+    can be a single host, a comma-separated string or a list of hosts, each
+    one optionally followed by ':port'.
+    """
+    if not host:
+        host = 'localhost'
+    if isinstance(host, basestring):
+        host = host.split(',')
+    
+    hosts = []
+    for entry in host:
+        entry = entry.strip()
+        if not entry:
+            continue
+        if ':' in entry:
+            name, port = entry.rsplit(':', 1)
+            hosts.append((name, int(port)))
+        else:
+            hosts.append((entry, int(default_port)))
+    return hosts
+
+
+class CassandraConnectionPool(object):
+    """
+    Pool of CassandraConnections to one or more hosts.
+    
+    Each thread checks out its own connection the first time it talks to
+    Cassandra and keeps it until release is called, which the backend does
+    when Django closes the connections at the end of every request. The
+    connections of threads that ended without releasing them are closed and
+    count against the pool no more. Hosts are picked round-robin and at most
+    pool_size connections are open to each one; when all of them are
+    checked out, threads wait up to pool_timeout seconds for one to be
+    released.
+    
+    The database wrappers are thread-local, so they share the pool of their
+    alias through get_connection_pool.
+    
+    The pool has the same interface as CassandraConnection, applied to the
+    calling thread's connection, so it can be used wherever a connection is.
+    """
+    
+    connection_class = CassandraConnection
+    
+    def __init__(self, hosts, keyspace, user, password, pool_size=5,
+                 pool_timeout=30, max_idle_time=300, health_check_interval=30,
+                 retry_interval=10):
+        self.hosts = hosts
+        self.keyspace = keyspace
+        self.user = user
+        self.password = password
+        self.pool_size = pool_size
+        self.pool_timeout = pool_timeout
+        self.max_idle_time = max_idle_time
+        self.health_check_interval = health_check_interval
+        self.retry_interval = retry_interval
+        
+        self._local = threading.local()
+        self._condition = threading.Condition(threading.Lock())
+        self._idle = dict([(host, []) for host in hosts])
+        self._open = dict([(host, 0) for host in hosts])
+        # Checked out connections, by the thread holding them
+        self._checked_out = {}
+        self._failed_at = {}
+        self._next_host = 0
+        
+        self.checkouts = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+        
+    def _ordered_hosts(self):
+        # Round-robin, with the hosts that failed recently at the end
+        start = self._next_host
+        self._next_host = (self._next_host + 1) % len(self.hosts)
+        hosts = self.hosts[start:] + self.hosts[:start]
+        now = time.time()
+        up = [host for host in hosts
+              if now - self._failed_at.get(host, 0) >= self.retry_interval]
+        return up + [host for host in hosts if host not in up]
+    
+    def _evict_idle(self):
+        now = time.time()
+        for host, idle in self._idle.iteritems():
+            while idle and now - idle[0].last_used > self.max_idle_time:
+                idle.pop(0).close()
+                self._open[host] -= 1
+    
+    def _reclaim(self):
+        for thread, connection in self._checked_out.items():
+            if not thread.is_alive():
+                del self._checked_out[thread]
+                connection.close()
+                self._open[(connection.host, connection.port)] -= 1
+    
+    def _take(self):
+        self._evict_idle()
+        self._reclaim()
+        hosts = self._ordered_hosts()
+        for host in hosts:
+            if self._idle[host]:
+                return self._idle[host].pop()
+        for host in hosts:
+            if self._open[host] < self.pool_size:
+                self._open[host] += 1
+                return self.connection_class(host[0], host[1], self.keyspace,
+                                             self.user, self.password)
+        return None
+    
+    def _check_health(self, connection):
+        if not connection.is_connected() or \
+           time.time() - connection.last_used < self.health_check_interval:
+            return
+        try:
+            connection.client.describe_version()
+        except Exception, e:
+            logging.warning('Discarding broken Cassandra connection to %s:%s; %s' %
+                            (connection.host, connection.port, e))
+            connection.close()
+    
+    def checkout(self):
+        """
+        Return the calling thread's connection, checking out one from the pool
+        if the thread doesn't have one yet.
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            return connection
+        
+        start = time.time()
+        self._condition.acquire()
+        try:
+            while True:
+                connection = self._take()
+                if connection is not None:
+                    break
+                remaining = self.pool_timeout - (time.time() - start)
+                if remaining <= 0:
+                    raise CassandraConnectionError('Timed out waiting for a connection from the pool')
+                self._condition.wait(remaining)
+            
+            self._checked_out[threading.current_thread()] = connection
+            wait_time = time.time() - start
+            self.checkouts += 1
+            self.total_wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+        finally:
+            self._condition.release()
+        
+        self._check_health(connection)
+        self._local.connection = connection
+        return connection
+    
+    def release(self):
+        """
+        Return the calling thread's connection to the pool.
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            return
+        self._local.connection = None
+        
+        connection.last_used = time.time()
+        host = (connection.host, connection.port)
+        self._condition.acquire()
+        try:
+            self._checked_out.pop(threading.current_thread(), None)
+            self._idle[host].append(connection)
+            self._condition.notify()
+        finally:
+            self._condition.release()
+    
+    def discard(self, failed=True):
+        """
+        Close the calling thread's connection. If failed is set its host is
+        the last one tried for the next retry_interval seconds.
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            return
+        self._local.connection = None
+        
+        connection.close()
+        host = (connection.host, connection.port)
+        self._condition.acquire()
+        try:
+            self._checked_out.pop(threading.current_thread(), None)
+            self._open[host] -= 1
+            if failed:
+                self._failed_at[host] = time.time()
+            self._condition.notify()
+        finally:
+            self._condition.release()
+    
+    def stats(self):
+        self._condition.acquire()
+        try:
+            return {'checkouts': self.checkouts,
+                    'total_wait_time': self.total_wait_time,
+                    'average_wait_time': self.total_wait_time / self.checkouts
+                                         if self.checkouts else 0.0,
+                    'max_wait_time': self.max_wait_time,
+                    'open': sum(self._open.values()),
+                    'idle': sum([len(idle) for idle in self._idle.values()])}
+        finally:
+            self._condition.release()
+    
+    # CassandraConnection interface, applied to the thread's connection
+    
+    def commit(self):
+        pass
+    
+    def set_keyspace(self):
+        self.checkout().set_keyspace()
+    
+    def login(self):
+        self.checkout().login()
+    
+    def open(self, set_keyspace=False, login=False):
+        try:
+            self.checkout().open(set_keyspace, login)
+        except TTransport.TTransportException:
+            # Try the next host
+            self.discard()
+            self.checkout().open(set_keyspace, login)
+    
+    def close(self):
+        self.discard(False)
+    
+    def is_connected(self):
+        return self.checkout().is_connected()
+    
+    def get_client(self):
+        return self.checkout().get_client()
+    
+    def reopen(self):
+        self.discard()
+        self.open(True, True)
             
 
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_connection_pool(alias, *args, **kwargs):
+    """
+    Return the connection pool of the database alias, creating it with the
+    given arguments the first time.
+    """
+    _pools_lock.acquire()
+    try:
+        pool = _pools.get(alias)
+        if pool is None:
+            pool = _pools[alias] = CassandraConnectionPool(*args, **kwargs)
+        return pool
+    finally:
+        _pools_lock.release()
+
+
 class CassandraConnectionError(DatabaseError):
     def __init__(self, message=None):
         msg = 'Error connecting to Cassandra database'
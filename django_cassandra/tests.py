@@ -0,0 +1,431 @@
+#   Copyright 2010 BSN, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import time
+import logging
+import threading
+
+from django.db.utils import DatabaseError
+from django.utils import unittest
+
+from django_cassandra.db.base import DatabaseWrapper
+from django_cassandra.db.compiler import CassandraQuery
+from django_cassandra.db.predicate import CompoundPredicate, COMPOUND_OP_AND, \
+    COMPOUND_OP_OR
+from django_cassandra.db.utils import parse_hosts, CassandraConnectionPool, \
+    CassandraConnectionError, combine_rows, COMBINE_INTERSECTION, COMBINE_UNION
+
+
+class FakeConnection(object):
+    def __init__(self, page_size=100, max_key_count=1000000,
+                 full_scan_policy='warn', supports_indexed_ranges=True):
+        self.page_size = page_size
+        self.max_key_count = max_key_count
+        self.full_scan_policy = full_scan_policy
+        self.supports_indexed_range_expressions = supports_indexed_ranges
+        self.db_connection = None
+
+class FakeKeySlice(object):
+    def __init__(self, key):
+        self.key = key
+
+def make_query(connection):
+    # Only the paging code is exercised, it doesn't need the compiler
+    query = CassandraQuery.__new__(CassandraQuery)
+    query.connection = connection
+    return query
+
+class FakeRange(object):
+    """
+    Serves pages of the sorted keys like get_range_slices does, starting at
+    start_key inclusive, and records the counts asked for.
+    """
+    def __init__(self, keys):
+        self.keys = sorted(keys)
+        self.counts = []
+
+    def __call__(self, start_key, count):
+        self.counts.append(count)
+        keys = [key for key in self.keys if key >= start_key]
+        return [FakeKeySlice(key) for key in keys[:count]]
+
+class KeySlicePagingTest(unittest.TestCase):
+    keys = ['%02d' % i for i in range(10)]
+
+    def fetch(self, page_size, limit=None, max_key_count=1000000, start_key=''):
+        query = make_query(FakeConnection(page_size, max_key_count))
+        fetch_page = FakeRange(self.keys)
+        keys = [element.key for element in
+                query._iter_key_slices(fetch_page, start_key, limit)]
+        return keys, fetch_page.counts
+
+    def test_pages(self):
+        keys, counts = self.fetch(page_size=4)
+        self.assertEqual(keys, self.keys)
+        # The pages after the first one overlap by their first key
+        self.assertEqual(counts, [4, 5, 5])
+
+    def test_limit_only_sizes_first_page(self):
+        keys, counts = self.fetch(page_size=4, limit=2)
+        self.assertEqual(keys, self.keys)
+        self.assertEqual(counts, [2, 5, 5, 5])
+
+    def test_limit_above_page_size(self):
+        keys, counts = self.fetch(page_size=4, limit=100)
+        self.assertEqual(keys, self.keys)
+        self.assertEqual(counts, [4, 5, 5])
+
+    def test_zero_limit(self):
+        keys, counts = self.fetch(page_size=4, limit=0)
+        self.assertEqual(keys, self.keys)
+        self.assertEqual(counts[0], 1)
+
+    def test_max_key_count(self):
+        keys, counts = self.fetch(page_size=4, max_key_count=6)
+        self.assertEqual(keys, self.keys[:6])
+        self.assertEqual(counts, [4, 3])
+
+    def test_start_key(self):
+        keys, counts = self.fetch(page_size=3, start_key='05')
+        self.assertEqual(keys, self.keys[5:])
+
+    def test_exact_pages(self):
+        keys, counts = self.fetch(page_size=5)
+        self.assertEqual(keys, self.keys)
+        # The last page only has the overlapping key
+        self.assertEqual(counts, [5, 6, 6])
+
+class MatchingKeysTest(unittest.TestCase):
+    def test_delete_fetches_keys_first(self):
+        query = make_query(FakeConnection(page_size=2))
+        events = []
+        def iter_keys():
+            # 'a' shows up again, like a row matched by both sides of an OR
+            for key in ['a', 'b', 'a', 'c']:
+                events.append(('fetch', key))
+                yield key
+        def batch_mutate(keys, get_mutations):
+            for key in keys:
+                events.append(('mutate', key))
+            return len(keys)
+        query.iter_keys = iter_keys
+        query.batch_mutate = batch_mutate
+        
+        query.delete()
+        self.assertEqual(events, [('fetch', 'a'), ('fetch', 'b'), ('fetch', 'a'),
+                                  ('fetch', 'c'), ('mutate', 'a'),
+                                  ('mutate', 'b'), ('mutate', 'c')])
+
+def make_planned_query(connection, *filters, **kwargs):
+    query = make_query(connection)
+    query.pk_column = 'id'
+    query.column_family = 'report'
+    query.indexed_columns = ['test_id', 'time']
+    query.ordering_spec = None
+    query.root_predicate = CompoundPredicate(kwargs.get('op', COMPOUND_OP_AND))
+    for column, op, value in filters:
+        query.root_predicate.add_filter(column, op, value)
+    return query
+
+class QueryPlanTest(unittest.TestCase):
+    def plan(self, *filters, **kwargs):
+        connection = FakeConnection(**kwargs)
+        query = make_planned_query(connection, *filters)
+        return query.root_predicate.get_plan(query)
+    
+    def test_cheapest_predicate(self):
+        plan = self.plan(('target', 'contains', 'a'), ('test_id', 'exact', '1'),
+                         ('id', 'exact', 'k'))
+        self.assertFalse(plan.full_scan)
+        self.assertEqual([p.column for p in plan.fetch_predicates], ['id'])
+        self.assertEqual([p.column for p in plan.filter_predicates],
+                         ['target', 'test_id'])
+        self.assertEqual(plan.index_predicates, [])
+    
+    def test_index_predicates(self):
+        filters = (('test_id', 'exact', '1'), ('time', 'gt', '5'),
+                   ('target', 'exact', 'a'))
+        plan = self.plan(*filters)
+        self.assertEqual([p.column for p in plan.fetch_predicates], ['test_id'])
+        self.assertEqual([p.column for p in plan.index_predicates], ['time'])
+        # The index predicates are still checked on the fetched rows
+        self.assertEqual([p.column for p in plan.filter_predicates],
+                         ['time', 'target'])
+        
+        plan = self.plan(supports_indexed_ranges=False, *filters)
+        self.assertEqual(plan.index_predicates, [])
+    
+    def test_full_scan(self):
+        plan = self.plan(('target', 'exact', 'a'), ('time', 'gt', '5'))
+        self.assertTrue(plan.full_scan)
+        self.assertEqual(len(plan.filter_predicates), 2)
+    
+    def test_union(self):
+        connection = FakeConnection()
+        query = make_planned_query(connection, ('id', 'exact', 'a'),
+                                   ('id', 'in', ['b', 'c']), op=COMPOUND_OP_OR)
+        plan = query.root_predicate.get_plan(query)
+        self.assertEqual(len(plan.fetch_predicates), 2)
+        self.assertEqual(plan.filter_predicates, [])
+    
+    def test_explain(self):
+        query = make_planned_query(FakeConnection(), ('id', 'exact', 'k'),
+                                   ('target', 'contains', 'a'))
+        self.assertEqual(query.explain().split('\n'),
+                         ['COLUMN FAMILY report',
+                          'KEY LOOKUP (RANGE: k<=id<=k)',
+                          'FILTER AND: (OP: target:contains:a)'])
+        
+        query = make_planned_query(FakeConnection(), ('test_id', 'exact', '1'),
+                                   ('time', 'gte', '5'))
+        query.ordering_spec = [('time', True)]
+        self.assertEqual(query.explain(0, 10).split('\n'),
+                         ['COLUMN FAMILY report',
+                          'INDEX SCAN (RANGE: 1<=test_id<=1) AND (RANGE: 5<=time)',
+                          'FILTER AND: (RANGE: 5<=time)',
+                          'TOP 10 BY time DESC',
+                          'SLICE [:10]'])
+        
+        query = make_planned_query(FakeConnection(), ('target', 'exact', 'a'))
+        self.assertEqual(query.explain().split('\n')[1:],
+                         ['FULL SCAN', 'FILTER AND: (RANGE: a<=target<=a)'])
+    
+    def test_full_scan_raise(self):
+        query = make_planned_query(FakeConnection(full_scan_policy='raise'),
+                                   ('target', 'exact', 'a'))
+        self.assertRaises(DatabaseError, query.root_predicate.get_matching_rows,
+                          query)
+
+    def test_full_scan_warns_once(self):
+        warnings = []
+        handler = logging.Handler()
+        handler.emit = warnings.append
+        logging.getLogger().addHandler(handler)
+        try:
+            for value in ['a', 'b']:
+                query = make_planned_query(FakeConnection(),
+                                           ('target', 'exact', value))
+                query.column_family = 'warned_report'
+                query._check_full_scan()
+            query = make_planned_query(FakeConnection(full_scan_policy='allow'),
+                                       ('time', 'gt', '5'))
+            query.column_family = 'warned_report'
+            query._check_full_scan()
+        finally:
+            logging.getLogger().removeHandler(handler)
+        self.assertEqual(len(warnings), 1)
+
+class RowMatchesTest(unittest.TestCase):
+    def test_compound(self):
+        predicate = CompoundPredicate(COMPOUND_OP_AND)
+        predicate.add_filter('time', 'gt', 5)
+        predicate.add_filter('target', 'startswith', 'www')
+        self.assertTrue(predicate.row_matches({'time': 6, 'target': 'www.a'}))
+        self.assertFalse(predicate.row_matches({'time': 5, 'target': 'www.a'}))
+        self.assertFalse(predicate.row_matches({'time': 6}))
+        
+        either = CompoundPredicate(COMPOUND_OP_OR, negated=True)
+        either.add_filter('time', 'lt', 2)
+        either.add_filter('target', 'contains', 'b')
+        self.assertTrue(either.row_matches({'time': 5, 'target': 'www.a'}))
+        self.assertFalse(either.row_matches({'time': 1, 'target': 'www.a'}))
+        self.assertFalse(either.row_matches({'time': 5, 'target': 'www.b'}))
+
+class ParseHostsTest(unittest.TestCase):
+    def test_hosts(self):
+        self.assertEqual(parse_hosts(None, 9160), [('localhost', 9160)])
+        self.assertEqual(parse_hosts('db1, db2:9161,', '9160'),
+                         [('db1', 9160), ('db2', 9161)])
+        self.assertEqual(parse_hosts(['db1:9170', 'db2'], 9160),
+                         [('db1', 9170), ('db2', 9160)])
+
+class FakeCassandraConnection(object):
+    def __init__(self, host, port, keyspace, user, password):
+        self.host = host
+        self.port = port
+        self.closed = False
+        self.last_used = time.time()
+    
+    def is_connected(self):
+        return False
+    
+    def close(self):
+        self.closed = True
+
+class FakePool(CassandraConnectionPool):
+    connection_class = FakeCassandraConnection
+
+class ConnectionPoolTest(unittest.TestCase):
+    def make_pool(self, **kwargs):
+        return FakePool([('db1', 9160), ('db2', 9160)], 'test', None, None,
+                        **kwargs)
+    
+    def test_thread_keeps_connection(self):
+        pool = self.make_pool()
+        connection = pool.checkout()
+        self.assertTrue(pool.checkout() is connection)
+        pool.release()
+        self.assertTrue(pool.checkout() is connection)
+        self.assertEqual(pool.stats()['open'], 1)
+    
+    def test_round_robin(self):
+        pool = self.make_pool()
+        hosts = []
+        def checkout():
+            hosts.append(pool.checkout().host)
+        for i in range(2):
+            thread = threading.Thread(target=checkout)
+            thread.start()
+            thread.join()
+        # The connections of the ended threads were never released
+        self.assertEqual(sorted(hosts), ['db1', 'db2'])
+        pool.checkout()
+        self.assertEqual(pool.stats()['open'], 1)
+    
+    def test_timeout(self):
+        pool = self.make_pool(pool_size=1, pool_timeout=0.01)
+        ready = threading.Event()
+        done = threading.Event()
+        def hold():
+            pool.checkout()
+            ready.set()
+            done.wait()
+        threads = [threading.Thread(target=hold) for i in range(2)]
+        for thread in threads:
+            thread.start()
+            ready.wait()
+            ready.clear()
+        try:
+            self.assertRaises(CassandraConnectionError, pool.checkout)
+        finally:
+            done.set()
+            for thread in threads:
+                thread.join()
+    
+    def test_discard(self):
+        pool = self.make_pool()
+        connection = pool.checkout()
+        pool.discard()
+        self.assertTrue(connection.closed)
+        self.assertEqual(pool.stats()['open'], 0)
+        # The failed host is tried last
+        self.assertNotEqual(pool.checkout().host, connection.host)
+    
+    def test_wrapper_close_releases(self):
+        wrapper = DatabaseWrapper({'NAME': 'test'}, 'pool_test')
+        pool = wrapper._db_connection = self.make_pool()
+        pool.checkout()
+        wrapper.close()
+        self.assertEqual(pool.stats()['idle'], 1)
+
+class CombineRowsTest(unittest.TestCase):
+    rows1 = [{'id': 'c'}, {'id': 'a'}, {'id': 'b'}]
+    rows2 = [{'id': 'd'}, {'id': 'b'}, {'id': 'c'}, {'id': 'd'}]
+    
+    def keys(self, rows):
+        return [row['id'] for row in rows]
+    
+    def test_intersection(self):
+        rows = combine_rows(self.rows1, self.rows2, COMBINE_INTERSECTION, 'id')
+        self.assertEqual(self.keys(rows), ['c', 'b'])
+        self.assertEqual(combine_rows(self.rows1, [], COMBINE_INTERSECTION,
+                                      'id'), [])
+    
+    def test_union(self):
+        rows = combine_rows(self.rows1, self.rows2, COMBINE_UNION, 'id')
+        self.assertEqual(self.keys(rows), ['c', 'a', 'b', 'd'])
+        self.assertEqual(self.keys(combine_rows(None, self.rows2,
+                                                COMBINE_UNION, 'id')),
+                         self.keys(self.rows2))
+
+class FakeFetches(object):
+    """
+    Stands in for the calls that fetch rows from Cassandra, returning only
+    the query's column_names of each row, and records what was fetched.
+    """
+    def __init__(self, query, rows):
+        self.query = query
+        self.rows = rows
+        self.column_names = []
+        self.fetch_limits = []
+        self.fetched = 0
+        query.get_all_rows = self.get_all_rows
+        query.get_row_range = self.get_row_range
+        query.get_rows_by_keys = self.get_rows_by_keys
+    
+    def _iter(self, rows):
+        self.column_names.append(self.query.column_names)
+        self.fetch_limits.append(self.query.fetch_limit)
+        for row in rows:
+            self.fetched += 1
+            if self.query.column_names is None:
+                yield dict(row)
+            else:
+                yield dict([(column, row[column]) for column in
+                            self.query.column_names if column in row])
+    
+    def get_all_rows(self):
+        return self._iter(self.rows)
+    
+    def get_row_range(self, predicate, index_predicates=()):
+        return self._iter([row for row in self.rows
+                           if predicate.row_matches(row)])
+    
+    def get_rows_by_keys(self, keys):
+        return self._iter([row for row in self.rows if row['id'] in keys])
+
+class KeysOnlyTest(unittest.TestCase):
+    rows = [{'id': key, 'target': target, 'trace': 'long'}
+            for key, target in [('a', 'x'), ('b', 'y'), ('c', 'x'), ('d', 'x')]]
+    
+    def query(self, *filters, **kwargs):
+        query = make_planned_query(FakeConnection(full_scan_policy='allow'),
+                                   *filters, **kwargs)
+        query.cached_results = None
+        query.column_names = None
+        return query, FakeFetches(query, self.rows)
+    
+    def test_count_and(self):
+        query, fetches = self.query(('id', 'in', ['a', 'b', 'c']),
+                                    ('target', 'exact', 'x'))
+        self.assertEqual(query.count(), 2)
+        # Only the rows of the cheapest clause were fetched, without their data
+        self.assertEqual(fetches.fetched, 3)
+        self.assertEqual(sorted(fetches.column_names[0]), ['id', 'target'])
+        self.assertEqual(query.column_names, None)
+    
+    def test_count_or(self):
+        query, fetches = self.query(('id', 'exact', 'a'),
+                                    ('id', 'in', ['a', 'b']),
+                                    op=COMPOUND_OP_OR)
+        self.assertEqual(query.count(), 2)
+        self.assertEqual(fetches.column_names, [['id'], ['id']])
+    
+    def test_count_limit(self):
+        query, fetches = self.query(('target', 'exact', 'x'))
+        self.assertEqual(query.count(2), 2)
+        # Paging stopped at the second matching row
+        self.assertEqual(fetches.fetched, 3)
+        self.assertEqual(fetches.fetch_limits, [2])
+        self.assertEqual(query.fetch_limit, None)
+        
+        query.cached_results = self.rows[:3]
+        self.assertEqual(query.count(2), 2)
+        self.assertEqual(query.count(), 3)
+    
+    def test_iter_keys(self):
+        query, fetches = self.query(('target', 'exact', 'x'))
+        self.assertEqual(list(query.iter_keys()), ['a', 'c', 'd'])
+        self.assertEqual(sorted(fetches.column_names[0]), ['id', 'target'])
+        self.assertEqual(query.column_names, None)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##
+## Author: Adriano Monteiro Marques <adriano@umitproject.org>
+##
+## Copyright (C) 2011 S2S Network Consultoria e Tecnologia da Informacao LTDA
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU Affero General Public License as
+## published by the Free Software Foundation, either version 3 of the
+## License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Affero General Public License for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""Log of the latest event changes, for the delta polls.
+
+Every change gets the next version from a counter in the cache and is kept,
+with the JSON of the changed event, in one of size slots used as a ring
+buffer. A poll passes the last version it saw as its cursor and gets the
+events changed since then, so its cost follows the rate of changes instead
+of the size of the feed. Callers whose cursor is older than the buffer, or
+from before the counter was lost, are told to reset and get the whole feed.
+
+The counter starts from the current time in milliseconds, so versions
+handed out after it's lost are always past the ones before.
+"""
+
+import time
+import logging
+import threading
+
+import simplejson as json
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+EVENT_CHANGES_VERSION_KEY = "event_changes_version"
+EVENT_CHANGES_SLOT_KEY = "event_changes_%s"
+EVENT_CHANGES_EXPIRATION = 60*60 # Changes are kept for an hour at most
+EVENT_CHANGES_VERSION_EXPIRATION = 60*60*24*30
+
+
+class EventChanges(object):
+
+    def __init__(self, size=1000):
+        self.size = size
+        # Last change recorded by this process, so that an event published
+        # right after it was saved isn't recorded twice
+        self._last = None
+        self._lock = threading.Lock()
+
+    def _next_version(self):
+        cache.add(EVENT_CHANGES_VERSION_KEY, int(time.time() * 1000),
+                  EVENT_CHANGES_VERSION_EXPIRATION)
+        try:
+            return cache.incr(EVENT_CHANGES_VERSION_KEY)
+        except ValueError:
+            # Evicted in between
+            cache.add(EVENT_CHANGES_VERSION_KEY, int(time.time() * 1000),
+                      EVENT_CHANGES_VERSION_EXPIRATION)
+            return cache.incr(EVENT_CHANGES_VERSION_KEY)
+
+    def record(self, event):
+        """Adds the current state of event to the log.
+        """
+        try:
+            data = json.dumps(event.get_dict(), use_decimal=True)
+            with self._lock:
+                if self._last == (event.id, data):
+                    return
+                self._last = (event.id, data)
+
+            version = self._next_version()
+            cache.set(EVENT_CHANGES_SLOT_KEY % (version % self.size),
+                      (version, event.id, data), EVENT_CHANGES_EXPIRATION)
+        except Exception, e:
+            logging.error("Failed to record the changes of event %s: %s" % \
+                            (event.id, e))
+
+    def get_version(self):
+        """Returns the version of the latest change.
+        """
+        version = cache.get(EVENT_CHANGES_VERSION_KEY)
+        if version is None:
+            cache.add(EVENT_CHANGES_VERSION_KEY, int(time.time() * 1000),
+                      EVENT_CHANGES_VERSION_EXPIRATION)
+            version = cache.get(EVENT_CHANGES_VERSION_KEY)
+        return version
+
+    def since(self, cursor):
+        """Returns (version, changes), where changes is the JSON of the events
+        changed after the cursor version, oldest first, or None if the
+        caller must reset. Each event only shows up once, with its latest
+        state.
+        """
+        version = self.get_version()
+        if cursor is None or cursor > version or version - cursor > self.size:
+            return version, None
+        if cursor == version:
+            return version, []
+
+        versions = range(cursor + 1, version + 1)
+        keys = [EVENT_CHANGES_SLOT_KEY % (v % self.size) for v in versions]
+        slots = cache.get_many(keys)
+
+        changes = []
+        for i, v in enumerate(versions):
+            slot = slots.get(keys[i])
+            if slot is not None and slot[0] == v:
+                changes.append(slot[1:])
+                continue
+            if slot is not None and slot[0] > v:
+                # Overwritten by a later change
+                return version, None
+
+            later = [slots.get(key) for key in keys[i + 1:]]
+            if [slot for slot in later if slot is not None and slot[0] > v]:
+                # Evicted from the cache
+                return version, None
+            # Not written yet, the next poll picks it up
+            version = v - 1
+            break
+
+        latest = {}
+        for i, (event_id, data) in enumerate(changes):
+            latest[event_id] = i
+        return version, [data for i, (event_id, data) in enumerate(changes)
+                         if latest[event_id] == i]
+
+
+event_changes = EventChanges(
+        size=getattr(settings, 'EVENT_CHANGES_BUFFER_SIZE', 1000))
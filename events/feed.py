@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##
+## Author: Adriano Monteiro Marques <adriano@umitproject.org>
+##
+## Copyright (C) 2011 S2S Network Consultoria e Tecnologia da Informacao LTDA
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU Affero General Public License as
+## published by the Free Software Foundation, either version 3 of the
+## License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Affero General Public License for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""Materialized feed of the active events, as served to the map.
+
+The feed keeps the JSON of each of the first size active events, in the
+order of Event.get_active_events, and the whole list already serialized,
+along with its ETag. Saving an event only serializes that event and splices
+it into the feed, so polls never build the JSON themselves. The ETag is kept
+under a key of its own, so a poll whose feed didn't change doesn't even
+fetch the feed from the cache.
+
+The feed is rebuilt from the datastore when it expires, or when an update
+can't be applied safely, like when a change pushes an event out of a full
+feed and the next one has to be read.
+"""
+
+import hashlib
+import logging
+
+import simplejson as json
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+EVENT_FEED_CACHE_KEY = "active_events_feed"
+EVENT_FEED_ETAG_CACHE_KEY = "active_events_feed_etag"
+EVENT_FEED_LOCK_KEY = "active_events_feed_lock"
+EVENT_FEED_EXPIRATION = 60 # Rebuilt from the datastore every minute
+EVENT_FEED_LOCK_EXPIRATION = 10
+
+
+def feed_key(event):
+    return (event.last_detection_utc, event.id)
+
+
+class ActiveEventsFeed(object):
+
+    def __init__(self, size=25):
+        self.size = size
+        # Last feed read by this process, reused while its ETag is current
+        self._local = None
+
+    @staticmethod
+    def _entry(event):
+        return (feed_key(event), event.id,
+                json.dumps(event.get_dict(), use_decimal=True))
+
+    def _store(self, entries, complete):
+        data = '[%s]' % ','.join([entry[2] for entry in entries])
+        feed = {
+            'entries': entries,
+            'complete': complete,
+            'json': data,
+            'etag': hashlib.md5(data).hexdigest(),
+        }
+        cache.set(EVENT_FEED_CACHE_KEY, feed, EVENT_FEED_EXPIRATION)
+        cache.set(EVENT_FEED_ETAG_CACHE_KEY, feed['etag'],
+                  EVENT_FEED_EXPIRATION)
+        return feed
+
+    def rebuild(self):
+        """Builds the feed from the datastore.
+        """
+        from events.models import Event
+
+        events = Event.objects.filter(active=True).order_by(
+                        "last_detection_utc")[:self.size]
+        entries = [self._entry(event) for event in events]
+        return self._store(entries, len(entries) < self.size)
+
+    def invalidate(self):
+        cache.delete(EVENT_FEED_ETAG_CACHE_KEY)
+        cache.delete(EVENT_FEED_CACHE_KEY)
+
+    def update(self, event):
+        """Applies the changes of a saved event to the feed.
+        """
+        if not cache.add(EVENT_FEED_LOCK_KEY, True, EVENT_FEED_LOCK_EXPIRATION):
+            # Someone else is changing the feed, let the next read rebuild it
+            self.invalidate()
+            return
+
+        try:
+            feed = cache.get(EVENT_FEED_CACHE_KEY)
+            if feed is None:
+                return
+
+            entries = self._apply(feed['entries'], feed['complete'], event)
+            if entries is None:
+                self.invalidate()
+            elif entries is not feed['entries']:
+                complete = feed['complete'] and len(entries) <= self.size
+                self._store(entries[:self.size], complete)
+        except Exception, e:
+            logging.error("Failed to update the active events feed: %s" % e)
+            self.invalidate()
+        finally:
+            cache.delete(EVENT_FEED_LOCK_KEY)
+
+    def _apply(self, entries, complete, event):
+        """Returns the entries with the changes of event, the same entries
+        if it doesn't change them, or None if the feed must be rebuilt.
+        """
+        key = feed_key(event)
+        position = None
+        for i, entry in enumerate(entries):
+            if entry[1] == event.id:
+                position = i
+                break
+
+        if position is None and not event.active:
+            return entries
+
+        # Unless the feed has every active event, it only knows the ones up
+        # to its last entry. Past that, others could come first.
+        known = complete or (entries and key <= entries[-1][0])
+
+        if position is None:
+            if not known:
+                return entries
+            entries = entries[:]
+        else:
+            if not (known and event.active or complete):
+                return None
+            entries = entries[:position] + entries[position + 1:]
+
+        if event.active:
+            entries.append(self._entry(event))
+            entries.sort()
+        return entries
+
+    def get(self, limit=None, etag=None):
+        """Returns the ETag and the JSON of the first limit active events.
+        The JSON is None when etag is still current.
+        """
+        limit = min(limit or self.size, self.size)
+        current = cache.get(EVENT_FEED_ETAG_CACHE_KEY)
+
+        feed = None
+        if current is None:
+            feed = self.rebuild()
+            current = feed['etag']
+        elif self._local is not None and self._local['etag'] == current:
+            feed = self._local
+
+        if limit < self.size:
+            current = '%s-%s' % (current, limit)
+        if etag == current:
+            return current, None
+
+        if feed is None:
+            feed = cache.get(EVENT_FEED_CACHE_KEY)
+            if feed is None:
+                feed = self.rebuild()
+        self._local = feed
+
+        if limit < self.size:
+            return '%s-%s' % (feed['etag'], limit), \
+                   '[%s]' % ','.join([entry[2] for entry in
+                                      feed['entries'][:limit]])
+        return feed['etag'], feed['json']
+
+
+active_events_feed = ActiveEventsFeed(
+        size=getattr(settings, 'ACTIVE_EVENTS_FEED_SIZE', 25))
@@ -28,7 +28,9 @@ from django.utils import simplejson
 from django.core.cache import cache
 
 from geoip.models import Location
-from dbextra.fields import ListField
+from dbextra.fields import ListField, WideListField
+from events.feed import active_events_feed
+from events.changes import event_changes
 import logging
 
 SINGLE_EVENT_CACHE_TIME = 30
@@ -118,11 +120,10 @@ class Event(models.Model):
 
     @staticmethod
     def get_active_events_as_json(limit=20):
-        events = Event.get_active_events(limit)
-        events_dict = []
-        for event in events:
-            events_dict.append(event.get_dict())
-        initialEvents = json.dumps(events_dict, use_decimal=True)
+        """Returns the JSON of the active events, from the materialized feed.
+        See events.feed.
+        """
+        etag, initialEvents = active_events_feed.get(limit)
         return initialEvents
 
     @staticmethod
@@ -193,6 +194,8 @@ class Event(models.Model):
             cache.delete(EVENT_CACHE_KEY % self.id)
 
         cache.delete(EVENT_LIST_CACHE_KEY)
+        active_events_feed.update(self)
+        event_changes.record(self)
 
         return res
 
@@ -204,7 +207,7 @@ class EventLocationAggregation(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     last_detection_utc = models.DateTimeField(auto_now=True)
     location_country_code = models.CharField(max_length=2)
-    events = ListField(py_type=str)
+    events = WideListField(py_type=str, indexed=True)
     count = models.IntegerField(default=1)
 
     @staticmethod
@@ -223,8 +226,8 @@ class EventLocationAggregation(models.Model):
                 add = True
 
             if add:
-                agg.events.append(event.id)
                 agg.save()
+                agg.events.append(event.id)
 
             # TODO: delete LOCATION_CACHE
 
@@ -14,3 +14,206 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+import decimal
+
+from dbextra.listcodec import encode_list, decode_list, encode_csv
+
+
+class ListCodecTest(TestCase):
+    def test_round_trip(self):
+        lats = [decimal.Decimal('37.7749'), decimal.Decimal('-122.4194')]
+        self.assertEqual(decode_list(encode_list(lats, decimal.Decimal),
+                                     decimal.Decimal), lats)
+        self.assertEqual(decode_list(encode_list([1, -2], int), int), [1, -2])
+        names = ['a,b', 'c"d', 'e\\nf\ng', '']
+        self.assertEqual(decode_list(encode_list(names)), names)
+
+    def test_reads_csv(self):
+        names = ['a,b', 'c"d', 'e\ng']
+        self.assertEqual(decode_list(encode_csv(names)), names)
+        self.assertEqual(decode_list(encode_csv([1, 2]), int), [1, 2])
+
+
+from dbextra.fields import EncodedList
+from events.models import Event
+
+
+class LazyListFieldTest(TestCase):
+    def test_decodes_on_access(self):
+        raw = encode_list([1, 2], int)
+        event = Event(location_ids=raw)
+        field = Event._meta.get_field('location_ids')
+        self.assertTrue(isinstance(event.__dict__['location_ids'], EncodedList))
+        self.assertEqual(field.get_prep_value(field.pre_save(event, False)), raw)
+        self.assertEqual(event.location_ids, [1, 2])
+
+
+import datetime
+
+from events.feed import ActiveEventsFeed
+
+
+class ActiveEventsFeedTest(TestCase):
+    def event(self, id, minute, active=True):
+        return Event(id=id, active=active, target_type=0, event_type=0,
+                     target='example.com',
+                     first_detection_utc=datetime.datetime(2011, 8, 1),
+                     last_detection_utc=datetime.datetime(2011, 8, 1, 0, minute))
+
+    def test_apply(self):
+        feed = ActiveEventsFeed(size=2)
+        entries = [feed._entry(self.event('a', 1)), feed._entry(self.event('b', 2))]
+
+        moved = feed._apply(entries, True, self.event('a', 3))
+        self.assertEqual([entry[1] for entry in moved], ['b', 'a'])
+        # Full feeds don't know which event comes after their last one
+        self.assertEqual(feed._apply(entries, False, self.event('c', 3)), entries)
+        self.assertEqual(feed._apply(entries, False, self.event('a', 1, False)), None)
+
+
+from dbextra.widerow import WideList, index_key, column_name
+
+
+class MemoryRow(object):
+    """Keeps the rows of a WideRow in memory."""
+
+    def __init__(self):
+        self.rows = {}
+        self.slices = 0
+
+    def append(self, key, value, indexed=False):
+        self.extend(key, [value], indexed)
+
+    def extend(self, key, values, indexed=False):
+        row = self.rows.setdefault(key, {})
+        for value in values:
+            row[column_name()] = value
+        if indexed:
+            for value in values:
+                self.rows.setdefault(index_key(key), {})[value] = ''
+
+    def has_column(self, key, name):
+        return name in self.rows.get(key, {})
+
+    def get_slice(self, key, start='', count=100, reverse=False):
+        self.slices += 1
+        columns = sorted(self.rows.get(key, {}).items(), reverse=reverse)
+        if start:
+            columns = [c for c in columns
+                       if (c[0] <= start if reverse else c[0] >= start)]
+        return columns[:count]
+
+
+class WideListTest(TestCase):
+    def test_pages(self):
+        events = WideList(MemoryRow(), 'agg', str, str, 2)
+        events.extend(['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(list(events), ['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(events.latest(2), ['e', 'd'])
+
+    def test_indexed_contains(self):
+        row = MemoryRow()
+        events = WideList(row, 'agg', str, str, 2, indexed=True)
+        events.append('a')
+        events.extend(['b', 'c'])
+        self.assertTrue('c' in events)
+        self.assertFalse('d' in events)
+        # Answered from the index row, without reading the list
+        self.assertEqual(row.slices, 0)
+
+
+import time
+
+import simplejson as json
+
+from django.core.cache import get_cache
+
+from events import changes
+from events.changes import EventChanges, EVENT_CHANGES_SLOT_KEY, \
+                           EVENT_CHANGES_VERSION_KEY
+
+
+class FakeEvent(object):
+    def __init__(self, id, state):
+        self.id = id
+        self.state = state
+
+    def get_dict(self):
+        return {'id': self.id, 'state': self.state}
+
+
+class EventChangesTest(TestCase):
+    def setUp(self):
+        self._cache = changes.cache
+        changes.cache = get_cache('django.core.cache.backends.locmem.LocMemCache')
+        changes.cache.clear()
+        self.changes = EventChanges(size=4)
+        self.cursor = self.changes.get_version()
+
+    def tearDown(self):
+        changes.cache = self._cache
+
+    def record(self, id, state):
+        self.changes.record(FakeEvent(id, state))
+        return self.changes.get_version()
+
+    def states(self, data):
+        return [json.loads(d)['state'] for d in data]
+
+    def test_changes(self):
+        self.record(1, 'a')
+        self.record(2, 'b')
+        version = self.record(1, 'c')
+
+        self.assertEqual(self.changes.since(version), (version, []))
+        since, data = self.changes.since(self.cursor)
+        self.assertEqual(since, version)
+        # Each event once, with its latest state
+        self.assertEqual(self.states(data), ['b', 'c'])
+
+    def test_same_change_recorded_once(self):
+        first = self.record(1, 'a')
+        self.assertEqual(self.record(1, 'a'), first)
+
+    def test_reset(self):
+        version = self.record(1, 'a')
+        self.assertEqual(self.changes.since(None), (version, None))
+        self.assertEqual(self.changes.since(version + 1), (version, None))
+        for i in range(4):
+            version = self.record(2, str(i))
+        # Older than the buffer
+        self.assertEqual(self.changes.since(self.cursor), (version, None))
+
+    def test_counter_lost(self):
+        self.record(1, 'a')
+        # Versions are handed out in milliseconds
+        time.sleep(0.01)
+        changes.cache.delete(EVENT_CHANGES_VERSION_KEY)
+        version = self.changes.get_version()
+        # The counter starts again past the versions handed out before
+        self.assertTrue(version > self.cursor)
+        self.assertEqual(self.changes.since(self.cursor), (version, None))
+
+    def test_gap(self):
+        version = self.record(1, 'a')
+        # A change got its version, but wasn't written yet
+        changes.cache.incr(EVENT_CHANGES_VERSION_KEY)
+        self.assertEqual(self.changes.since(self.cursor)[0], version)
+        self.assertEqual(self.states(self.changes.since(self.cursor)[1]),
+                         ['a'])
+
+    def test_evicted(self):
+        first = self.record(1, 'a')
+        version = self.record(2, 'b')
+        changes.cache.delete(EVENT_CHANGES_SLOT_KEY % (first % 4))
+        self.assertEqual(self.changes.since(self.cursor), (version, None))
+
+    def test_overwritten(self):
+        first = self.record(1, 'a')
+        version = self.record(2, 'b')
+        # Changes recorded after the version was read took the slot
+        changes.cache.set(EVENT_CHANGES_SLOT_KEY % (first % 4),
+                          (first + 4, 3, '{}'))
+        self.assertEqual(self.changes.since(self.cursor), (version, None))
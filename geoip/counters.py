@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##
+## Author: Adriano Monteiro Marques <adriano@umitproject.org>
+##
+## Copyright (C) 2011 S2S Network Consultoria e Tecnologia da Informacao LTDA
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU Affero General Public License as
+## published by the Free Software Foundation, either version 3 of the
+## License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Affero General Public License for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""Buffered nodes_count counters for IPRange and Location.
+
+Logins and logouts don't load, change and save the rows anymore. The changes
+are added up in memory and applied at most flush_interval seconds later, or
+as soon as max_pending ids are waiting, with UPDATE ... SET nodes_count =
+nodes_count + delta statements, one per distinct delta, so concurrent
+changes can't overwrite each other.
+
+Every change is also added to a counter in the cache, shared by all the
+processes, which starts from the stored count the first time it's read.
+Counts read through NodesCounter.get come from there, so they include the
+changes that no process flushed yet.
+
+The IPRange counter also keeps the networks with the most nodes, so the
+network list doesn't need to sort the whole table.
+"""
+
+import atexit
+import logging
+import threading
+
+from django.db import close_connection
+from django.db.models import F
+from django.core.cache import cache
+from django.conf import settings
+
+
+NODES_COUNT_CACHE_KEY = "nodes_count_%s_%s"
+NODES_COUNT_EXPIRATION = 60*10
+TOP_NETWORKS_CACHE_KEY = "top_networks"
+TOP_NETWORKS_LOCK_KEY = "top_networks_lock"
+TOP_NETWORKS_EXPIRATION = 60*10 # Rebuilt from the table every 10 minutes
+TOP_NETWORKS_LOCK_EXPIRATION = 10
+
+
+class NodesCounter(object):
+
+    def __init__(self, model_name, flush_interval=5, max_pending=1000):
+        self.model_name = model_name
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending = {}
+        self._timer = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    @property
+    def model(self):
+        from geoip import models
+        return getattr(models, self.model_name)
+
+    def _key(self, id):
+        return NODES_COUNT_CACHE_KEY % (self.model_name, id)
+
+    def add(self, id, delta=1):
+        with self._lock:
+            self._pending[id] = self._pending.get(id, 0) + delta
+            full = len(self._pending) >= self.max_pending
+            if not full:
+                self._schedule()
+
+        try:
+            cache.incr(self._key(id), delta)
+        except ValueError:
+            # Not read yet, it starts from the stored count
+            pass
+        except Exception, e:
+            logging.error("Failed to count %s nodes in the cache: %s" % \
+                            (self.model_name, e))
+
+        if full:
+            self.flush()
+
+    def _schedule(self):
+        # Called with self._lock held
+        if self._timer is None:
+            self._timer = threading.Timer(self.flush_interval,
+                                          self._timed_flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _timed_flush(self):
+        with self._lock:
+            self._timer = None
+        try:
+            if not self.flush():
+                # Try again later, so the pending changes aren't left behind
+                with self._lock:
+                    if self._pending:
+                        self._schedule()
+        finally:
+            # Give the timer thread's database connections back
+            close_connection()
+
+    def get_many(self, stored_counts):
+        """Returns a dict with the current count of each id in stored_counts,
+        a dict of the counts read from the datastore.
+        """
+        keys = dict([(self._key(id), id) for id in stored_counts])
+        counts = {}
+        for key, count in cache.get_many(keys.keys()).iteritems():
+            counts[keys[key]] = count
+
+        for key, id in keys.iteritems():
+            if id in counts:
+                continue
+            # The changes of this process that weren't flushed yet are the
+            # only ones known past the stored count
+            count = max((stored_counts[id] or 0) + self._pending.get(id, 0), 0)
+            if cache.add(key, count, NODES_COUNT_EXPIRATION):
+                counts[id] = count
+            else:
+                current = cache.get(key)
+                counts[id] = count if current is None else current
+        return counts
+
+    def get(self, id, stored_count=0):
+        """Returns the current count, including the changes not flushed yet.
+        """
+        return self.get_many({id: stored_count})[id]
+
+    def flush(self):
+        """Applies the pending changes to the datastore. Returns False if
+        another thread is already flushing.
+        """
+        # Only one thread flushes at a time, the others keep buffering
+        if not self._flush_lock.acquire(False):
+            return False
+
+        try:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+
+            by_delta = {}
+            for id, delta in pending.iteritems():
+                if delta:
+                    by_delta.setdefault(delta, []).append(id)
+
+            for delta, ids in by_delta.iteritems():
+                try:
+                    self._update(ids, delta)
+                except Exception, e:
+                    logging.error("Failed to flush %s nodes count: %s" % \
+                                    (self.model_name, e))
+                    # Keep the changes for the next flush
+                    with self._lock:
+                        for id in ids:
+                            self._pending[id] = self._pending.get(id, 0) + delta
+                        self._schedule()
+
+            if pending:
+                try:
+                    self.flushed(pending.keys())
+                except Exception, e:
+                    logging.error("Failed to update after flushing %s nodes "
+                                  "count: %s" % (self.model_name, e))
+        finally:
+            self._flush_lock.release()
+        return True
+
+    def _update(self, ids, delta):
+        Model = self.model
+        updated = Model.objects.filter(id__in=ids).update(
+                        nodes_count=F('nodes_count') + delta)
+        if updated < len(ids):
+            existing = set(Model.objects.filter(id__in=ids).values_list(
+                                'id', flat=True))
+            for id in ids:
+                if id not in existing:
+                    self.missing(id, delta)
+
+    def missing(self, id, delta):
+        """Called for the ids that aren't stored yet.
+        """
+        logging.warning("Can't count nodes of missing %s %s" % \
+                            (self.model_name, id))
+
+    def flushed(self, ids):
+        """Called with the ids whose counts were just flushed.
+        """
+        pass
+
+
+class LocationNodesCounter(NodesCounter):
+
+    def missing(self, id, delta):
+        # Locations read from the GeoIP database are only stored once they
+        # have something to keep, like their nodes count.
+        location = self.model.from_geoip_database(id)
+        if location is None:
+            return super(LocationNodesCounter, self).missing(id, delta)
+        location.to_location(nodes_count=max(delta, 0)).save()
+
+
+class IPRangeNodesCounter(NodesCounter):
+    """Also keeps a list with the (id, nodes count) of the top_size networks
+    with the most nodes, which is updated with the counts of every flush.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.top_size = kwargs.pop('top_size', 100)
+        super(IPRangeNodesCounter, self).__init__(*args, **kwargs)
+
+    def _build_top(self):
+        top = list(self.model.objects.order_by('-nodes_count').values_list(
+                        'id', 'nodes_count')[:self.top_size])
+        cache.set(TOP_NETWORKS_CACHE_KEY, top, TOP_NETWORKS_EXPIRATION)
+        return top
+
+    def flushed(self, ids):
+        if not cache.add(TOP_NETWORKS_LOCK_KEY, True,
+                         TOP_NETWORKS_LOCK_EXPIRATION):
+            # Another process is changing the list, let the next read
+            # rebuild it
+            cache.delete(TOP_NETWORKS_CACHE_KEY)
+            return
+
+        try:
+            top = cache.get(TOP_NETWORKS_CACHE_KEY)
+            if top is None:
+                return
+
+            counts = dict(top)
+            counts.update(self._read_counts(ids))
+            top = sorted(counts.items(), key=lambda item: -item[1])
+            cache.set(TOP_NETWORKS_CACHE_KEY, top[:self.top_size],
+                      TOP_NETWORKS_EXPIRATION)
+        except Exception:
+            cache.delete(TOP_NETWORKS_CACHE_KEY)
+            raise
+        finally:
+            cache.delete(TOP_NETWORKS_LOCK_KEY)
+
+    def _read_counts(self, ids):
+        return self.model.objects.filter(id__in=ids).values_list(
+                    'id', 'nodes_count')
+
+    def top(self, count):
+        """Returns the (id, nodes count) of the count networks with the most
+        nodes. A network outside the list only gets in when its count
+        changes, so the list can be slightly off until it's rebuilt from the
+        table.
+        """
+        top = cache.get(TOP_NETWORKS_CACHE_KEY)
+        if top is None:
+            top = self._build_top()
+        top = top[:count]
+        counts = self.get_many(dict(top))
+        return [(id, counts[id]) for id, nodes_count in top]
+
+
+ip_range_counter = IPRangeNodesCounter('IPRange',
+        flush_interval=getattr(settings, 'NODES_COUNT_FLUSH_INTERVAL', 5),
+        top_size=getattr(settings, 'TOP_NETWORKS_SIZE', 100))
+location_counter = LocationNodesCounter('Location',
+        flush_interval=getattr(settings, 'NODES_COUNT_FLUSH_INTERVAL', 5))
+
+@atexit.register
+def flush_counters():
+    ip_range_counter.flush()
+    location_counter.flush()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##
+## Author: Adriano Monteiro Marques <adriano@umitproject.org>
+##
+## Copyright (C) 2011 S2S Network Consultoria e Tecnologia da Informacao LTDA
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU Affero General Public License as
+## published by the Free Software Foundation, either version 3 of the
+## License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Affero General Public License for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""Compact binary GeoIP database, compiled from the GeoLiteCity CSV files.
+
+The file is read through mmap, so every process on the host shares the same
+page-cached copy instead of keeping the tables in its own heap. Layout, all
+integers little-endian:
+
+  header     magic, format version, range count, location count and the
+             offsets of the three sections below
+  ranges     (start number, end number, location id), sorted by start number
+  locations  (id, lat, lon, country code, state region and string pool
+             offsets of city, zipcode, country name and full name), sorted
+             by id
+  strings    pool of distinct strings, each one prefixed by its length
+
+Latitudes and longitudes are stored as fixed-point integers, with the same
+4 decimal places the GeoLite files have.
+
+This module doesn't depend on django, so it can be used from the loading
+scripts.
+"""
+
+import csv
+import mmap
+import struct
+import decimal
+import logging
+
+
+MAGIC = 'ICMGEODB'
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct('<8sIIIIII')
+RANGE_RECORD = struct.Struct('<III')
+LOCATION_RECORD = struct.Struct('<Iii2s2sIIII')
+STRING_LENGTH = struct.Struct('<H')
+
+LAT_LON_SCALE = 10000
+
+# The GeoLite CSV files have a copyright line and a column names line
+CSV_HEADER_LINES = 2
+
+
+class GeoIPDatabaseError(Exception):
+    pass
+
+
+class StringPool(object):
+    """Stores each distinct string once. Offset 0 is always the empty string.
+    """
+    def __init__(self):
+        self.offsets = {'': 0}
+        self.data = [STRING_LENGTH.pack(0)]
+        self.size = STRING_LENGTH.size
+
+    def add(self, value):
+        value = (value or '').encode('utf-8')
+        offset = self.offsets.get(value)
+        if offset is None:
+            offset = self.size
+            self.offsets[value] = offset
+            self.data.append(STRING_LENGTH.pack(len(value)))
+            self.data.append(value)
+            self.size += STRING_LENGTH.size + len(value)
+        return offset
+
+    def getvalue(self):
+        return ''.join(self.data)
+
+
+def _read_csv(path, skip=CSV_HEADER_LINES, **kwargs):
+    f = open(path, 'rb')
+    try:
+        for i, row in enumerate(csv.reader(f, **kwargs)):
+            if i >= skip and row:
+                yield row
+    finally:
+        f.close()
+
+
+def _fixed_point(value):
+    return int(decimal.Decimal(value or '0') * LAT_LON_SCALE)
+
+
+def build_database(blocks_csv, locations_csv, output_path, country_names=None):
+    """Compiles the GeoLiteCity Blocks and Location CSV files into a binary
+    database at output_path.
+
+    country_names maps country codes to names, which are used to fill the
+    country name and full name the same way fill_geoips.py does for MySQL.
+    """
+    country_names = country_names or {}
+    strings = StringPool()
+
+    ranges = []
+    for row in _read_csv(blocks_csv):
+        start_number, end_number, location_id = [int(v) for v in row[:3]]
+        ranges.append((start_number, end_number, location_id))
+    ranges.sort()
+
+    locations = []
+    for row in _read_csv(locations_csv):
+        row = [v.decode('latin-1') for v in row]
+        id, country_code, state_region, city, zipcode, lat, lon = row[:7]
+        country_name = country_names.get(country_code, u'')
+        if city:
+            fullname = u"%s, %s" % (city, country_name)
+        else:
+            fullname = country_name
+        id = int(id)
+        locations.append((id, LOCATION_RECORD.pack(id,
+                                                   _fixed_point(lat),
+                                                   _fixed_point(lon),
+                                                   country_code.encode('ascii'),
+                                                   state_region.encode('ascii'),
+                                                   strings.add(city),
+                                                   strings.add(zipcode),
+                                                   strings.add(country_name),
+                                                   strings.add(fullname))))
+    locations.sort()
+
+    ranges_offset = HEADER.size
+    locations_offset = ranges_offset + len(ranges) * RANGE_RECORD.size
+    strings_offset = locations_offset + len(locations) * LOCATION_RECORD.size
+
+    f = open(output_path, 'wb')
+    try:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(ranges),
+                            len(locations), ranges_offset, locations_offset,
+                            strings_offset))
+        for record in ranges:
+            f.write(RANGE_RECORD.pack(*record))
+        for id, record in locations:
+            f.write(record)
+        f.write(strings.getvalue())
+    finally:
+        f.close()
+
+    return len(ranges), len(locations)
+
+
+class GeoIPDatabase(object):
+    """Read-only access to a database built with build_database.
+    """
+
+    def __init__(self, path):
+        f = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        if len(self._map) < HEADER.size:
+            raise GeoIPDatabaseError("%s is not a GeoIP database" % path)
+
+        (magic, version, self.range_count, self.location_count,
+         self._ranges_offset, self._locations_offset,
+         self._strings_offset) = HEADER.unpack_from(self._map, 0)
+
+        if magic != MAGIC:
+            raise GeoIPDatabaseError("%s is not a GeoIP database" % path)
+        if version != FORMAT_VERSION:
+            raise GeoIPDatabaseError("Unsupported GeoIP database version %s" %
+                                     version)
+
+    def close(self):
+        self._map.close()
+
+    def _find(self, record, offset, count, key):
+        """Returns the index of the last record whose first field is lower
+        or equal to key, or -1.
+        """
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key < record.unpack_from(self._map, offset + mid * record.size)[0]:
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo - 1
+
+    def _string(self, offset):
+        offset += self._strings_offset
+        length = STRING_LENGTH.unpack_from(self._map, offset)[0]
+        start = offset + STRING_LENGTH.size
+        return self._map[start:start + length].decode('utf-8')
+
+    def lookup(self, ip):
+        """Returns a (start number, end number, location id) tuple for the
+        range containing the given integer ip, or None.
+        """
+        i = self._find(RANGE_RECORD, self._ranges_offset, self.range_count, ip)
+        if i < 0:
+            return None
+
+        start_number, end_number, location_id = RANGE_RECORD.unpack_from(
+                self._map, self._ranges_offset + i * RANGE_RECORD.size)
+        if end_number < ip:
+            return None
+
+        return start_number, end_number, location_id
+
+    def location(self, id):
+        """Returns a dict with the fields of the given location, or None.
+        """
+        i = self._find(LOCATION_RECORD, self._locations_offset,
+                       self.location_count, id)
+        if i < 0:
+            return None
+
+        (location_id, lat, lon, country_code, state_region, city, zipcode,
+         country_name, fullname) = LOCATION_RECORD.unpack_from(
+                self._map, self._locations_offset + i * LOCATION_RECORD.size)
+        if location_id != id:
+            return None
+
+        return dict(id=location_id,
+                    fullname=self._string(fullname),
+                    country_name=self._string(country_name),
+                    country_code=country_code.rstrip('\x00'),
+                    state_region=state_region.rstrip('\x00'),
+                    city=self._string(city),
+                    zipcode=self._string(zipcode),
+                    lat=decimal.Decimal(lat) / LAT_LON_SCALE,
+                    lon=decimal.Decimal(lon) / LAT_LON_SCALE)
+
+
+_database = None
+_database_failed = False
+
+def get_database(path):
+    """Returns the process wide GeoIPDatabase for path, or None when there is
+    no usable database there. Opening is only tried once per process.
+    """
+    global _database, _database_failed
+    if _database is None and path and not _database_failed:
+        try:
+            _database = GeoIPDatabase(path)
+        except (IOError, ValueError, GeoIPDatabaseError), e:
+            logging.error("Failed to open the GeoIP database: %s" % e)
+            _database_failed = True
+    return _database
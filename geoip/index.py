@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##
+## Author: Adriano Monteiro Marques <adriano@umitproject.org>
+##
+## Copyright (C) 2011 S2S Network Consultoria e Tecnologia da Informacao LTDA
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU Affero General Public License as
+## published by the Free Software Foundation, either version 3 of the
+## License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Affero General Public License for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""In-process interval index for the IPRange table.
+
+The ranges are kept in sorted arrays (start number, end number, location id
+and range id) that are loaded once per worker, so resolving an IP is a bisect
+instead of a range query against MySQL. The arrays are never modified in
+place: every change builds a new snapshot and swaps it in, so readers always
+see a consistent index. Whenever the index can't answer, callers should fall
+back to the database.
+"""
+
+import time
+import logging
+import threading
+
+from array import array
+from bisect import bisect_right
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+IP_RANGE_INDEX_VERSION_KEY = "ip_range_index_version"
+IP_RANGE_INDEX_VERSION_EXPIRATION = 60*60*24 # 1 day
+INDEX_CHECK_INTERVAL = 60 # Seconds between checks for changes made elsewhere
+
+# 'I' is an unsigned int, enough for any IPv4 address in 4 bytes
+INDEX_TYPECODE = 'I'
+
+
+class IPRangeIndex(object):
+    """Read-only, array-backed interval index of IP ranges.
+
+    Changes made by other processes are noticed through a version stamp kept
+    in the cache, which is checked at most once every check_interval seconds.
+    """
+
+    def __init__(self, enabled=True, check_interval=INDEX_CHECK_INTERVAL):
+        self.enabled = enabled
+        self.check_interval = check_interval
+        self._snapshot = None
+        self._version = None
+        self._checked_at = 0
+        self._stale = False
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            return 0
+        return len(snapshot[0])
+
+    @staticmethod
+    def _build(rows):
+        """Receives (id, start_number, end_number, location_id) tuples sorted
+        by start_number and returns a new snapshot.
+        """
+        starts = array(INDEX_TYPECODE)
+        ends = array(INDEX_TYPECODE)
+        location_ids = array(INDEX_TYPECODE)
+        ids = array(INDEX_TYPECODE)
+
+        for id, start_number, end_number, location_id in rows:
+            starts.append(start_number)
+            ends.append(end_number)
+            location_ids.append(location_id)
+            ids.append(id)
+
+        return (starts, ends, location_ids, ids)
+
+    def load(self, rows=None):
+        """Loads the index, either from the given rows or from the IPRange
+        table, and atomically replaces the current snapshot.
+        """
+        version = cache.get(IP_RANGE_INDEX_VERSION_KEY)
+
+        if rows is None:
+            from geoip.models import IPRange
+            rows = IPRange.objects.order_by('start_number').values_list(
+                        'id', 'start_number', 'end_number',
+                        'location_id').iterator()
+        else:
+            rows = sorted(rows, key=lambda row: row[1])
+
+        snapshot = self._build(rows)
+
+        self._snapshot = snapshot
+        self._version = version
+        self._checked_at = time.time()
+
+    def invalidate(self):
+        """Signals every worker, including the current one, that the ranges
+        changed and the index must be reloaded.
+        """
+        self._stale = True
+        cache.set(IP_RANGE_INDEX_VERSION_KEY, time.time(),
+                  IP_RANGE_INDEX_VERSION_EXPIRATION)
+
+    def _refresh(self):
+        now = time.time()
+        if self._snapshot is not None and not self._stale and \
+           now - self._checked_at < self.check_interval:
+            return
+
+        # Only one thread reloads the index, the others keep using the
+        # current snapshot (or the database) meanwhile.
+        if not self._lock.acquire(False):
+            return
+
+        try:
+            self._checked_at = now
+            version = cache.get(IP_RANGE_INDEX_VERSION_KEY)
+            if self._snapshot is None or self._stale or \
+               (version is not None and version != self._version):
+                self._stale = False
+                self.load()
+        except Exception, e:
+            logging.error("Failed to load the IP range index: %s" % e)
+        finally:
+            self._lock.release()
+
+    def lookup(self, ip):
+        """Returns a (range id, location id) tuple for the range containing
+        the given integer ip, or None when the index can't tell.
+        """
+        if not self.enabled:
+            return None
+
+        self._refresh()
+
+        snapshot = self._snapshot
+        if snapshot is None:
+            return None
+
+        starts, ends, location_ids, ids = snapshot
+        i = bisect_right(starts, ip) - 1
+        if i < 0 or ends[i] < ip:
+            return None
+
+        return ids[i], location_ids[i]
+
+    def lookup_many(self, ips):
+        """Same as lookup, for a list of integer ips sorted in ascending
+        order. The ranges are resolved in a single forward sweep over the
+        index, so each bisect only looks past the previous match.
+        """
+        if not self.enabled:
+            return [None] * len(ips)
+
+        self._refresh()
+
+        snapshot = self._snapshot
+        if snapshot is None:
+            return [None] * len(ips)
+
+        starts, ends, location_ids, ids = snapshot
+        entries = []
+        lo = 0
+        for ip in ips:
+            i = bisect_right(starts, ip, lo) - 1
+            if i < 0 or ends[i] < ip:
+                entries.append(None)
+            else:
+                entries.append((ids[i], location_ids[i]))
+            lo = max(i, 0)
+        return entries
+
+    def add(self, id, start_number, end_number, location_id):
+        """Adds a newly created range to the local snapshot. Other workers
+        don't need to know about it, since a miss in their index falls back
+        to the database anyway.
+        """
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None:
+                return
+
+            i = bisect_right(snapshot[0], start_number)
+            values = (start_number, end_number, location_id, id)
+            self._snapshot = tuple(
+                    column[:i] + array(INDEX_TYPECODE, [value]) + column[i:]
+                    for column, value in zip(snapshot, values))
+
+
+ip_range_index = IPRangeIndex(enabled=getattr(settings, 'GEOIP_RANGE_INDEX',
+                                              True))
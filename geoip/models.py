@@ -27,6 +27,9 @@ from django.conf import settings
 
 from dbextra.fields import ListField
 from geoip.ip import convert_ip, convert_int_ip
+from geoip.index import ip_range_index
+from geoip.geodb import get_database
+from geoip.counters import ip_range_counter, location_counter
 
 CACHE_EXPIRATION = 60*60 # 1 hour, since this doesn't change any often
 LOCATION_CACHE_KEY = "location_%s"
@@ -46,6 +49,11 @@ BAN_FLAGS = dict(
 )
 
 
+def geoip_database():
+    """Returns the binary GeoIP database, if there is one configured."""
+    return get_database(settings.GEOIP_DATABASE)
+
+
 class LocationAggregation(models.Model):
     lat = models.DecimalField(decimal_places=20, max_digits=23) # Base Latitude
     lon = models.DecimalField(decimal_places=20, max_digits=23) # Base Longitude
@@ -128,6 +136,30 @@ class LocationNamesAggregation(models.Model):
         return self.prefix
 
 
+class GeoLocation(object):
+    """Location read from the GeoIP database. It only has the fields kept in
+    there, so it's never saved: changes go to the stored Location, from
+    Location.get_stored_location.
+    """
+
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+    def __unicode__(self):
+        return "%s, %s" % (self.city, self.country_name) \
+                                if self.city != '' else self.country_code
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+    def to_location(self, **kwargs):
+        """Returns a new, unsaved Location with the same fields.
+        """
+        fields = dict(self.__dict__)
+        fields.update(kwargs)
+        return Location(**fields)
+
+
 class Location(models.Model):
     ip_range_ids = ListField(py_type=int)
     fullname = models.CharField(max_length=300, blank=True, null=True,
@@ -165,7 +197,7 @@ class Location(models.Model):
     
     @staticmethod
     def add_ip_range(ip_range):
-        location = ip_range.location
+        location = Location.get_stored_location(ip_range.location_id)
         if location:
             if ip_range.id in location.ip_range_ids:
                 return location
@@ -186,9 +218,6 @@ class Location(models.Model):
         
         return location
 
-    def save(self, *args, **kwargs):
-        super(Location, self).save(*args, **kwargs)
-
     def generateAggregations(self):
         # Create proper aggregation for the current lat/lon
         LocationAggregation.add_location(self)
@@ -221,13 +250,86 @@ class Location(models.Model):
         
         return locations
 
+    @staticmethod
+    def from_geoip_database(id):
+        database = geoip_database()
+        if database is None:
+            return None
+
+        fields = database.location(id)
+        if fields is None:
+            return None
+
+        return GeoLocation(**fields)
+
     @staticmethod
     def get_location_or_unknown(id=0):
+        location = Location.from_geoip_database(id)
+        if location is not None:
+            return location
+
         try:
             return Location.objects.get(id=id)
         except Location.DoesNotExist:
             return UNKNOWN_LOCATION
 
+    @staticmethod
+    def get_stored_location(id):
+        """Returns the stored Location, to be changed and saved. Locations
+        only in the GeoIP database come as a new Location, stored when saved.
+        """
+        try:
+            return Location.objects.get(id=id)
+        except Location.DoesNotExist:
+            pass
+
+        location = Location.from_geoip_database(id)
+        if location is not None:
+            return location.to_location()
+        return None
+
+    @staticmethod
+    def get_cached_location(id):
+        key = LOCATION_CACHE_KEY % id
+        location = cache.get(key, False)
+        if not location:
+            location = Location.get_location_or_unknown(id)
+            cache.set(key, location, CACHE_EXPIRATION)
+        return location
+
+    @staticmethod
+    def get_cached_locations(ids):
+        """Returns a dict mapping each of the given ids to its location, using
+        one cache multi-get and one datastore query for the cache misses.
+        """
+        ids = set(ids)
+        cached = cache.get_many([LOCATION_CACHE_KEY % id for id in ids])
+
+        locations = {}
+        missing = []
+        for id in ids:
+            location = cached.get(LOCATION_CACHE_KEY % id)
+            if location:
+                locations[id] = location
+                continue
+
+            location = Location.from_geoip_database(id)
+            if location is not None:
+                locations[id] = location
+            else:
+                missing.append(id)
+
+        if missing:
+            stored = Location.objects.in_bulk(missing)
+            for id in missing:
+                locations[id] = stored.get(id, UNKNOWN_LOCATION)
+
+        cache.set_many(dict((LOCATION_CACHE_KEY % id, locations[id])
+                            for id in ids
+                            if LOCATION_CACHE_KEY % id not in cached),
+                       CACHE_EXPIRATION)
+        return locations
+
 
 try:
     UNKNOWN_LOCATION = Location.objects.get_or_create(fullname='Unknown',
@@ -280,6 +382,12 @@ class IPRange(models.Model):
     banned = models.BooleanField(default=False)
     ban_flags = models.IntegerField(default=0)
 
+    def __init__(self, *args, **kwargs):
+        super(IPRange, self).__init__(*args, **kwargs)
+        # Keep the indexed state as loaded, so that we only refresh the
+        # ip_range_index when one of its fields actually changes.
+        self._indexed_state = self._index_state()
+
     def __unicode__(self):
         return "%s - %s" % (convert_int_ip(self.start_number),
                             convert_int_ip(self.end_number))
@@ -302,7 +410,7 @@ class IPRange(models.Model):
             banet.iprange_id = self.id
             banet.start_number = self.start_number
             banet.end_number = self.end_number
-            banet.nodes_count = self.nodes_count # the amount of nodes at the moment of the ban
+            banet.nodes_count = ip_range_counter.get(self.id, self.nodes_count) # the amount of nodes at the moment of the ban
             banet.flags = flags
 
         banet.save()
@@ -321,6 +429,14 @@ class IPRange(models.Model):
         if type(ip) != type(0):
             ip = convert_ip(ip)
 
+        entry = ip_range_index.lookup(ip)
+        if entry is not None:
+            try:
+                return IPRange.get_cached_range(entry[0])
+            except IPRange.DoesNotExist:
+                # The range is gone, the index must be reloaded.
+                ip_range_index.invalidate()
+
         try:
             iprange = IPRange.objects.filter(
                 start_number__lte=ip).order_by('-start_number')[0]
@@ -338,14 +454,88 @@ class IPRange(models.Model):
                                                  start_number=ip,
                                                  end_number=ip)[0]
 
+    @staticmethod
+    def get_cached_range(id):
+        key = IP_RANGE_CACHE_KEY % id
+        iprange = cache.get(key, False)
+        if not iprange:
+            iprange = IPRange.objects.get(id=id)
+            cache.set(key, iprange, CACHE_EXPIRATION)
+        return iprange
+
+    @staticmethod
+    def ip_location_id(ip):
+        """Returns only the location id for the given ip. This is answered
+        from ip_range_index or the GeoIP database without going to the
+        datastore whenever possible.
+        """
+        if type(ip) != type(0):
+            ip = convert_ip(ip)
+
+        entry = ip_range_index.lookup(ip)
+        if entry is not None:
+            return entry[1]
+
+        database = geoip_database()
+        if database is not None:
+            entry = database.lookup(ip)
+            if entry is not None:
+                return entry[2]
+
+        return IPRange.ip_location(ip).location_id
+
+    @staticmethod
+    def locate_many(ips):
+        """Geolocates a whole list of ips at once, as the hops of a traceroute.
+
+        The ips are sorted and resolved in a single sweep over ip_range_index,
+        and all the distinct locations are fetched with one multi-get. Returns
+        a dict mapping each of the given ips to its location.
+        """
+        int_ips = sorted(set((ip if type(ip) == type(0) else convert_ip(ip), ip)
+                             for ip in ips))
+
+        entries = ip_range_index.lookup_many([int_ip for int_ip, ip in int_ips])
+        database = geoip_database()
+
+        location_ids = {}
+        for (int_ip, ip), entry in zip(int_ips, entries):
+            if entry is not None:
+                location_ids[ip] = entry[1]
+                continue
+
+            if database is not None:
+                entry = database.lookup(int_ip)
+                if entry is not None:
+                    location_ids[ip] = entry[2]
+                    continue
+
+            # Not covered by any known range yet
+            location_ids[ip] = IPRange.ip_location(int_ip).location_id
+
+        locations = Location.get_cached_locations(location_ids.values())
+        return dict((ip, locations[location_id])
+                    for ip, location_id in location_ids.items())
+
+    @staticmethod
+    def top_networks(count):
+        """Returns the count networks with the most nodes, from the list kept
+        by ip_range_counter.
+        """
+        top = ip_range_counter.top(count)
+        ranges = IPRange.objects.in_bulk([id for id, nodes_count in top])
+
+        networks = []
+        for id, nodes_count in top:
+            iprange = ranges.get(id)
+            if iprange is not None:
+                iprange.nodes_count = nodes_count
+                networks.append(iprange)
+        return networks
+
     @property
     def location(self):
-        key = LOCATION_CACHE_KEY % self.location_id
-        location = cache.get(key, False)
-        if not location:
-            location = Location.get_location_or_unknown(self.location_id)
-            cache.set(key, location, CACHE_EXPIRATION)
-        return location
+        return Location.get_cached_location(self.location_id)
 
     @property
     def logged_agents(self):
@@ -360,14 +550,34 @@ class IPRange(models.Model):
             cache.set(key, logged_agents, CACHE_EXPIRATION)
         return logged_agents
 
+    def _index_state(self):
+        return (self.start_number, self.end_number, self.location_id)
+
     def save(self, *args, **kwargs):
         new = self.id is None
 
         super(IPRange, self).save(*args, **kwargs)
 
+        # Saves that only touch nodes_count or the ban flags don't change the
+        # index, so we don't force every worker to reload it for those.
+        if new:
+            ip_range_index.add(self.id, self.start_number, self.end_number,
+                               self.location_id)
+        elif getattr(self, '_indexed_state', None) != self._index_state():
+            ip_range_index.invalidate()
+        self._indexed_state = self._index_state()
+        if not new:
+            # Logins check the ban flags on the cached range
+            cache.delete(IP_RANGE_CACHE_KEY % self.id)
+
         #if new:
         Location.add_ip_range(self)
 
+    def delete(self, *args, **kwargs):
+        cache.delete(IP_RANGE_CACHE_KEY % self.id)
+        super(IPRange, self).delete(*args, **kwargs)
+        ip_range_index.invalidate()
+
     def dump(self):
         return dict(
                     start_ip=convert_int_ip(self.start_number),
@@ -14,3 +14,205 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+from geoip.index import IPRangeIndex
+
+
+class IPRangeIndexTest(TestCase):
+    def setUp(self):
+        self.index = IPRangeIndex(check_interval=60*60)
+        self.index.load([(3, 300, 399, 30),
+                         (1, 100, 199, 10),
+                         (2, 200, 249, 20)])
+
+    def test_lookup(self):
+        self.assertEqual(self.index.lookup(100), (1, 10))
+        self.assertEqual(self.index.lookup(150), (1, 10))
+        self.assertEqual(self.index.lookup(399), (3, 30))
+
+    def test_lookup_outside_ranges(self):
+        self.assertEqual(self.index.lookup(50), None)
+        self.assertEqual(self.index.lookup(250), None)
+        self.assertEqual(self.index.lookup(400), None)
+
+    def test_lookup_many(self):
+        self.assertEqual(self.index.lookup_many([50, 100, 150, 250, 300, 500]),
+                         [None, (1, 10), (1, 10), None, (3, 30), None])
+
+    def test_add(self):
+        self.index.add(4, 250, 250, 40)
+        self.assertEqual(len(self.index), 4)
+        self.assertEqual(self.index.lookup(250), (4, 40))
+        self.assertEqual(self.index.lookup(300), (3, 30))
+
+
+import os
+import shutil
+import tempfile
+
+from geoip.geodb import build_database, GeoIPDatabase
+from geoip.models import GeoLocation, Location
+
+
+class GeoIPDatabaseTest(TestCase):
+    BLOCKS = ('Copyright (c) 2012 MaxMind LLC.  All Rights Reserved.\n'
+              'startIpNum,endIpNum,locId\n'
+              '"16777472","16778239","49"\n'
+              '"16777216","16777471","17"\n')
+    LOCATIONS = ('Copyright (c) 2012 MaxMind LLC.  All Rights Reserved.\n'
+                 'locId,country,region,city,postalCode,latitude,longitude,'
+                 'metroCode,areaCode\n'
+                 '49,"CN","","","",35.0000,105.0000,,\n'
+                 '17,"AU","07","Melbourne","",-37.8139,144.9634,,\n')
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        blocks = os.path.join(self.tmp_dir, 'blocks.csv')
+        locations = os.path.join(self.tmp_dir, 'locations.csv')
+        open(blocks, 'w').write(self.BLOCKS)
+        open(locations, 'w').write(self.LOCATIONS)
+
+        path = os.path.join(self.tmp_dir, 'geoip.dat')
+        build_database(blocks, locations, path,
+                       {'AU': u'Australia', 'CN': u'China'})
+        self.database = GeoIPDatabase(path)
+
+    def tearDown(self):
+        self.database.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_lookup(self):
+        self.assertEqual(self.database.lookup(16777216), (16777216, 16777471, 17))
+        self.assertEqual(self.database.lookup(16778239), (16777472, 16778239, 49))
+        self.assertEqual(self.database.lookup(16777215), None)
+        self.assertEqual(self.database.lookup(16778240), None)
+
+    def test_location(self):
+        location = self.database.location(17)
+        self.assertEqual(location['fullname'], u'Melbourne, Australia')
+        self.assertEqual(location['country_code'], 'AU')
+        self.assertEqual(location['state_region'], '07')
+        self.assertEqual(str(location['lat']), '-37.8139')
+        self.assertEqual(self.database.location(49)['fullname'], u'China')
+        self.assertEqual(self.database.location(18), None)
+
+    def test_geo_location(self):
+        location = GeoLocation(**self.database.location(17))
+        self.assertEqual(unicode(location), u'Melbourne, Australia')
+
+        stored = location.to_location(nodes_count=3)
+        self.assertTrue(isinstance(stored, Location))
+        self.assertEqual(stored.id, 17)
+        self.assertEqual(stored.city, u'Melbourne')
+        self.assertEqual(stored.nodes_count, 3)
+        self.assertEqual(stored.ip_range_ids, [])
+
+
+from django.core.cache import get_cache
+
+from geoip import counters
+from geoip.counters import NodesCounter, IPRangeNodesCounter
+
+
+class NodesCounterTest(TestCase):
+    def setUp(self):
+        self._cache = counters.cache
+        counters.cache = get_cache('django.core.cache.backends.locmem.LocMemCache')
+        counters.cache.clear()
+        # Long enough for the timer not to flush during the test
+        self.counter = NodesCounter('IPRange', flush_interval=600)
+        # Another process sharing the cache
+        self.other = NodesCounter('IPRange', flush_interval=600)
+        self.counters = [self.counter, self.other]
+        self.updates = []
+        for counter in self.counters:
+            counter._update = lambda ids, delta: self.updates.append(
+                                    (sorted(ids), delta))
+
+    def tearDown(self):
+        for counter in self.counters:
+            if counter._timer is not None:
+                counter._timer.cancel()
+                counter._timer.join()
+        counters.cache = self._cache
+
+    def test_shared_counts(self):
+        self.counter.add(1)
+        self.assertEqual(self.counter.get(1, 10), 11)
+        self.other.add(1)
+        self.other.add(1, -1)
+        self.other.add(1)
+        self.assertEqual(self.counter.get(1, 10), 12)
+        self.assertEqual(self.other.get(1, 10), 12)
+
+    def test_timed_flush(self):
+        self.counter.add(1)
+        self.counter.add(2, 2)
+        self.counter.add(3)
+        timer = self.counter._timer
+        self.assertTrue(timer is not None)
+        timer.cancel()
+
+        self.counter._timed_flush()
+        self.assertEqual(sorted(self.updates), [([1, 3], 1), ([2], 2)])
+        self.assertEqual(self.counter._pending, {})
+        self.assertTrue(self.counter._timer is None)
+
+    def test_failed_flush_keeps_changes(self):
+        def update(ids, delta):
+            raise IOError("unavailable")
+        self.counter._update = update
+
+        self.counter.add(1)
+        self.counter.flush()
+        self.assertEqual(self.counter._pending, {1: 1})
+        self.assertTrue(self.counter._timer is not None)
+
+    def test_max_pending(self):
+        self.counter.max_pending = 2
+        self.counter.add(1)
+        self.assertEqual(self.updates, [])
+        self.counter.add(2)
+        self.assertEqual(sorted(self.updates), [([1, 2], 1)])
+
+    def test_top_networks(self):
+        counter = IPRangeNodesCounter('IPRange', flush_interval=600, top_size=2)
+        self.counters.append(counter)
+        counter._update = lambda ids, delta: None
+        counter._read_counts = lambda ids: [(3, 50)]
+        counters.cache.set(counters.TOP_NETWORKS_CACHE_KEY, [(1, 20), (2, 10)])
+
+        counter.add(3, 40)
+        counter.flush()
+        self.assertEqual(counters.cache.get(counters.TOP_NETWORKS_CACHE_KEY),
+                         [(3, 50), (1, 20)])
+
+        # Another process is changing the list
+        counters.cache.add(counters.TOP_NETWORKS_LOCK_KEY, True)
+        counter.add(3)
+        counter.flush()
+        self.assertEqual(counters.cache.get(counters.TOP_NETWORKS_CACHE_KEY),
+                         None)
+
+
+from geoip import models
+from geoip.models import IPRange, IP_RANGE_CACHE_KEY
+from icm_utils.testing import PatchingTestCase
+
+
+class IPLocationTest(PatchingTestCase):
+    def setUp(self):
+        super(IPLocationTest, self).setUp()
+        self.patch_cache(models)
+        index = IPRangeIndex(check_interval=60*60)
+        index.load([(1, 100, 199, 10)])
+        self.patch(models, 'ip_range_index', index)
+
+    def test_index_hit_uses_cached_range(self):
+        iprange = IPRange(id=1, location_id=10, start_number=100,
+                          end_number=199)
+        models.cache.set(IP_RANGE_CACHE_KEY % 1, iprange)
+        # Going to the datastore would fail, there is none in the tests
+        self.assertEqual(IPRange.ip_location(150).id, 1)
+        self.assertEqual(IPRange.ip_location_id(150), 10)
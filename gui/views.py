@@ -27,9 +27,12 @@ import decimal
 
 import simplejson as json
 
+from django.conf import settings
 from django.shortcuts import render_to_response
-from django.http import HttpResponse, Http404, HttpResponseRedirect
-from django.views.decorators.cache import cache_page
+from django.http import HttpResponse, Http404, HttpResponseRedirect, \
+    HttpResponseNotModified
+from django.views.decorators.cache import cache_page, never_cache
+from django.utils.http import parse_etags, quote_etag
 from django.shortcuts import get_object_or_404
 from django.template import RequestContext
 from django.contrib import messages
@@ -40,6 +43,8 @@ from gui.decorators import staff_member_required
 from geoip.models import Location
 from suggestions.models import WebsiteSuggestion, ServiceSuggestion
 from events.models import Event, TargetType, EventType
+from events.feed import active_events_feed
+from events.changes import event_changes
 from reports.models import WebsiteReport
 from notificationsystem.system import NotificationSystem
 from filetransfers.api import serve_file
@@ -59,22 +64,57 @@ def home(request):
 def map(request):
     initialEvents = Event.get_active_events_as_json(SHOW_EVENT_LIMIT)
     return render_to_response('notificationsystem/map.html',
-                              {'initial_events': initialEvents},
+                              {'initial_events': initialEvents,
+                               'realtime_stream_url': settings.REALTIME_STREAM_URL},
                               context_instance=RequestContext(request))
 
 
 def realtimebox(request):
-    initialEvents = Events.get_active_events_as_json(SHOW_EVENT_LIMIT)
+    initialEvents = Event.get_active_events_as_json(SHOW_EVENT_LIMIT)
     return render_to_response('notificationsystem/realtimebox.html',
                               {'initial_events': initialEvents},
                               context_instance=RequestContext(request))
 
 
+@never_cache
 def poll_active_events(request):
-    """Returns json response of new events to AJAX caller.
+    """Returns json response of new events to AJAX caller, or 304 when the
+    events in the caller's If-None-Match ETag didn't change.
     """
-    events = Event.get_active_events_as_json(SHOW_EVENT_LIMIT)
-    return HttpResponse(events)
+    etags = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+    etag, events = active_events_feed.get(SHOW_EVENT_LIMIT,
+                                          etags[0] if etags else None)
+    if events is None:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(events, mimetype='application/json')
+    response['ETag'] = quote_etag(etag)
+    return response
+
+
+@never_cache
+def poll_event_changes(request):
+    """Returns the events changed after the version in the cursor parameter,
+    along with the cursor for the next poll. When the cursor is missing or
+    too old, reset is set and all the active events are returned instead.
+    """
+    try:
+        cursor = int(request.GET['cursor'])
+    except (KeyError, ValueError):
+        cursor = None
+
+    version, changes = event_changes.since(cursor)
+    if changes is None:
+        etag, events = active_events_feed.get(SHOW_EVENT_LIMIT)
+        reset = 'true'
+    else:
+        events = '[%s]' % ','.join(changes)
+        reset = 'false'
+
+    # The events are already serialized
+    return HttpResponse('{"cursor": %d, "reset": %s, "events": %s}' % \
+                            (version, reset, events),
+                        mimetype='application/json')
 
 
 def event(request, event_id):
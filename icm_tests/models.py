@@ -21,11 +21,12 @@
 ##
 
 from django.db import models
-from django.db.models.signals import pre_delete
+from django.db.models.signals import pre_delete, post_save, post_delete
 from django.dispatch import receiver
 
 from dbextra.fields import ListField
 from geoip.models import Location
+from versions.models import invalidate_version_headers
 
 
 class Test(models.Model):
@@ -419,3 +420,7 @@ SERVICE_TESTS_AGGREGATION_MODELS = {
 
 ALL_TESTS_AGGREGATION_MODELS = WEBSITE_TESTS_AGGREGATION_MODELS.values() + \
                                SERVICE_TESTS_AGGREGATION_MODELS.values()
+
+for Model in ALL_TESTS_AGGREGATION_MODELS:
+    post_save.connect(invalidate_version_headers, sender=Model)
+    post_delete.connect(invalidate_version_headers, sender=Model)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##
+## Author: Adriano Monteiro Marques <adriano@umitproject.org>
+##
+## Copyright (C) 2011 S2S Network Consultoria e Tecnologia da Informacao LTDA
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU Affero General Public License as
+## published by the Free Software Foundation, either version 3 of the
+## License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Affero General Public License for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+from django.core.cache import get_cache
+from django.test import TestCase
+
+
+LOCMEM_CACHE = 'django.core.cache.backends.locmem.LocMemCache'
+
+
+class PatchingTestCase(TestCase):
+    """TestCase that replaces attributes of modules, classes or objects for
+    the duration of each test, and puts the originals back afterwards.
+    """
+
+    def setUp(self):
+        self._patched = []
+
+    def tearDown(self):
+        while self._patched:
+            obj, name, original = self._patched.pop()
+            setattr(obj, name, original)
+
+    def patch(self, obj, name, value):
+        # Taken from __dict__ so static methods are put back as they were
+        if isinstance(obj, type):
+            original = obj.__dict__[name]
+        else:
+            original = getattr(obj, name)
+        self._patched.append((obj, name, original))
+        setattr(obj, name, value)
+
+    def patch_cache(self, module):
+        """Gives the module an empty local memory cache instead of memcache.
+        """
+        cache = get_cache(LOCMEM_CACHE)
+        cache.clear()
+        self.patch(module, 'cache', cache)
+        return cache
@@ -88,26 +88,25 @@ function createEventSummaryDiv(event, show_all_countries) {
 }
 
 function receiveEvents(){
-	/*
-	var channel = new goog.appengine.Channel(token);
-    var handler = {
-        'onopen': onMapOpened,
-        'onmessage': onMapMessage,
-        'onerror': onMapError,
-        'onclose': function() {}
-    };
-    var socket = channel.open(handler);
-    socket.onopen = onMapOpened;
-    socket.onmessage = onMapMessage;
-    socket.onerror = onMapError;*/
+    // The stream is served by the realtime hub, when there is one
+    if (window.EventSource && window.REALTIME_STREAM_URL) {
+        var source = new EventSource(REALTIME_STREAM_URL + "/stream/map");
+        source.onopen = onMapOpened;
+        source.onmessage = onMapMessage;
+        source.onerror = onMapError;
+        return;
+    }
 
     $.ajax({
         url: "/events/poll",
         dataType: "html",
-        type: "POST",
-        success: function(data){
-            updateInitialMapEvents({data: data});
-            updateInitialRealTimeEvents({data: data});
+        type: "GET",
+        ifModified: true, // sends the last ETag, the server answers 304 if unchanged
+        success: function(data, status){
+            if (status != "notmodified") {
+                updateInitialMapEvents({data: data});
+                updateInitialRealTimeEvents({data: data});
+            }
             setTimeout('receiveEvents()', 60000); //poll again after 60 sec.
         },
         error: function(data){
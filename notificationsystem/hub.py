@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##
+## Author: Adriano Monteiro Marques <adriano@umitproject.org>
+##
+## Copyright (C) 2011 S2S Network Consultoria e Tecnologia da Informacao LTDA
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU Affero General Public License as
+## published by the Free Software Foundation, either version 3 of the
+## License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Affero General Public License for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+
+"""Publish/subscribe hub for the realtime event streams, taking the place of
+the App Engine channels.
+
+The web processes only publish: HubClient sends each message, as a line of
+JSON, to the relay server through a local UNIX socket. The relay server, run
+with "manage.py realtimehub", is a single asyncore process. It numbers the
+messages, keeps the last backlog of each channel, and serves the browsers
+itself over HTTP, so an open stream costs a socket in the relay server
+instead of a WSGI worker:
+
+  /stream/<channel>  server-sent events, resumed from Last-Event-ID
+  /wait/<channel>    long poll for the messages after the since parameter
+
+The front-end web server is expected to proxy those to the relay server, at
+REALTIME_STREAM_URL. Django only serves the page.
+"""
+
+import os
+import cgi
+import time
+import socket
+import logging
+import asyncore
+import asynchat
+import threading
+from collections import deque
+
+import simplejson as json
+
+from django.conf import settings
+
+
+# Channels open to the browsers
+REALTIME_CHANNELS = ('map', 'realtimebox')
+
+# Requests bigger than this are dropped
+MAX_REQUEST_SIZE = 8192
+# Connections with more unsent data than this are too slow, and dropped
+MAX_PENDING_OUTPUT = 256
+
+
+class Channel(object):
+
+    def __init__(self, backlog):
+        self.messages = deque(maxlen=backlog)
+        self.last_id = 0
+        # Id of the latest message dropped from the backlog
+        self.dropped_id = 0
+
+    def append(self, id, message):
+        """Adds the message, unless its id isn't past the last one, like a
+        message relayed again after a reconnection.
+        """
+        if id <= self.last_id:
+            return False
+        if len(self.messages) == self.messages.maxlen:
+            self.dropped_id = self.messages[0][0]
+        self.messages.append((id, message))
+        self.last_id = id
+        return True
+
+    def since(self, since):
+        """Returns the messages after since. Callers that fell behind the
+        backlog get all of it, and ids from another hub start from the
+        latest message.
+        """
+        if since is None or since > self.last_id:
+            since = self.last_id
+        elif since < self.dropped_id:
+            since = self.dropped_id
+        return since, [message for message in self.messages
+                       if message[0] > since]
+
+
+class HubClient(object):
+    """Publishes messages through the relay server listening on path.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._publisher = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        return sock
+
+    def publish(self, name, message):
+        # Only the relay server numbers the messages, so messages it can't
+        # get are dropped; the browsers catch up with the next poll of the
+        # feed.
+        line = "%s\n" % json.dumps([name, message])
+        with self._lock:
+            try:
+                if self._publisher is None:
+                    self._publisher = self._connect()
+                self._publisher.sendall(line)
+            except socket.error, e:
+                logging.error("Dropped a message for the realtime hub at %s: "
+                              "%s" % (self.path, e))
+                self._publisher = None
+
+
+class NullHubClient(object):
+    """Used when there's no relay server, the browsers only poll.
+    """
+
+    def publish(self, name, message):
+        pass
+
+
+def _get_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class PublisherHandler(asynchat.async_chat):
+    """Connection of a web process, sending one [name, message] per line.
+    """
+
+    def __init__(self, sock, server):
+        asynchat.async_chat.__init__(self, sock, map=server.map)
+        self.server = server
+        self.buffer = []
+        self.set_terminator("\n")
+
+    def collect_incoming_data(self, data):
+        self.buffer.append(data)
+
+    def found_terminator(self):
+        line = ''.join(self.buffer)
+        self.buffer = []
+        try:
+            name, message = json.loads(line)
+        except ValueError:
+            logging.warning("Invalid message for the realtime hub: %r" % line)
+            return
+        self.server.relay(name, message)
+
+    def handle_error(self):
+        logging.exception("Realtime hub publisher failed")
+        self.close()
+
+
+class BrowserHandler(asynchat.async_chat):
+    """HTTP connection of a browser, either a stream or a long poll.
+    """
+
+    def __init__(self, sock, server):
+        asynchat.async_chat.__init__(self, sock, map=server.map)
+        self.server = server
+        self.request = []
+        self.request_size = 0
+        self.channel = None
+        self.streaming = False
+        self.deadline = None
+        self.keepalive_at = None
+        self.set_terminator("\r\n\r\n")
+
+    def collect_incoming_data(self, data):
+        if self.request is None:
+            return
+        self.request_size += len(data)
+        if self.request_size > MAX_REQUEST_SIZE:
+            self.close()
+            return
+        self.request.append(data)
+
+    def found_terminator(self):
+        # Nothing else is read from the browser
+        self.set_terminator(None)
+        lines = ''.join(self.request).split("\r\n")
+        self.request = None
+
+        try:
+            method, target, version = lines[0].split()
+        except ValueError:
+            return self.respond(400, "Bad Request")
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        path, _, query = target.partition('?')
+        parts = path.strip('/').split('/')
+        if method != 'GET':
+            return self.respond(405, "Method Not Allowed")
+        if len(parts) != 2 or parts[0] not in ('stream', 'wait') or \
+           parts[1] not in self.server.channels:
+            return self.respond(404, "Not Found")
+
+        since = cgi.parse_qs(query).get('since', [None])[0]
+        since = _get_int(headers.get('last-event-id', since))
+        if parts[0] == 'stream':
+            self.server.stream(self, parts[1], since)
+        else:
+            self.server.wait(self, parts[1], since)
+
+    def respond(self, status, reason, content_type='text/plain', body=''):
+        self.push("HTTP/1.1 %d %s\r\n"
+                  "Content-Type: %s\r\n"
+                  "Content-Length: %d\r\n"
+                  "Cache-Control: no-cache\r\n"
+                  "Connection: close\r\n\r\n%s" % \
+                      (status, reason, content_type, len(body), body))
+        self.close_when_done()
+
+    def start_stream(self, retry):
+        self.streaming = True
+        self.push("HTTP/1.1 200 OK\r\n"
+                  "Content-Type: text/event-stream\r\n"
+                  "Cache-Control: no-cache\r\n"
+                  "Connection: close\r\n\r\n"
+                  "retry: %d\n\n" % (retry * 1000))
+
+    def send_messages(self, last_id, messages):
+        """Sends messages, returning False once the connection is done.
+        """
+        if len(self.producer_fifo) > MAX_PENDING_OUTPUT:
+            self.close()
+            return False
+        if self.streaming:
+            for id, message in messages:
+                self.push("id: %d\ndata: %s\n\n" % (id, message))
+            return True
+
+        # The messages are already serialized
+        self.respond(200, "OK", 'application/json',
+                     '{"since": %d, "events": [%s]}' % \
+                         (last_id, ','.join([m for id, m in messages])))
+        return False
+
+    def tick(self, now, keepalive):
+        """Returns False once the connection is done.
+        """
+        if now >= self.deadline:
+            if self.streaming:
+                # The browser reconnects with the id of the last event
+                self.close_when_done()
+            else:
+                self.send_messages(self.server.channels[self.channel].last_id,
+                                   [])
+            return False
+        if self.streaming and now >= self.keepalive_at:
+            self.keepalive_at = now + keepalive
+            self.push(": keepalive\n\n")
+        return True
+
+    def handle_close(self):
+        self.server.unsubscribe(self)
+        self.close()
+
+    def handle_error(self):
+        logging.exception("Realtime hub browser connection failed")
+        self.server.unsubscribe(self)
+        self.close()
+
+
+class Listener(asyncore.dispatcher):
+
+    def __init__(self, server, family, address, handler_class):
+        asyncore.dispatcher.__init__(self, map=server.map)
+        self.server = server
+        self.handler_class = handler_class
+        self.create_socket(family, socket.SOCK_STREAM)
+        if family != socket.AF_UNIX:
+            self.set_reuse_addr()
+        self.bind(address)
+        self.listen(128)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            self.handler_class(pair[0], self.server)
+
+
+class RelayServer(object):
+    """Numbers the published messages and sends them to the browsers.
+    Publishers connect to the UNIX socket in path, browsers to address.
+    """
+
+    def __init__(self, path, address, channels=REALTIME_CHANNELS, backlog=100,
+                 stream_timeout=300, keepalive=15, retry=5, poll_timeout=30):
+        self.stream_timeout = stream_timeout
+        self.keepalive = keepalive
+        self.retry = retry
+        self.poll_timeout = poll_timeout
+        self.channels = dict([(name, Channel(backlog)) for name in channels])
+        self.subscribers = dict([(name, set()) for name in channels])
+        # Ids carry on past the ones handed out before a restart
+        self._next_id = int(time.time() * 1000)
+
+        self.map = {}
+        if os.path.exists(path):
+            os.unlink(path)
+        self.publishers = Listener(self, socket.AF_UNIX, path,
+                                   PublisherHandler)
+        self.browsers = Listener(self, socket.AF_INET, address,
+                                 BrowserHandler)
+
+    def relay(self, name, message):
+        channel = self.channels.get(name)
+        if channel is None:
+            return
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
+        self._next_id += 1
+        channel.append(self._next_id, message)
+        for handler in list(self.subscribers[name]):
+            if not handler.send_messages(self._next_id,
+                                         [(self._next_id, message)]):
+                self.unsubscribe(handler)
+
+    def subscribe(self, handler, name, timeout):
+        handler.channel = name
+        handler.deadline = time.time() + timeout
+        handler.keepalive_at = time.time() + self.keepalive
+        self.subscribers[name].add(handler)
+
+    def unsubscribe(self, handler):
+        if handler.channel is not None:
+            self.subscribers[handler.channel].discard(handler)
+
+    def stream(self, handler, name, since):
+        handler.start_stream(self.retry)
+        since, messages = self.channels[name].since(since)
+        handler.send_messages(since, messages)
+        self.subscribe(handler, name, self.stream_timeout)
+
+    def wait(self, handler, name, since):
+        since, messages = self.channels[name].since(since)
+        if messages:
+            handler.send_messages(self.channels[name].last_id, messages)
+        else:
+            self.subscribe(handler, name, self.poll_timeout)
+
+    def tick(self):
+        now = time.time()
+        for subscribers in self.subscribers.values():
+            for handler in list(subscribers):
+                if not handler.tick(now, self.keepalive):
+                    subscribers.discard(handler)
+
+    def poll(self, timeout=1.0):
+        asyncore.loop(timeout=timeout, map=self.map, count=1)
+        self.tick()
+
+    def serve_forever(self):
+        while True:
+            self.poll()
+
+    def close(self):
+        asyncore.close_all(map=self.map)
+
+
+def get_hub():
+    path = getattr(settings, 'REALTIME_HUB_SOCKET', None)
+    if path:
+        return HubClient(path)
+    return NullHubClient()
+
+
+hub = get_hub()
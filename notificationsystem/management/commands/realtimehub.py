@@ -0,0 +1,39 @@
+"""
+A management command which runs the relay server of the realtime hub.
+
+Takes the events published by the web processes on the UNIX socket in
+``settings.REALTIME_HUB_SOCKET`` and serves them to the browsers on
+``settings.REALTIME_HUB_ADDRESS``. See ``notificationsystem.hub``.
+
+"""
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+from django.core.management.base import CommandError
+
+from notificationsystem.hub import RelayServer
+
+
+class Command(NoArgsCommand):
+    help = "Run the relay server of the realtime event hub"
+
+    def handle_noargs(self, **options):
+        path = getattr(settings, 'REALTIME_HUB_SOCKET', None)
+        if not path:
+            raise CommandError("REALTIME_HUB_SOCKET isn't set")
+
+        address = tuple(settings.REALTIME_HUB_ADDRESS)
+        server = RelayServer(path, address,
+                             backlog=settings.REALTIME_HUB_BACKLOG,
+                             stream_timeout=settings.REALTIME_STREAM_TIMEOUT,
+                             keepalive=settings.REALTIME_STREAM_KEEPALIVE,
+                             retry=settings.REALTIME_STREAM_RETRY,
+                             poll_timeout=settings.REALTIME_LONG_POLL_TIMEOUT)
+        print "Realtime hub listening on %s and %s:%s" % \
+                ((path,) + address)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
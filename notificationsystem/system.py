@@ -25,11 +25,10 @@ import decimal
 
 import simplejson
 
-#TODO(orc.avs): implement channel equivalent with HTTP polling.
-#from google.appengine.api import channel
-
 from twitter.main import send_event_tweet
 from notificationsystem.views import send_event_email
+from events.changes import event_changes
+from notificationsystem.hub import hub
 
 class NotificationInterface:
     def eventReceived(self, event):
@@ -61,29 +60,29 @@ class NotificationSystem:
 
 class RealtimeBox(NotificationInterface):
     def eventReceived(self, event):
-	'''
         logging.info("event received on realtimebox")
         try:
             message = simplejson.dumps(event.get_dict(), use_decimal=True)
-            channel.send_message('realtimebox', message)
+            hub.publish('realtimebox', message)
         except Exception,ex:
             logging.error(ex)
-	'''
-	pass
 
 
 class RealtimeMap(NotificationInterface):
     def eventReceived(self, event):
-	'''
         logging.info("event received on realtimemap")
         try:
-            logging.info("%s,%s" % (event.lats[0], event.lons[0]))
             message = simplejson.dumps(event.get_dict(), use_decimal=True)
-            channel.send_message('map', message)
+            hub.publish('map', message)
         except Exception,ex:
             logging.error(ex)
-	'''
-	pass
+
+
+class RealtimeChanges(NotificationInterface):
+    """Feeds the event changes log read by the delta polls.
+    """
+    def eventReceived(self, event):
+        event_changes.record(event)
 
 
 class EmailNotification(NotificationInterface):
@@ -100,10 +99,12 @@ class TwitterNotification(NotificationInterface):
 
 realtimeBox = RealtimeBox()
 realtimeMap = RealtimeMap()
+realtimeChanges = RealtimeChanges()
 emailNotification = EmailNotification()
 twitterNotification = TwitterNotification()
 
 NotificationSystem.registerSubscriber(realtimeBox)
 NotificationSystem.registerSubscriber(realtimeMap)
+NotificationSystem.registerSubscriber(realtimeChanges)
 NotificationSystem.registerSubscriber(emailNotification)
 NotificationSystem.registerSubscriber(twitterNotification)
@@ -14,3 +14,106 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+import os
+import shutil
+import socket
+import tempfile
+
+import simplejson as json
+
+from notificationsystem.hub import Channel, HubClient, RelayServer
+
+
+class HubTest(TestCase):
+    def test_channel_backlog(self):
+        channel = Channel(2)
+        last_id, messages = channel.since(None)
+        self.assertEqual(messages, [])
+
+        for id, message in ((1, 'a'), (2, 'b'), (3, 'c')):
+            channel.append(id, message)
+        # Callers behind the backlog get all of it
+        messages = channel.since(last_id)[1]
+        self.assertEqual([m for id, m in messages], ['b', 'c'])
+        self.assertEqual(channel.since(3)[1], [])
+
+    def test_channel_ids_increase(self):
+        channel = Channel(10)
+        self.assertTrue(channel.append(5, 'a'))
+        self.assertFalse(channel.append(5, 'b'))
+        self.assertFalse(channel.append(3, 'c'))
+        self.assertTrue(channel.append(6, 'd'))
+        self.assertEqual(channel.last_id, 6)
+        self.assertEqual(channel.since(4)[1], [(5, 'a'), (6, 'd')])
+
+
+class RelayServerTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'hub.sock')
+        self.server = RelayServer(self.path, ('127.0.0.1', 0), keepalive=60)
+        self.address = self.server.browsers.socket.getsockname()
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _request(self, path, headers=''):
+        browser = socket.create_connection(self.address)
+        browser.sendall("GET %s HTTP/1.1\r\nHost: hub\r\n%s\r\n" % \
+                            (path, headers))
+        browser.settimeout(0.01)
+        return browser
+
+    def _read(self, browser, until):
+        data = ''
+        for i in range(100):
+            self.server.poll(0.01)
+            try:
+                chunk = browser.recv(4096)
+            except socket.timeout:
+                continue
+            data += chunk
+            if until in data or not chunk:
+                break
+        return data
+
+    def test_wait(self):
+        browser = self._request('/wait/map')
+        self.server.poll(0.01)
+        self.server.poll(0.01)
+
+        HubClient(self.path).publish('map', '{"id": 1}')
+        response = self._read(browser, '}]}')
+        self.assertTrue(response.startswith('HTTP/1.1 200 OK'))
+        body = json.loads(response.split('\r\n\r\n', 1)[1])
+        self.assertEqual(body['events'], [{'id': 1}])
+
+        # Messages after since are answered right away
+        browser = self._request('/wait/map?since=%d' % (body['since'] - 1))
+        response = self._read(browser, '}]}')
+        self.assertTrue(response.endswith('"events": [{"id": 1}]}'))
+
+    def test_stream(self):
+        HubClient(self.path).publish('map', '{"id": 1}')
+        self.server.poll(0.01)
+        self.server.poll(0.01)
+        last_id = self.server.channels['map'].last_id
+
+        browser = self._request('/stream/map',
+                                'Last-Event-ID: %d\r\n' % (last_id - 1))
+        response = self._read(browser, '\n\n' + 'id: %d' % last_id)
+        self._read(browser, '{"id": 1}')
+        self.assertTrue('text/event-stream' in response)
+
+        HubClient(self.path).publish('map', '{"id": 2}')
+        response = self._read(browser, '{"id": 2}')
+        self.assertTrue('id: %d\ndata: {"id": 2}\n\n' % (last_id + 1)
+                        in response)
+
+    def test_unknown_channel(self):
+        browser = self._request('/stream/other')
+        self.assertTrue(self._read(browser, '\r\n').startswith(
+                            'HTTP/1.1 404'))
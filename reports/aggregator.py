@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##
+## Author: Adriano Monteiro Marques <adriano@umitproject.org>
+##
+## Copyright (C) 2011 S2S Network Consultoria e Tecnologia da Informacao LTDA
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU Affero General Public License as
+## published by the Free Software Foundation, either version 3 of the
+## License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Affero General Public License for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""Write-behind updates of the Report aggregates.
+
+The counts of the user reports in an existing aggregate are added up in
+memory, per aggregate, and written at most flush_interval seconds later, or
+as soon as max_pending reports are waiting. Each flush reads every changed
+aggregate with one multiget and writes all of them with batched mutations,
+so a hot target costs one write per flush instead of one per report.
+
+The changes of a flush that fails are kept for the next one: the counts,
+if the aggregates couldn't be read, or the values to write, once the
+counts went to the counters. So are the counts of aggregates that another
+process is still creating.
+"""
+
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+from django.db import close_connection
+
+from django_cassandra.db.compiler import update_rows
+
+
+class AggregateDelta(object):
+    """Changes to an aggregate that weren't written yet.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.response_time_sum = 0
+        self.response_time_count = 0
+
+    def add(self, user_report):
+        self.count += 1
+        if user_report.response_time:
+            self.response_time_sum += user_report.response_time
+            self.response_time_count += 1
+
+    def merge(self, delta):
+        self.count += delta.count
+        self.response_time_sum += delta.response_time_sum
+        self.response_time_count += delta.response_time_count
+
+
+class ReportAggregator(object):
+
+    def __init__(self, flush_interval=0.5, max_pending=100):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending = {}
+        self._pending_reports = 0
+        # Values of the aggregates that failed to be written
+        self._unwritten = {}
+        self._timer = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def add(self, report_id, user_report):
+        """Counts user_report in the aggregate with the given id.
+        """
+        with self._lock:
+            delta = self._pending.get(report_id)
+            if delta is None:
+                delta = self._pending[report_id] = AggregateDelta()
+            delta.add(user_report)
+            self._pending_reports += 1
+            full = self._pending_reports >= self.max_pending
+
+            if not full:
+                self._schedule()
+
+        if full:
+            self.flush()
+
+    def _schedule(self):
+        # Called with self._lock held
+        if self._timer is None:
+            self._timer = threading.Timer(self.flush_interval,
+                                          self._timed_flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        """Writes the pending changes to the aggregates. Returns False if
+        another thread is already flushing.
+        """
+        # Only one thread flushes at a time, the others keep buffering
+        if not self._flush_lock.acquire(False):
+            return False
+
+        pending = {}
+        try:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                unwritten, self._unwritten = self._unwritten, {}
+                self._pending_reports = 0
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+
+            if pending or unwritten:
+                self._write(pending, unwritten)
+        except Exception, e:
+            logging.error("Failed to flush %s report aggregates: %s" % \
+                            (len(pending), e))
+        finally:
+            self._flush_lock.release()
+        return True
+
+    def _timed_flush(self):
+        with self._lock:
+            self._timer = None
+        try:
+            if not self.flush():
+                # Try again later, so the pending changes aren't left behind
+                with self._lock:
+                    if self._pending or self._unwritten:
+                        self._schedule()
+        finally:
+            # Give the timer thread's database connections back
+            close_connection()
+
+    def _restore(self, pending, unwritten):
+        """Keeps the changes of a failed flush for the next one, along with
+        the ones added in the meantime.
+        """
+        with self._lock:
+            for report_id, delta in pending.iteritems():
+                self._pending_reports += delta.count
+                newer = self._pending.get(report_id)
+                if newer is not None:
+                    delta.merge(newer)
+                self._pending[report_id] = delta
+            self._unwritten.update(unwritten)
+            if self._pending or self._unwritten:
+                self._schedule()
+
+    def _read(self, report_ids):
+        from reports.models import Report
+        return Report.objects.in_bulk(report_ids)
+
+    def _is_being_created(self, report_id):
+        from reports.models import Report
+        return Report.is_being_created(report_id)
+
+    def _update(self, changes):
+        from reports.models import Report
+        update_rows(Report, changes)
+
+    def _write(self, pending, unwritten):
+        try:
+            reports = self._read(pending.keys()) if pending else {}
+        except Exception:
+            self._restore(pending, unwritten)
+            raise
+
+        changes = dict((report_id, dict(values))
+                       for report_id, values in unwritten.iteritems())
+        waiting = {}
+        for report_id, delta in pending.iteritems():
+            report = reports.get(report_id)
+            if report is None:
+                if self._is_being_created(report_id):
+                    waiting[report_id] = delta
+                else:
+                    logging.warning("Can't count reports of missing aggregate %s" % \
+                                        report_id)
+                continue
+            changes.setdefault(report_id, {}).update(
+                    report.aggregate(delta.count, delta.response_time_sum,
+                                     delta.response_time_count))
+
+        try:
+            if changes:
+                self._update(changes)
+        except Exception:
+            # The counts are in the counters already, adding them again
+            # would count them twice. Only their values are written again.
+            self._restore(waiting, changes)
+            raise
+        if waiting:
+            self._restore(waiting, {})
+
+
+report_aggregator = ReportAggregator(
+        flush_interval=getattr(settings, 'REPORT_AGGREGATE_FLUSH_INTERVAL', 500)/1000.0,
+        max_pending=getattr(settings, 'REPORT_AGGREGATE_MAX_PENDING', 100))
+
+atexit.register(report_aggregator.flush)
@@ -20,23 +20,47 @@
 ## along with this program.  If not, see <http://www.gnu.org/licenses/>.
 ##
 
+import base64
 import logging
 import datetime
+import calendar
 import tarfile
 import decimal
 
 from django.db import models
+from django.core.cache import cache
 from django.utils import simplejson as json
 from django.core.files import File
 from icm_utils.json import ICMJSONEncoder
+from umit.proto import messages_pb2
 
-from dbextra.fields import ListField
+from dbextra.fields import ListField, WideListField
 from dbextra.fields import CassandraKeyField
 from dbextra.decorators import cache_model_method
 from geoip.models import Location, IPRange
 
 REPORT_PERIOD = datetime.timedelta(days=1)
 
+# Counters of the Report aggregates, updated atomically in the cache and
+# written to the report row after every update
+REPORT_COUNTER_KEY = "report_counter_%s_%s"
+REPORT_COUNTER_EXPIRATION = REPORT_PERIOD.days*24*60*60*2
+REPORT_CREATION_KEY = "report_creation_%s"
+REPORT_CREATION_EXPIRATION = 60
+
+def increment_counter(key, delta, stored_value):
+    """Atomically adds delta to the counter in key and returns its new value.
+    The counter starts from stored_value if it isn't in the cache.
+    """
+    cache.add(key, stored_value or 0, REPORT_COUNTER_EXPIRATION)
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        # Evicted since it was added
+        value = (stored_value or 0) + delta
+        cache.set(key, value, REPORT_COUNTER_EXPIRATION)
+        return value
+
 class Trace(object):
     def __init__(self, hop, ip, timings, location_id=None, location_name=None,
                  country_name=None, country_code=None, state_region=None,
@@ -58,16 +82,16 @@ class Trace(object):
             self.lat = decimal.Decimal(lat)
             self.lon = decimal.Decimal(lon)
         else:
-            iprange = IPRange.ip_location(ip)
-            self.location_id = iprange.location_id
-            self.location_name = iprange.location.fullname
-            self.country_name = iprange.location.country_name
-            self.country_code = iprange.location.country_code
-            self.state_region = iprange.location.state_region
-            self.city = iprange.location.city
-            self.zipcode = iprange.location.zipcode
-            self.lat = decimal.Decimal(iprange.location.lat)
-            self.lon = decimal.Decimal(iprange.location.lon)
+            self.location_id = IPRange.ip_location_id(ip)
+            location = Location.get_cached_location(self.location_id)
+            self.location_name = location.fullname
+            self.country_name = location.country_name
+            self.country_code = location.country_code
+            self.state_region = location.state_region
+            self.city = location.city
+            self.zipcode = location.zipcode
+            self.lat = decimal.Decimal(location.lat)
+            self.lon = decimal.Decimal(location.lon)
     
     @staticmethod
     def from_dump(dump):
@@ -102,6 +126,24 @@ class Trace(object):
                    lat=str(decimal.Decimal(self.lat)),
                    lon=str(decimal.Decimal(self.lon)))
 
+def trace_location(location):
+    """Returns the location arguments Trace takes for the given location, so
+    the trace doesn't need to geolocate its ip by itself.
+    """
+    return dict(location_id=location.id,
+                location_name=location.fullname,
+                country_name=location.country_name,
+                country_code=location.country_code,
+                state_region=location.state_region,
+                city=location.city,
+                zipcode=location.zipcode,
+                lat=location.lat,
+                lon=location.lon)
+
+def traceroute_ips(traceroute):
+    """Returns the target and hop ips of an ICMReport TraceRoute"""
+    return [traceroute.target] + [t.ip for t in traceroute.traces]
+
 def py_convert_trace(trace):
     return Trace.from_dump(trace)
 
@@ -165,7 +207,11 @@ class Report(models.Model):
     # Occurrences of similar reports
     count = models.IntegerField(default=1)
     
-    user_reports_ids = ListField(py_type=str)
+    # response_time is the mean of the response times reported so far
+    response_time_sum = models.IntegerField(default=0)
+    response_time_count = models.IntegerField(default=0)
+    
+    user_reports_ids = WideListField(py_type=str)
 
     def __unicode__(self):
         return "(%s) %s" % (self.updated_at, self.target)
@@ -173,7 +219,7 @@ class Report(models.Model):
     @cache_model_method('report_', 300, 'id')
     @property
     def user_reports(self):
-        return UserReport.objects.filter(id__in=self.user_reports_ids)
+        return UserReport.objects.filter(id__in=list(self.user_reports_ids))
     
     @cache_model_method('report_', 300, 'location_id')    
     @property
@@ -181,18 +227,40 @@ class Report(models.Model):
         """The location of the reporting node"""
         return Location.get_location_or_unknown(self.location_id)
     
+    @staticmethod
+    def dedup_key(test_id, location_id, created_at):
+        """Returns the id of the aggregate for the reports of a test from a
+        location, in the REPORT_PERIOD long bucket containing created_at.
+        """
+        period = REPORT_PERIOD.days*24*60*60 + REPORT_PERIOD.seconds
+        bucket = calendar.timegm(created_at.utctimetuple()) // period
+        return "%s|%s|%s" % (test_id, location_id, bucket)
+    
+    @staticmethod
+    def is_being_created(report_id):
+        """Tells if another process claimed the creation of the aggregate,
+        which may not be written yet.
+        """
+        return cache.get(REPORT_CREATION_KEY % report_id) is not None
+    
     @staticmethod
     def create_or_count(user_report):
         from decision.decisionSystem import DecisionSystem
 
-        report = Report.objects.filter(
-                        test_id=user_report.test_id,
-                        agent_location_id=user_report.agent_location_id,
-                        created_at__gte=user_report.created_at-REPORT_PERIOD,
-                        created_at__lte=user_report.created_at+REPORT_PERIOD
-        )
-        if not report:
+        key = Report.dedup_key(user_report.test_id,
+                               user_report.agent_location_id,
+                               user_report.created_at)
+        try:
+            report = Report.objects.get(id=key)
+        except Report.DoesNotExist:
+            report = None
+
+        # Only the process that claims the creation creates the aggregate,
+        # the others count their reports in it like in an existing one
+        if report is None and cache.add(REPORT_CREATION_KEY % key, True,
+                                        REPORT_CREATION_EXPIRATION):
             report = Report()
+            report.id = key
             report.test_id = user_report.test_id
             report.time = user_report.time
             report.time_zone = user_report.time_zone
@@ -224,19 +292,53 @@ class Report(models.Model):
             report.target_lat = user_report.target_lat
             report.target_lon = user_report.target_lon
             report.count = 1
+            if user_report.response_time:
+                report.response_time_sum = user_report.response_time
+                report.response_time_count = 1
+            try:
+                report.save()
+            except Exception:
+                cache.delete(REPORT_CREATION_KEY % key)
+                raise
             report.user_reports_ids.append(user_report.id)
             DecisionSystem.newReport(user_report)
-        else:
-            report = report[0]
-            report.count += 1
-            report.user_reports_ids.append(user_report.id)
-            if report.response_time and user_report.response_time:
-                report.response_time = (report.response_time + user_report.response_time)/2
-            elif not report.response_time and user_report.response_time:
-                report.response_time = user_report.response_time
+            return report
 
-        report.save()
-        return Report
+        # Existing aggregates are updated in batches, a little later, but
+        # the id is appended right away, it's a single column insert
+        from reports.aggregator import report_aggregator
+        Report.user_reports_ids.get_list(key).append(user_report.id)
+        report_aggregator.add(key, user_report)
+        return report
+
+    def aggregate(self, count, response_time_sum, response_time_count):
+        """Adds the counts of new user reports to this aggregate and returns
+        the values of the changed fields. The counts are incremented
+        atomically, so concurrent updates aren't lost.
+        """
+        changes = {'updated_at': datetime.datetime.now()}
+        changes['count'] = increment_counter(
+                REPORT_COUNTER_KEY % (self.id, 'count'), count, self.count)
+
+        if response_time_count:
+            stored_sum = self.response_time_sum
+            stored_count = self.response_time_count
+            if not stored_count and self.response_time:
+                # Aggregated before the sum and count were kept
+                stored_sum = self.response_time
+                stored_count = 1
+            changes['response_time_sum'] = increment_counter(
+                    REPORT_COUNTER_KEY % (self.id, 'response_time_sum'),
+                    response_time_sum, stored_sum)
+            changes['response_time_count'] = increment_counter(
+                    REPORT_COUNTER_KEY % (self.id, 'response_time_count'),
+                    response_time_count, stored_count)
+            changes['response_time'] = changes['response_time_sum'] / \
+                                       changes['response_time_count']
+
+        for name, value in changes.items():
+            setattr(self, name, value)
+        return changes
 
 
 class UserReport(models.Model):
@@ -307,6 +409,78 @@ class UserReport(models.Model):
     
     def add_trace(self, hop, ip, timing, **kwargs):
         self.trace.append(Trace(hop, ip, timing, **kwargs))
+
+    def read_traceroute(self, traceroute, locations=None):
+        """Reads the target and the traces of an ICMReport TraceRoute. The
+        target and all the hops are geolocated together, in one batch,
+        unless locations already maps their ips to Locations.
+        """
+        self.target = traceroute.target
+        self.hops = traceroute.hops
+        self.packet_size = traceroute.packetSize
+
+        if locations is None:
+            locations = IPRange.locate_many(traceroute_ips(traceroute))
+
+        # read ICMReport TraceRoute Traces
+        for rcvTrace in traceroute.traces:
+            self.trace.append(
+                    Trace(hop=rcvTrace.hop,
+                          ip=rcvTrace.ip,
+                          timings=[t for t in rcvTrace.packetsTiming],
+                          is_final=(self.target==rcvTrace.ip and 1 or 0),
+                          **trace_location(locations[rcvTrace.ip]))
+            )
+
+        # update target location
+        location = locations[self.target]
+        self.target_country_code = location.country_code
+        self.target_country_name = location.country_name
+        self.target_lat = location.lat
+        self.target_lon = location.lon
+        self.target_location_id = location.id
+        self.target_location_name = location.fullname
+        self.target_zipcode = location.zipcode
+        self.target_state_region = location.state_region
+        self.target_city = location.city
+    
+    def read_agent_location(self, agent, loggedAgent=None):
+        """Fills the location of the reporting node from the agent's login
+        info. Reports processed from the queue may arrive after the agent
+        logged out, in which case its last known IP is located instead.
+        """
+        from agents.models import LoggedAgent
+
+        if loggedAgent is None:
+            try:
+                loggedAgent = agent.getLoginInfo()
+            except LoggedAgent.DoesNotExist:
+                pass
+
+        if loggedAgent is not None:
+            self.agent_ip = loggedAgent.current_ip
+            self.agent_location_id = loggedAgent.location_id
+            self.agent_location_name = loggedAgent.location_name
+            self.agent_country_name = loggedAgent.country_name
+            self.agent_country_code = loggedAgent.country_code
+            self.agent_state_region = loggedAgent.state_region
+            self.agent_city = loggedAgent.city
+            self.agent_zipcode = loggedAgent.zipcode
+            self.agent_lat = loggedAgent.latitude
+            self.agent_lon = loggedAgent.longitude
+        else:
+            location = Location.get_cached_location(
+                            IPRange.ip_location_id(agent.lastKnownIP))
+            self.agent_ip = agent.lastKnownIP
+            self.agent_location_id = location.id
+            self.agent_location_name = location.fullname
+            self.agent_country_name = location.country_name
+            self.agent_country_code = location.country_code
+            self.agent_state_region = location.state_region
+            self.agent_city = location.city
+            self.agent_zipcode = location.zipcode
+            self.agent_lat = location.lat
+            self.agent_lon = location.lon
     
     def save(self, *args, **kwargs):
         new = self.id is None
@@ -333,7 +507,7 @@ class WebsiteReport(UserReport):
         return WebsiteReportMedia.objects.filter(id__in=self.media_ids)
 
     @staticmethod
-    def create(websiteReportMsg, agent):
+    def create(websiteReportMsg, agent, locations=None, loggedAgent=None):
         report = WebsiteReport()
 
         website_report = websiteReportMsg.report
@@ -385,43 +559,10 @@ class WebsiteReport(UserReport):
 
         # read ICMReport TraceRoute
         if icm_report.HasField('traceroute'):
-            report.target = icm_report.traceroute.target
-            report.hops = icm_report.traceroute.hops
-            report.packet_size = icm_report.traceroute.packetSize
-
-            # read ICMReport TraceRoute Traces
-            for rcvTrace in icm_report.traceroute.traces:
-                report.trace.append(
-                        Trace(hop=rcvTrace.hop,
-                              ip=rcvTrace.ip,
-                              timings=[t for t in rcvTrace.packetsTiming],
-                              is_final=(report.target==rcvTrace.ip and 1 or 0))
-                )
-
-            # update target location
-            iprange = IPRange.ip_location(report.target)
-            report.target_country_code = iprange.location.country_code
-            report.target_country_name = iprange.location.country_name
-            report.target_lat = iprange.location.lat
-            report.target_lon = iprange.location.lon
-            report.target_location_id = iprange.location_id
-            report.target_location_name = iprange.location.fullname
-            report.target_zipcode = iprange.location.zipcode
-            report.target_state_region = iprange.location.state_region
-            report.target_city = iprange.location.city
-
-        # get info about target ip
-        loggedAgent = agent.getLoginInfo()
-        report.agent_ip = loggedAgent.current_ip
-        report.agent_location_id = loggedAgent.location_id
-        report.agent_location_name = loggedAgent.location_name
-        report.agent_country_name = loggedAgent.country_name
-        report.agent_country_code = loggedAgent.country_code
-        report.agent_state_region = loggedAgent.state_region
-        report.agent_city = loggedAgent.city
-        report.agent_zipcode = loggedAgent.zipcode
-        report.agent_lat = loggedAgent.latitude
-        report.agent_lon = loggedAgent.longitude
+            report.read_traceroute(icm_report.traceroute, locations)
+
+        # get info about the reporting agent
+        report.read_agent_location(agent, loggedAgent)
         
         report.save()
         
@@ -445,7 +586,7 @@ class ServiceReport(UserReport):
     status_code = models.PositiveSmallIntegerField()
     
     @staticmethod
-    def create(serviceReportMsg, agent):
+    def create(serviceReportMsg, agent, locations=None, loggedAgent=None):
         report = ServiceReport()
 
         service_report = serviceReportMsg.report
@@ -479,44 +620,59 @@ class ServiceReport(UserReport):
 
         # read ICMReport TraceRoute
         if icm_report.HasField('traceroute'):
-            report.target = icm_report.traceroute.target
-            report.hops = icm_report.traceroute.hops
-            report.packet_size = icm_report.traceroute.packetSize
-
-            # read ICMReport TraceRoute Traces
-            for rcvTrace in icm_report.traceroute.traces:
-                report.trace.append(
-                        Trace(hop=rcvTrace.hop,
-                              ip=rcvTrace.ip,
-                              timings=[t for t in rcvTrace.packetsTiming],
-                              is_final=(report.target==rcvTrace.ip and 1 or 0))
-                )
-
-            # update target location
-            iprange = IPRange.ip_location(report.target)
-            report.target_country_code = iprange.location.country_code
-            report.target_country_name = iprange.location.country_name
-            report.target_lat = iprange.location.lat
-            report.target_lon = iprange.location.lon
-            report.target_location_id = iprange.location_id
-            report.target_location_name = iprange.location.fullname
-            report.target_zipcode = iprange.location.zipcode
-            report.target_state_region = iprange.location.state_region
-            report.target_city = iprange.location.city
-
-        # get info about target ip
-        loggedAgent = agent.getLoginInfo()
-        report.agent_ip = loggedAgent.current_ip
-        report.agent_location_id = loggedAgent.location_id
-        report.agent_location_name = loggedAgent.location_name
-        report.agent_country_name = loggedAgent.country_name
-        report.agent_country_code = loggedAgent.country_code
-        report.agent_state_region = loggedAgent.state_region
-        report.agent_city = loggedAgent.city
-        report.agent_zipcode = loggedAgent.zipcode
-        report.agent_lat = loggedAgent.latitude
-        report.agent_lon = loggedAgent.longitude
+            report.read_traceroute(icm_report.traceroute, locations)
+
+        # get info about the reporting agent
+        report.read_agent_location(agent, loggedAgent)
         
         report.save()
         return report
 
+
+REPORT_TYPES = {
+    'WEBSITE': (WebsiteReport, messages_pb2.SendWebsiteReport),
+    'SERVICE': (ServiceReport, messages_pb2.SendServiceReport),
+}
+
+class QueuedReport(models.Model):
+    """A report received from an agent which wasn't processed yet. Keeps the
+    decrypted SendWebsiteReport or SendServiceReport message, so that the
+    api can acknowledge the report right away and leave the geolocation,
+    aggregation and event creation to reports.tasks.process_report_queue.
+    """
+    created_at = models.DateTimeField(auto_now_add=True)
+    agent_id = CassandraKeyField()
+    report_type = models.CharField(max_length=10)
+    message = models.TextField()
+    attempts = models.IntegerField(default=0)
+    # Reports that failed aren't retried before this time
+    next_attempt = models.DateTimeField(null=True)
+
+    def __unicode__(self):
+        return "(%s) %s report from agent %s" % (self.created_at,
+                                                 self.report_type,
+                                                 self.agent_id)
+
+    @staticmethod
+    def enqueue(report_type, report_msg, agent):
+        queued = QueuedReport()
+        queued.agent_id = agent.id
+        queued.report_type = report_type
+        queued.message = base64.b64encode(report_msg.SerializeToString())
+        queued.save()
+        return queued
+
+    def process(self, agent):
+        """Creates the user report, the same way the api would have done
+        if the report hadn't been queued.
+        """
+        from decision.decisionSystem import DecisionSystem
+
+        Model, message_type = REPORT_TYPES[self.report_type]
+        report_msg = message_type()
+        report_msg.ParseFromString(base64.b64decode(self.message))
+
+        report = Model.create(report_msg, agent)
+        if self.report_type == 'SERVICE':
+            DecisionSystem.newReport(report)
+        return report
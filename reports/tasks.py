@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##
+## Author: Adriano Monteiro Marques <adriano@umitproject.org>
+##
+## Copyright (C) 2011 S2S Network Consultoria e Tecnologia da Informacao LTDA
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU Affero General Public License as
+## published by the Free Software Foundation, either version 3 of the
+## License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Affero General Public License for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""Module containing the report ingestion tasks.
+"""
+
+import logging
+import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+
+from celery.task import task
+
+from agents.models import Agent
+from reports.models import QueuedReport
+
+
+REPORT_QUEUE_SCHEDULED_KEY = "report_queue_scheduled"
+REPORT_QUEUE_RETRY_KEY = "report_queue_retry"
+REPORT_QUEUE_LOCK_KEY = "report_queue_lock"
+REPORT_QUEUE_LOCK_EXPIRATION = 60*10 # 10 minutes
+
+
+def schedule_report_queue():
+    """Schedules process_report_queue to run in REPORT_QUEUE_DELAY seconds,
+    unless it's already scheduled. Reports received meanwhile are processed
+    together, in a single task.
+    """
+    if cache.add(REPORT_QUEUE_SCHEDULED_KEY, True, settings.REPORT_QUEUE_DELAY):
+        process_report_queue.apply_async(countdown=settings.REPORT_QUEUE_DELAY)
+
+
+def schedule_report_retry(next_retry):
+    """Schedules process_report_queue to run at next_retry, unless a retry
+    is already scheduled.
+    """
+    delay = next_retry - datetime.datetime.now()
+    delay = max(delay.days*24*60*60 + delay.seconds + 1,
+                settings.REPORT_QUEUE_DELAY)
+    if cache.add(REPORT_QUEUE_RETRY_KEY, True, delay):
+        process_report_queue.apply_async(countdown=delay)
+
+
+def enqueue_report(report_type, report_msg, agent):
+    """Validates and queues a report received by the api.
+    """
+    if agent is None:
+        raise Exception("Reports can only be sent by registered agents")
+    if not report_msg.IsInitialized():
+        raise Exception("Report is missing required fields")
+
+    queued = QueuedReport.enqueue(report_type, report_msg, agent)
+    schedule_report_queue()
+    return queued
+
+
+def process_reports(queued_reports, now=None):
+    """Processes a batch of queued reports. Agents are fetched only once per
+    batch. Reports that fail are kept in the queue, to be retried up to
+    REPORT_QUEUE_MAX_ATTEMPTS times, REPORT_QUEUE_RETRY_DELAY seconds later
+    and twice as late after each attempt.
+    """
+    now = now or datetime.datetime.now()
+    agents = {}
+    processed = 0
+
+    for queued in queued_reports:
+        try:
+            agent = agents.get(queued.agent_id)
+            if agent is None:
+                agent = agents[queued.agent_id] = Agent.get_agent(queued.agent_id)
+
+            queued.process(agent)
+            queued.delete()
+            processed += 1
+        except Exception, e:
+            queued.attempts += 1
+            logging.error("Failed to process queued report %s (attempt %s): %s" % \
+                            (queued.id, queued.attempts, e))
+            if queued.attempts >= settings.REPORT_QUEUE_MAX_ATTEMPTS:
+                queued.delete()
+            else:
+                delay = settings.REPORT_QUEUE_RETRY_DELAY * \
+                        2 ** (queued.attempts - 1)
+                queued.next_attempt = now + datetime.timedelta(seconds=delay)
+                queued.save()
+
+    return processed
+
+
+def due_reports(queue, now):
+    """Returns the ids of the queued reports to process now, from the (id,
+    next_attempt) pairs in queue, and the time of the next retry of the
+    others, if any.
+    """
+    due = []
+    next_retry = None
+    for id, next_attempt in queue:
+        if next_attempt is None or next_attempt <= now:
+            due.append(id)
+        elif next_retry is None or next_attempt < next_retry:
+            next_retry = next_attempt
+    return due, next_retry
+
+
+@task()
+def process_report_queue():
+    """Task that processes the queued reports that are due, in batches of
+    REPORT_QUEUE_BATCH_SIZE, and schedules itself again for the retries.
+    """
+    if not cache.add(REPORT_QUEUE_LOCK_KEY, True, REPORT_QUEUE_LOCK_EXPIRATION):
+        # Another worker is already going through the queue, check again
+        # later for reports it might have missed
+        schedule_report_queue()
+        return 0
+
+    processed = 0
+    retries = []
+    try:
+        # The queue is read once, so the reports waiting for a retry aren't
+        # read again with each batch
+        now = datetime.datetime.now()
+        due, next_retry = due_reports(
+                QueuedReport.objects.values_list('id', 'next_attempt'), now)
+
+        batch_size = settings.REPORT_QUEUE_BATCH_SIZE
+        for i in range(0, len(due), batch_size):
+            # Keep other workers out while the batches go on
+            cache.set(REPORT_QUEUE_LOCK_KEY, True, REPORT_QUEUE_LOCK_EXPIRATION)
+            batch = QueuedReport.objects.in_bulk(due[i:i + batch_size]).values()
+            processed += process_reports(batch, now)
+            retries.extend([queued.next_attempt for queued in batch
+                            if queued.next_attempt and queued.next_attempt > now])
+    finally:
+        cache.delete(REPORT_QUEUE_LOCK_KEY)
+
+    if next_retry is not None:
+        retries.append(next_retry)
+    if retries:
+        schedule_report_retry(min(retries))
+
+    return processed
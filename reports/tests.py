@@ -14,3 +14,164 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+import datetime
+
+from reports.models import Report
+
+
+class ReportDedupKeyTest(TestCase):
+    def test_same_period(self):
+        morning = Report.dedup_key('test', 10, datetime.datetime(2011, 8, 1, 1))
+        night = Report.dedup_key('test', 10, datetime.datetime(2011, 8, 1, 23))
+        self.assertEqual(morning, night)
+
+    def test_different_period_or_location(self):
+        today = Report.dedup_key('test', 10, datetime.datetime(2011, 8, 1, 12))
+        tomorrow = Report.dedup_key('test', 10, datetime.datetime(2011, 8, 2, 12))
+        elsewhere = Report.dedup_key('test', 11, datetime.datetime(2011, 8, 1, 12))
+        self.assertNotEqual(today, tomorrow)
+        self.assertNotEqual(today, elsewhere)
+
+
+from reports.aggregator import ReportAggregator
+from reports.models import UserReport
+
+
+class ReportAggregatorTest(TestCase):
+    def setUp(self):
+        # Long enough for the timer not to flush during the test
+        self.aggregator = ReportAggregator(flush_interval=600)
+
+    def tearDown(self):
+        if self.aggregator._timer is not None:
+            self.aggregator._timer.cancel()
+
+    def test_failed_read_keeps_counts(self):
+        def read(report_ids):
+            raise IOError("unavailable")
+        self.aggregator._read = read
+
+        self.aggregator.add('report', UserReport(response_time=10))
+        self.aggregator.flush()
+        self.aggregator.add('report', UserReport(response_time=20))
+
+        delta = self.aggregator._pending['report']
+        self.assertEqual(delta.count, 2)
+        self.assertEqual(delta.response_time_sum, 30)
+        self.assertEqual(delta.response_time_count, 2)
+        self.assertEqual(self.aggregator._pending_reports, 2)
+
+    def test_failed_write_keeps_values(self):
+        class Report(object):
+            def aggregate(self, count, response_time_sum, response_time_count):
+                return {'count': 5}
+
+        written = []
+        def update(changes):
+            if not written:
+                written.append(None)
+                raise IOError("unavailable")
+            written.append(changes)
+        self.aggregator._read = lambda report_ids: {'report': Report()}
+        self.aggregator._update = update
+
+        self.aggregator.add('report', UserReport(response_time=10))
+        self.aggregator.flush()
+        self.assertEqual(self.aggregator._pending, {})
+        self.assertEqual(self.aggregator._unwritten, {'report': {'count': 5}})
+
+        self.aggregator.flush()
+        self.assertEqual(written[-1], {'report': {'count': 5}})
+        self.assertEqual(self.aggregator._unwritten, {})
+
+    def test_waits_for_created_aggregate(self):
+        self.aggregator._read = lambda report_ids: {}
+        self.aggregator._is_being_created = lambda report_id: True
+
+        self.aggregator.add('report', UserReport(response_time=10))
+        self.aggregator.flush()
+        self.assertEqual(self.aggregator._pending['report'].count, 1)
+
+        self.aggregator._is_being_created = lambda report_id: False
+        self.aggregator.flush()
+        self.assertEqual(self.aggregator._pending, {})
+
+
+from django.conf import settings
+
+from reports import tasks
+
+
+class FakeQueuedReport(object):
+    def __init__(self, id, fails=False, attempts=0):
+        self.id = id
+        self.agent_id = 'agent'
+        self.fails = fails
+        self.attempts = attempts
+        self.next_attempt = None
+        self.deleted = False
+
+    def process(self, agent):
+        if self.fails:
+            raise IOError("unavailable")
+
+    def delete(self):
+        self.deleted = True
+
+    def save(self):
+        pass
+
+
+class ReportQueueTest(TestCase):
+    def setUp(self):
+        self._get_agent = tasks.Agent.get_agent
+        tasks.Agent.get_agent = staticmethod(lambda agent_id: None)
+        self.now = datetime.datetime(2011, 1, 1)
+
+    def tearDown(self):
+        tasks.Agent.get_agent = self._get_agent
+
+    def test_due_reports(self):
+        later = self.now + datetime.timedelta(minutes=1)
+        much_later = self.now + datetime.timedelta(minutes=2)
+        queue = [('a', None), ('b', much_later), ('c', self.now), ('d', later)]
+        self.assertEqual(tasks.due_reports(queue, self.now),
+                         (['a', 'c'], later))
+        self.assertEqual(tasks.due_reports([('a', None)], self.now),
+                         (['a'], None))
+
+    def test_failed_reports_back_off(self):
+        ok = FakeQueuedReport('ok')
+        failed = FakeQueuedReport('failed', fails=True)
+        retried = FakeQueuedReport('retried', fails=True, attempts=1)
+        last = FakeQueuedReport('last', fails=True,
+                                attempts=settings.REPORT_QUEUE_MAX_ATTEMPTS - 1)
+
+        processed = tasks.process_reports([ok, failed, retried, last], self.now)
+        self.assertEqual(processed, 1)
+        self.assertTrue(ok.deleted)
+
+        delay = datetime.timedelta(seconds=settings.REPORT_QUEUE_RETRY_DELAY)
+        self.assertEqual(failed.next_attempt, self.now + delay)
+        self.assertEqual(retried.next_attempt, self.now + delay*2)
+        self.assertFalse(failed.deleted or retried.deleted)
+        self.assertTrue(last.deleted)
+
+
+from reports.models import Trace
+
+
+class ReportTraceTest(TestCase):
+    def test_round_trip(self):
+        trace = Trace(1, '10.0.0.1', [12, 14], location_id=5,
+                      location_name='Campinas, SP, Brazil',
+                      country_name='Brazil', country_code='BR',
+                      state_region='SP', city='Campinas', zipcode='13000',
+                      lat='-22.9', lon='-47.06', is_final=1)
+        field = Report._meta.get_field('trace')
+        raw = field.get_prep_value(field.pre_save(Report(trace=[trace]), False))
+
+        traces = Report(trace=raw).trace
+        self.assertEqual([t.get_dict() for t in traces], [trace.get_dict()])
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##
+## Author: Adriano Monteiro Marques <adriano@umitproject.org>
+##
+## Copyright (C) 2011 S2S Network Consultoria e Tecnologia da Informacao LTDA
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU Affero General Public License as
+## published by the Free Software Foundation, either version 3 of the
+## License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Affero General Public License for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""Standalone microbenchmark of the ListField codec against the older
+comma-separated encoding.
+
+Usage: benchmark_listfield.py [list size] [repetitions]
+"""
+
+import csv
+import sys
+import random
+import decimal
+import timeit
+import StringIO
+from os.path import dirname, abspath
+
+AGG_DIR = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, AGG_DIR)
+
+from dbextra.listcodec import encode_list, decode_list, encode_csv
+
+
+def decode_csv(value, py_converter):
+    """The csv reader loop of the older versions of ListField.
+    """
+    return [py_converter(v[0])
+            for v in csv.reader(StringIO.StringIO(value), delimiter=',')]
+
+
+def sample_lists(size):
+    ints = [random.randint(0, 2**31) for i in xrange(size)]
+    decimals = [decimal.Decimal('%.4f' % random.uniform(-180, 180))
+                for i in xrange(size)]
+    strings = ['%x' % random.getrandbits(128) for i in xrange(size)]
+    return [('int', int, ints),
+            ('decimal', decimal.Decimal, decimals),
+            ('str', str, strings)]
+
+
+def bench(fn, repetitions):
+    return min(timeit.repeat(fn, number=repetitions, repeat=3))
+
+
+def main(size, repetitions):
+    print "%d elements, %d repetitions" % (size, repetitions)
+    print "%-8s %-7s %10s %10s %8s %8s" % ('type', 'op', 'csv', 'codec',
+                                           'speedup', 'size')
+
+    for name, py_type, values in sample_lists(size):
+        old = encode_csv(values)
+        new = encode_list(values, py_type)
+        assert decode_list(new, py_type) == values
+        assert decode_list(old, py_type) == values
+
+        results = [
+            ('encode', lambda: encode_csv(values),
+                       lambda: encode_list(values, py_type)),
+            ('decode', lambda: decode_csv(old, py_type),
+                       lambda: decode_list(new, py_type)),
+        ]
+        for op, csv_fn, codec_fn in results:
+            csv_time = bench(csv_fn, repetitions)
+            codec_time = bench(codec_fn, repetitions)
+            print "%-8s %-7s %9.4fs %9.4fs %7.1fx %7.2f" % (name, op,
+                    csv_time, codec_time, csv_time / codec_time,
+                    float(len(new)) / len(old))
+
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    repetitions = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    main(size, repetitions)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##
+## Author: Adriano Monteiro Marques <adriano@umitproject.org>
+##
+## Copyright (C) 2011 S2S Network Consultoria e Tecnologia da Informacao LTDA
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU Affero General Public License as
+## published by the Free Software Foundation, either version 3 of the
+## License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Affero General Public License for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""Standalone script for compiling the GeoLiteCity CSV files into the binary
+GeoIP database read by geoip.geodb. Point settings.GEOIP_DATABASE to the
+generated file to use it.
+"""
+
+import csv
+import sys
+from os.path import dirname, abspath, join
+
+AGG_DIR =  dirname(dirname(dirname(abspath(__file__))))
+sys.path.insert(0, AGG_DIR)
+
+from geoip.geodb import build_database
+from download import CUR_DIR, GEO_BLOCK_CSV, GEO_LOCATION_CSV
+
+
+CSV_FILE = 'country_codes.csv'
+GEO_DATABASE = 'GeoLiteCity.dat'
+
+
+def load_country_names():
+    """Same names fill_geoips.py puts in the location table."""
+    country_names = {}
+    for country_name, country_code in csv.reader(open(join(CUR_DIR, CSV_FILE), 'r'),
+                                                 delimiter=';'):
+        country_names[country_code] = country_name.split(',')[0].title().decode('latin-1')
+
+    extra = [('South Korea', 'KR'), ('North Korea', 'KP'),
+             ('British Virgin Islands', 'VG'), ('U.S. Virgin Islands', 'VI')]
+    for country_name, country_code in extra:
+        country_names[country_code] = country_name.title().decode('latin-1')
+
+    return country_names
+
+
+def main(output_path):
+    print "Building GeoIP database at %s" % output_path
+    ranges, locations = build_database(join(CUR_DIR, GEO_BLOCK_CSV),
+                                       join(CUR_DIR, GEO_LOCATION_CSV),
+                                       output_path,
+                                       load_country_names())
+    print "Wrote %s ranges and %s locations." % (ranges, locations)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else join(CUR_DIR, GEO_DATABASE))
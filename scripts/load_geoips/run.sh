@@ -2,6 +2,8 @@
 echo "Starting download geoip data..."
 python download.py
 rm -rf GeoLiteCity*.zip
+echo "Building binary geoip database..."
+python build_geodb.py
 echo "Importing location data into mysql..."
 mysql -uroot -proot --local-infile=1 openmonitor<load_geoips.sql
 echo "Filling location names..."
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##
+## Author: Adriano Monteiro Marques <adriano@umitproject.org>
+##
+## Copyright (C) 2011 S2S Network Consultoria e Tecnologia da Informacao LTDA
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU Affero General Public License as
+## published by the Free Software Foundation, either version 3 of the
+## License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Affero General Public License for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+
+"""Standalone script that moves the lists kept in the columns of the older
+ListFields into the wide rows of the WideListFields that replaced them,
+like Report.user_reports_ids and EventLocationAggregation.events.
+
+Lists whose wide row already has elements are left as they are, so the
+script can be run again. The old columns are removed unless --keep is given.
+
+Usage: migrate_wide_lists.py [--keep]
+"""
+
+import sys
+from os.path import dirname, abspath
+
+AGG_DIR = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, AGG_DIR)
+
+from django.core.management import setup_environ
+import settings
+setup_environ(settings)
+
+from django.db import connections
+from django.db.models import get_models
+from pycassa.cassandra import Cassandra
+from pycassa.cassandra.ttypes import *
+
+from django_cassandra.db.utils import call_cassandra_with_reconnect, \
+    get_next_timestamp
+from dbextra.fields import _wide_list_fields
+from dbextra.listcodec import decode_list
+
+PAGE_SIZE = 500
+
+
+def iter_old_lists(field):
+    """Yields the key and the old column of every row of the model of field
+    that still has it.
+    """
+    connection = connections[field.row.using]
+    column_parent = ColumnParent(column_family=field.model._meta.db_table)
+    predicate = SlicePredicate(column_names=[field.name])
+
+    start = ''
+    while True:
+        key_range = KeyRange(start_key=start, end_key='', count=PAGE_SIZE)
+        key_slices = call_cassandra_with_reconnect(connection.db_connection,
+                        Cassandra.Client.get_range_slices, column_parent,
+                        predicate, key_range,
+                        connection.read_consistency_level)
+        for key_slice in key_slices:
+            # Each page starts with the last row of the previous one
+            if key_slice.key != start and key_slice.columns:
+                yield key_slice.key, key_slice.columns[0].column.value
+        if len(key_slices) < PAGE_SIZE:
+            break
+        start = key_slices[-1].key
+
+
+def remove_old_list(field, key):
+    connection = connections[field.row.using]
+    path = ColumnPath(column_family=field.model._meta.db_table,
+                      column=field.name)
+    call_cassandra_with_reconnect(connection.db_connection,
+        Cassandra.Client.remove, key, path, get_next_timestamp(),
+        connection.write_consistency_level)
+
+
+def migrate(field, keep=False):
+    moved = 0
+    for key, value in iter_old_lists(field):
+        values = [field.db_converter(v)
+                  for v in decode_list(value, field.py_converter)]
+        if values and not field.row.get_slice(key, count=1):
+            field.row.extend(key, values, field.indexed)
+            moved += 1
+        if not keep:
+            remove_old_list(field, key)
+    return moved
+
+
+def main():
+    keep = '--keep' in sys.argv[1:]
+
+    # Every model is loaded, so all the wide lists are known
+    get_models()
+    for field in _wide_list_fields:
+        moved = migrate(field, keep)
+        print "%s.%s: %d lists moved" % (field.model.__name__, field.name,
+                                         moved)
+
+
+if __name__ == '__main__':
+    main()
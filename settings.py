@@ -43,6 +43,8 @@ DATABASES = {'default': {'ENGINE': 'django_cassandra.db',
                            'SUPPORTS_TRANSACTIONS':False,
                            'CASSANDRA_REPLICATION_FACTOR':2,
                            'CASSANDRA_ENABLE_CASCADING_DELETES':True,
+                           'CASSANDRA_POOL_SIZE':5,
+                           'CASSANDRA_FULL_SCANS':'allow',
                            'TEST_NAME':'openmonitor_test'},
              "mysql": {'ENGINE': 'mysql',
                        'NAME':'openmonitor',
@@ -243,6 +245,76 @@ USE_I18N = True
 MAX_NETLIST_RESPONSE = 10
 MAX_AGENTSLIST_RESPONSE = 5
 
+##########################
+# PEER DIRECTORY SETTINGS
+# Seconds between reloads of the logged agents picked as peers
+PEER_DIRECTORY_REFRESH_INTERVAL = 60
+# Number of offline agents with the best uptime kept as fallback peers
+PEER_DIRECTORY_OFFLINE_PEERS = 100
+
+#################
+# GEOIP SETTINGS
+# Keeps a sorted, in-process index of the IP ranges in every worker so that
+# IP lookups don't need to query MySQL.
+GEOIP_RANGE_INDEX = True
+# Binary database built by scripts/load_geoips/build_geodb.py. When set, IP
+# and location lookups are answered from it through mmap before MySQL.
+GEOIP_DATABASE = None
+# Seconds between flushes of the buffered IPRange and Location nodes counts
+NODES_COUNT_FLUSH_INTERVAL = 5
+# Number of networks with the most nodes kept for the network list
+TOP_NETWORKS_SIZE = 100
+
+###################
+# REPORT INGESTION
+# When enabled, the api only queues the reports it receives and acknowledges
+# them right away. They're processed later by reports.tasks, on the celery
+# workers, REPORT_QUEUE_BATCH_SIZE at a time.
+ASYNC_REPORT_INGESTION = False
+REPORT_QUEUE_BATCH_SIZE = 100
+# Most reports an agent can send in a single batch request
+REPORT_BATCH_MAX_REPORTS = 100
+# Seconds to wait for more reports before processing the queue
+REPORT_QUEUE_DELAY = 5
+REPORT_QUEUE_MAX_ATTEMPTS = 3
+# Seconds before a failed report is retried, doubled after each attempt
+REPORT_QUEUE_RETRY_DELAY = 60
+# Reports counted in existing aggregates are written together, at most
+# REPORT_AGGREGATE_FLUSH_INTERVAL milliseconds later or as soon as
+# REPORT_AGGREGATE_MAX_PENDING reports are waiting.
+REPORT_AGGREGATE_FLUSH_INTERVAL = 500
+REPORT_AGGREGATE_MAX_PENDING = 100
+
+#########
+# EVENTS
+# Number of active events kept serialized by events.feed for the map and
+# the poll view
+ACTIVE_EVENTS_FEED_SIZE = 25
+# Number of the latest event changes kept for the delta polls of
+# /events/changes
+EVENT_CHANGES_BUFFER_SIZE = 1000
+
+####################
+# REALTIME EVENTS HUB
+# UNIX socket the web processes publish the events to. The relay server
+# ("manage.py realtimehub") listens on it. When None, nothing is published
+# and the browsers only poll.
+REALTIME_HUB_SOCKET = None
+# Address the relay server serves the browsers on, and the URL the front-end
+# web server proxies to it, as seen by the browsers
+REALTIME_HUB_ADDRESS = ('127.0.0.1', 8001)
+REALTIME_STREAM_URL = None
+# Number of the latest events kept per channel for reconnecting browsers
+REALTIME_HUB_BACKLOG = 100
+# Seconds a long poll of /wait/<channel> waits for events
+REALTIME_LONG_POLL_TIMEOUT = 30
+# Seconds a /stream/<channel> connection is kept open, and between the
+# keep-alive comments sent on it. Browsers reconnect after
+# REALTIME_STREAM_RETRY seconds.
+REALTIME_STREAM_TIMEOUT = 300
+REALTIME_STREAM_KEEPALIVE = 15
+REALTIME_STREAM_RETRY = 5
+
 #########################
 # File Transfer settings
 PREPARE_UPLOAD_BACKEND = 'filetransfers.backends.delegate.prepare_upload'
@@ -264,6 +336,10 @@ RSAKEY_U = 480716677972136688172353265038083263882320363755084097931083195396290
 
 RSA_KEYSIZE = 1024
 
+# Max number of agents whose AES ciphers and RSA public keys are kept, per
+# process, by agents.cryptocontext
+CRYPTO_CONTEXT_CACHE_SIZE = 10000
+
 
 ######################
 # AJAX_SELECT OPTIONS
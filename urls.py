@@ -35,6 +35,7 @@ urlpatterns = patterns('',
     url(r'', include('gui.urls')),
     url(r'', include('geoip.urls')),
     url(r'^events/poll$', 'gui.views.poll_active_events'),
+    url(r'^events/changes$', 'gui.views.poll_event_changes'),
     url(r'^map/$', 'gui.views.map'),
     url(r'^realtimebox/$', 'gui.views.realtimebox'),
     url(r'^events/(?P<event_id>%s)/$' % CASSANDRA_KEY_PATTERN, 'gui.views.event'),
@@ -20,9 +20,20 @@
 ## along with this program.  If not, see <http://www.gnu.org/licenses/>.
 ##
 
+import time
+
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.core.cache import cache
 from datetime import datetime
 
+
+# Cached version headers are keyed by this generation, so changing it drops
+# all of them at once.
+VERSION_HEADER_GENERATION_KEY = "version_header_generation"
+VERSION_HEADER_EXPIRATION = 60*60*24 # 1 day
+
+
 class SoftwareVersion(models.Model):
     released_at = models.DateTimeField(auto_now_add=True)
     version  = models.IntegerField()
@@ -35,8 +46,6 @@ class SoftwareVersion(models.Model):
 class DesktopAgentVersion(SoftwareVersion):
 
     def getLastVersionNo():
-        # TODO (Adriano): Use memcache to store this version indefinitely and
-        # create signals to revogate cache once a new version is added
         try:
             return DesktopAgentVersion.objects.order_by('-version')[0:1].get()
         except DesktopAgentVersion.DoesNotExist:
@@ -52,8 +61,6 @@ class DesktopAgentVersion(SoftwareVersion):
 class MobileAgentVersion(SoftwareVersion):
 
     def getLastVersionNo():
-        # TODO (Adriano): Use memcache to store this version indefinitely and create signals 
-        # to revogate cache once a new version is added
         try:
             return MobileAgentVersion.objects.order_by('-version')[0:1].get()
         except MobileAgentVersion.DoesNotExist:
@@ -64,3 +71,29 @@ class MobileAgentVersion(SoftwareVersion):
         return "Mobile Agent v" + str(self.version)
 
     getLastVersionNo = staticmethod(getLastVersionNo)
+
+
+AGENT_VERSION_MODELS = {
+    'DESKTOP': DesktopAgentVersion,
+    'MOBILE': MobileAgentVersion,
+}
+
+
+def get_version_header_generation():
+    generation = cache.get(VERSION_HEADER_GENERATION_KEY)
+    if generation is None:
+        generation = invalidate_version_headers()
+    return generation
+
+def invalidate_version_headers(*args, **kwargs):
+    """Starts a new generation of cached version headers. Used as a signal
+    receiver for every model that takes part in them.
+    """
+    generation = str(time.time())
+    cache.set(VERSION_HEADER_GENERATION_KEY, generation,
+              VERSION_HEADER_EXPIRATION)
+    return generation
+
+for VersionModel in AGENT_VERSION_MODELS.values():
+    post_save.connect(invalidate_version_headers, sender=VersionModel)
+    post_delete.connect(invalidate_version_headers, sender=VersionModel)